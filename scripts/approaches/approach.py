@@ -1,15 +1,31 @@
+import json
+import re
+
 from abc import ABC, abstractmethod
-from typing import Dict, List
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import Any, Dict, List, Optional, Tuple
 from rdflib.plugins.sparql.parser import parseQuery
 from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.term import URIRef, Variable
 
 from spy import Spy
 
 
 class Approach(ABC):
 
+    # an RDF term formatted as in the responses of a SaGe server, on which
+    # keys are ordered, e.g. "1"^^http://www.w3.org/2001/XMLSchema#integer
+    SERIALIZATION = (
+        'COALESCE(IF(isLiteral({0}), CONCAT("\\"", STR({0}), "\\"", '
+        'IF(LANG({0}) != "", CONCAT("@", LANG({0})), '
+        'IF(DATATYPE({0}) = <http://www.w3.org/2001/XMLSchema#string>, "", '
+        'CONCAT("^^", STR(DATATYPE({0})))))), STR({0})), "")')
+
     def __init__(self, name: str) -> None:
         self._name = name
+        # the resources created by the approach itself, e.g. its transport,
+        # which are released by close(), unlike the ones given by the caller
+        self._resources = list()
 
     @property
     def name(self) -> str:
@@ -36,9 +52,11 @@ class Approach(ABC):
         where_clause = query.split("WHERE")[1]
         return f"{prefixes}SELECT {projection} WHERE {where_clause}"
 
-    def __set_limit__(self, query: str, limit: int = 0) -> str:
+    def __set_limit__(
+        self, query: str, limit: int = 0, offset: int = 0
+    ) -> str:
         """
-        Updates the LIMIT clause of the query.
+        Updates the LIMIT and OFFSET clauses of the query.
 
         Parameters
         ----------
@@ -46,7 +64,10 @@ class Approach(ABC):
             A SPARQL query.
         limit: int - (default = 0)
             The value with which to update the LIMIT clause. If limit = 0, then
-            the LIMIT clause is not updated.
+            the LIMIT and OFFSET clauses are not updated.
+        offset: int - (default = 0)
+            The value of the OFFSET clause. If offset = 0, then the query has
+            no OFFSET clause.
 
         Returns
         -------
@@ -55,8 +76,9 @@ class Approach(ABC):
         """
         if limit == 0:
             return query
-        elif "LIMIT" in query:
-            query = query.split("LIMIT")[0]
+        query = re.sub(r"\s*\b(LIMIT|OFFSET)\s+\d+", "", query)
+        if offset > 0:
+            return f"{query} LIMIT {limit} OFFSET {offset}"
         return f"{query} LIMIT {limit}"
 
     def __get_orderby_variables__(self, query: str) -> List[str]:
@@ -80,6 +102,88 @@ class Approach(ABC):
                 variables.append(variable.n3())
         return variables
 
+    def __scan_order__(self, query: str) -> List[Tuple[str, str]]:
+        """
+        Returns the variables on which the solutions of a query are produced
+        sorted when the server follows the join order of the query. The first
+        triple pattern of the query, as written, is then scanned first. If its
+        predicate is an IRI, it is scanned in an index sorted on objects then
+        subjects, in ascending order of their serialization.
+
+        Parameters
+        ----------
+        query: str
+            A SPARQL TOP-K query.
+
+        Returns
+        -------
+        List[Tuple[str, str]]
+            The variables on which the solutions are sorted, with their order,
+            i.e. the object then the subject of the first triple pattern if
+            they are variables, or an empty list if the solutions are not
+            sorted.
+        """
+        triples = None
+        for part in parseQuery(query)[1]["where"].get("part", []):
+            if part.name == "TriplesBlock" and len(part["triples"]) > 0:
+                triples = part["triples"][0]
+                break
+        if triples is None:
+            return []
+        subject, predicate, obj = triples[:3]
+        if isinstance(predicate, Variable) or not isinstance(obj, Variable):
+            return []
+        # the predicate is parsed as a property path, which must be an IRI,
+        # as other paths are not a single scan of the index
+        sequences = predicate["part"]
+        if len(sequences) != 1 or len(sequences[0]["part"]) != 1:
+            return []
+        element = sequences[0]["part"][0]
+        if "mod" in element or not (
+            isinstance(element["part"], URIRef)
+            or element["part"].name == "pname"
+        ):
+            return []
+        variables = [(obj.n3(), "ASC")]
+        if isinstance(subject, Variable) and subject != obj:
+            variables.append((subject.n3(), "ASC"))
+        return variables
+
+    def __sorted_access__(
+        self, variables: List[Tuple[str, str]],
+        response: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Returns the sorted access path of a quantum, as reported by the
+        server, or as deduced by the client from the order of the scan of the
+        query. The solutions of a quantum are sorted on the variables of the
+        scan, or on the ORDER BY keys for a partial TOP-K, so its last
+        solution is not ordered after the solutions that the server scans in
+        the next quanta, on the variables shared by the scan and the ORDER BY
+        clause.
+
+        Parameters
+        ----------
+        variables: List[Tuple[str, str]]
+            The variables on which the scan of the query is sorted, or an
+            empty list if it is not sorted.
+        response: Dict[str, Any]
+            The response of the server to a quantum.
+
+        Returns
+        -------
+        None | Dict[str, Any]
+            The variables on which the solutions are sorted, with their order,
+            and their values in the last solution of the quantum, or None if
+            the access path of the quantum is not known to be sorted.
+        """
+        sorted_access = response["stats"].get("sorted")
+        if sorted_access is not None:
+            return sorted_access
+        if len(variables) == 0 or len(response["bindings"]) == 0:
+            return None
+        return {"variables": variables, "last": response["bindings"][-1]}
+
     def __extract_limit__(self, query: str) -> int:
         """
         Extracts k in the LIMIT k of a SPARQL query.
@@ -95,9 +199,150 @@ class Approach(ABC):
             The limit k of a TOP-k SPARQL query, or 10 if the query has no
             LIMIT clause.
         """
-        if "LIMIT" not in query:
+        match = re.search(r"\bLIMIT\s+(\d+)", query)
+        if match is None:
             return 10
-        return int(query.split("LIMIT")[1])
+        return int(match.group(1))
+
+    def __extract_offset__(self, query: str) -> int:
+        """
+        Extracts n in the OFFSET n of a SPARQL query.
+
+        Parameters
+        ----------
+        query: str
+            A TOP-k SPARQL query.
+
+        Returns
+        -------
+        int
+            The offset n of a TOP-k SPARQL query, or 0 if the query has no
+            OFFSET clause.
+        """
+        match = re.search(r"\bOFFSET\s+(\d+)", query)
+        if match is None:
+            return 0
+        return int(match.group(1))
+
+    def __resume_page__(
+        self, continuation: Optional[str], offset: int
+    ) -> Tuple[int, Optional[Dict[str, str]], int]:
+        """
+        Decodes the continuation token of a page. Pages are requested with
+        keyset pagination: the token contains the last solution of the
+        previous page, so the next page only contains solutions that are not
+        ordered before it. As several solutions can share the same ORDER BY
+        key, the token also contains the number of solutions with the key of
+        the last solution that were already returned, i.e. the ties to skip.
+
+        Parameters
+        ----------
+        continuation: None | str
+            The token returned with the previous page, or None to request the
+            first page.
+        offset: int
+            The number of solutions to skip after the previous page.
+
+        Returns
+        -------
+        Tuple[int, None | Dict[str, str], int]
+            The position of the first solution of the page in the result of
+            the query, the last solution of the previous page, and the number
+            of solutions to skip among the solutions that are not ordered
+            before it.
+        """
+        if continuation is None:
+            return offset, None, offset
+        state = json.loads(urlsafe_b64decode(continuation.encode("utf-8")))
+        if state["approach"] != self.name:
+            raise Exception((
+                f"The continuation was created by {state['approach']}, it "
+                f"cannot be used by {self.name}..."))
+        position = state["position"] + offset
+        return position, state["last"], state["ties"] + offset
+
+    def __keyset__(
+        self, query: str, last: Optional[Dict[str, str]]
+    ) -> Optional[str]:
+        """
+        Restricts a SPARQL TOP-K query to the solutions that are not ordered
+        before the last solution of the previous page, with a FILTER on its
+        ORDER BY keys. Keys are compared on their serialization in the
+        responses of a SaGe server, as they are ordered by the server, so the
+        query keeps exactly the ties of the last solution and the solutions
+        ordered after it.
+
+        Parameters
+        ----------
+        query: str
+            A SPARQL TOP-K query.
+        last: None | Dict[str, str]
+            The last solution of the previous page, as sent by the server.
+
+        Returns
+        -------
+        None | str
+            The SPARQL TOP-K query restricted to the solutions that are not
+            ordered before the last solution, the query itself if there is no
+            previous page, or None if an ORDER BY condition is not a variable.
+        """
+        if last is None:
+            return query
+        conditions = []
+        for condition in translateQuery(parseQuery(query)).algebra.p.p.p.expr:
+            if not isinstance(condition.expr, Variable):
+                return None
+            variable = condition.expr.n3()
+            conditions.append((
+                Approach.SERIALIZATION.format(variable),
+                "<" if condition.order == "DESC" else ">",
+                json.dumps(last.get(variable, ""), ensure_ascii=False)))
+        disjuncts = []
+        ties = []
+        for serialization, operator, value in conditions:
+            disjuncts.append(" && ".join(
+                [*ties, f"{serialization} {operator} {value}"]))
+            ties.append(f"{serialization} = {value}")
+        disjuncts.append(" && ".join(ties))
+        expression = " || ".join([f"({term})" for term in disjuncts])
+        end = query.rfind("}")
+        return f"{query[:end]}\tFILTER({expression})\n{query[end:]}"
+
+    def __next_page__(
+        self, position: int, solutions: int, limit: int,
+        last: Optional[Tuple[Dict[str, Any], int]] = None
+    ) -> Optional[str]:
+        """
+        Creates the continuation token of the next page.
+
+        Parameters
+        ----------
+        position: int
+            The position of the first solution of the page in the result of
+            the query.
+        solutions: int
+            The number of solutions of the page.
+        limit: int
+            The size of a page.
+        last: None | Tuple[Dict[str, Any], int] - (default = None)
+            The last solution of the page, as sent by the server, and the
+            number of solutions returned so far with its ORDER BY key.
+
+        Returns
+        -------
+        None | str
+            The continuation token, or None if the page is the last one.
+        """
+        if solutions < limit:
+            return None
+        mappings, ties = last if last is not None else (None, 0)
+        state = {
+            "approach": self.name,
+            "position": position + solutions,
+            "last": mappings,
+            "ties": ties}
+        return urlsafe_b64encode(json.dumps(state).encode("utf-8")).decode(
+            "utf-8")
 
     @abstractmethod
     def execute_query(
@@ -119,3 +364,12 @@ class Approach(ABC):
             The result of the query.
         """
         pass
+
+    def close(self) -> None:
+        """
+        Releases the resources held by the approach between queries, e.g. its
+        worker processes or the connections of its transport. Resources are
+        created again when the approach executes its next query.
+        """
+        for resource in self._resources:
+            resource.close()
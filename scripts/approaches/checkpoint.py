@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import time
+
+from typing import Any, Dict, Optional
+
+
+class Checkpoint():
+    """
+    This class saves the state of a query on disk during its execution, so
+    that an interrupted query can be resumed from its last saved plan instead
+    of being restarted. A state holds the next link sent by the server and
+    the solutions held by the client, e.g. as a snapshot of its TOP-K. As
+    saved plans are stateless, the server does not need to keep anything.
+
+    Parameters
+    ----------
+    path: str
+        The JSON file in which the state of the query is saved.
+    interval: float - (default = 30.0)
+        The minimum time between two saves of the state (seconds).
+    """
+
+    def __init__(self, path: str, interval: float = 30.0) -> None:
+        self._path = path
+        self._interval = interval
+        self._last_save = time.monotonic()
+
+    def load(self, header: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Loads the state of a query, if it was saved.
+
+        Parameters
+        ----------
+        header: Dict[str, Any]
+            The parameters that identify the execution of the query, e.g. the
+            approach, the query and its limit. The state must have been saved
+            with the same parameters.
+
+        Returns
+        -------
+        None | Dict[str, Any]
+            The state of the query, or None if no state was saved.
+        """
+        if not os.path.exists(self._path):
+            logging.warning(f"checkpoint - {self._path} does not exist")
+            return None
+        with open(self._path, "r") as checkpointfile:
+            state = json.load(checkpointfile)
+        for key, value in header.items():
+            if state.get(key) != value:
+                raise Exception((
+                    f"The checkpoint {self._path} was saved for another "
+                    f"execution ({key} differs)..."))
+        logging.info(
+            f"checkpoint - resuming after {state['quanta']} quanta")
+        return state
+
+    def due(self) -> bool:
+        """
+        Returns True if the last save is old enough to save the state again.
+        """
+        return time.monotonic() - self._last_save >= self._interval
+
+    def save(self, state: Dict[str, Any]) -> None:
+        """
+        Saves the state of a query. The file is replaced atomically, so an
+        interruption while saving does not corrupt the previous state.
+
+        Parameters
+        ----------
+        state: Dict[str, Any]
+            The state of the query, with the parameters of its header.
+        """
+        temporary = f"{self._path}.tmp"
+        with open(temporary, "w") as checkpointfile:
+            json.dump(state, checkpointfile)
+        os.replace(temporary, self._path)
+        self._last_save = time.monotonic()
+
+    def clear(self) -> None:
+        """
+        Removes the state of the query once it is completed.
+        """
+        if os.path.exists(self._path):
+            os.remove(self._path)
@@ -4,6 +4,7 @@ from approaches.approach import Approach
 from approaches.sage import SaGe
 from approaches.sage_topk import SaGeTopK
 from approaches.sage_partial_topk import SaGePartialTopK
+from approaches.sage_partitioned_topk import SaGePartitionedTopK
 from approaches.virtuoso import Virtuoso
 
 
@@ -15,16 +16,19 @@ class ApproachFactory():
             "sage",
             "sage-topk",
             "sage-partial-topk",
+            "sage-partitioned-topk",
             "virtuoso"]
 
     @staticmethod
-    def create(approach: str, config: Dict[str, str]) -> Approach:
+    def create(approach: str, config: Dict[str, str], **kwargs) -> Approach:
         if approach == "sage":
-            return SaGe(approach, config)
+            return SaGe(approach, config, **kwargs)
         elif approach == "sage-topk":
-            return SaGeTopK(approach, config)
+            return SaGeTopK(approach, config, **kwargs)
         elif approach == "sage-partial-topk":
-            return SaGePartialTopK(approach, config)
+            return SaGePartialTopK(approach, config, **kwargs)
+        elif approach == "sage-partitioned-topk":
+            return SaGePartitionedTopK(approach, config, **kwargs)
         elif approach == "virtuoso":
-            return Virtuoso(approach, config)
+            return Virtuoso(approach, config, **kwargs)
         raise Exception(f"The approach named {approach} does not exist...")
@@ -1,27 +1,66 @@
-import requests
 import json
 import time
-import sys
 import logging
+import multiprocessing
 
-from typing import Dict, Any, List
+from multiprocessing.pool import Pool
+from typing import Dict, Any, List, Optional, Tuple
+from base64 import b64decode, b64encode
 from rdflib.plugins.sparql.parser import parseQuery
-from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.plugins.sparql.algebra import translateQuery, traverse
 from rdflib.plugins.sparql.sparql import Bindings, QueryContext
 from rdflib.plugins.sparql.parserutils import Expr
 from rdflib.term import Identifier, Variable, URIRef
 from rdflib.util import from_n3
 
 from approaches.approach import Approach
-from approaches.topk_struct import TOPKStruct
+from approaches.transport import create_transport
+from approaches.topk_struct import Schema, Snapshot, Solution, TOPKStruct
 from spy import Spy
 
 
+# the TOP-K operators used to evaluate ORDER BY keys in a worker process, per
+# query, so that each query is only parsed once per worker
+_evaluators = dict()
+
+
+def evaluate_keys(
+    task: Tuple[str, List[str], List[Tuple[Optional[str], ...]]]
+) -> List[Tuple[Any, ...]]:
+    """
+    Evaluates the ORDER BY keys of a batch of solutions in a worker process.
+
+    Parameters
+    ----------
+    task: Tuple[str, List[str], List[Tuple[None | str, ...]]]
+        The SPARQL TOP-K query, the variables of its ORDER BY clause, and the
+        values of these variables in each solution of the batch (None if a
+        variable is not bound).
+
+    Returns
+    -------
+    List[Tuple[Any, ...]]
+        The ORDER BY keys of the solutions, in the order of the batch.
+    """
+    query, variables, rows = task
+    if query not in _evaluators:
+        _evaluators[query] = TOPKOperator(query)
+    evaluator = _evaluators[query]
+    return [
+        evaluator.__key__({
+            variable: value
+            for variable, value in zip(variables, row) if value is not None})
+        for row in rows]
+
+
 class TOPKOperator():
     """
     This class implements a data structure that allows to maitain a
     multiple-keys order between the solutions mappings. It is used to compute
     the TOP-K on the client. This is the baseline in our experimental study.
+    Solutions are stored as compact records, i.e. the values of their ORDER BY
+    keys and the values of their variables, aligned to a shared schema. They
+    are converted back to solutions mappings only by `flatten`.
 
     Parameters
     ----------
@@ -29,18 +68,58 @@ class TOPKOperator():
         The SPARQL TOP-K query for which we want to compute the TOP-K.
     limit: int
         The size of the TOP-K.
+    layout: str - (default = "nested")
+        The layout of the TOP-K data structure, "nested" for one level per
+        ORDER BY key, or "flat" for a single level of composite keys.
+    start: None | Dict[str, str] - (default = None)
+        The last solution of the previous page, as sent by the server. If
+        defined, the solutions ordered before it are not inserted, i.e. the
+        TOP-K is computed after it.
     """
 
-    def __init__(self, query: str, limit: int = 10):
+    def __init__(
+        self, query: str, limit: int = 10, layout: str = "nested",
+        start: Optional[Dict[str, str]] = None
+    ):
+        self._query = query
         self._exprs = translateQuery(parseQuery(query)).algebra.p.p.p.expr
         keys = []
+        self._variables = []
         for index, order_condition in enumerate(self._exprs):
             if order_condition.order is None or order_condition.order == "ASC":
                 order = "ASC"
             else:
                 order = "DESC"
             keys.append((f"__order_condition_{index}", order))
-        self._topk = TOPKStruct(keys, limit=limit)
+            self._variables.append((self.__variable__(order_condition), order))
+        self._topk = TOPKStruct(keys, limit=limit, layout=layout)
+        self._schema = Schema()
+        self._start = None if start is None else self.__key__(start)
+        # keys are only worth evaluating in worker processes for expressions
+        self._expressions = any(
+            variable is None for variable, _ in self._variables)
+        self._needed = self.__needed_variables__()
+
+    def __needed_variables__(self) -> List[str]:
+        """
+        Returns the variables used by the ORDER BY clause, i.e. the values of
+        the solutions sent to the worker processes that evaluate the keys.
+        """
+        variables = set()
+        for order_condition in self._exprs:
+            traverse(order_condition.expr, visitPost=lambda expr: (
+                variables.add(expr.n3()) if isinstance(expr, Variable)
+                else None))
+        return sorted(variables)
+
+    def __variable__(self, order_condition: Expr) -> Optional[str]:
+        """
+        Returns the variable of an ORDER BY condition, or None if the
+        condition is an expression.
+        """
+        if isinstance(order_condition.expr, Variable):
+            return order_condition.expr.n3()
+        return None
 
     def __to_rdflib_term__(self, value: str) -> Identifier:
         """
@@ -91,6 +170,14 @@ class TOPKOperator():
         context = QueryContext(bindings=Bindings(d=rdflib_mappings))
         return expr.eval(context)
 
+    def __key__(self, mappings: Dict[str, str]) -> Tuple[Any, ...]:
+        """
+        Evaluates the ORDER BY keys of a solution mappings.
+        """
+        return tuple(
+            self.__eval_rdflib_expr__(order_condition.expr, mappings)
+            for order_condition in self._exprs)
+
     def insert(self, mappings: Dict[str, str]) -> None:
         """
         Inserts a solution mappings in the TOP-K data structure.
@@ -100,26 +187,178 @@ class TOPKOperator():
         mappings: Dict[str, str]
             A solution mappings.
         """
-        for index, order_condition in enumerate(self._exprs):
-            mappings[f"__order_condition_{index}"] = self.__eval_rdflib_expr__(
-                order_condition.expr, mappings)
-        self._topk.insert(mappings)
+        self.__insert__(self.__key__(mappings), mappings)
 
-    def flatten(self) -> List[Dict[str, str]]:
+    def __insert__(
+        self, key: Tuple[Any, ...], mappings: Dict[str, str]
+    ) -> None:
+        """
+        Inserts a solution mappings, whose ORDER BY keys are evaluated, in the
+        TOP-K data structure.
+        """
+        if self._start is not None and self._topk.compare(
+            key, self._start
+        ) < 0:
+            return
+        if self._topk.can_insert(key):
+            self._topk.push(Solution(key, self._schema.encode(mappings)))
+
+    def insert_page(
+        self, page: List[Dict[str, str]], pool: Optional[Pool] = None,
+        batch: int = 512
+    ) -> None:
+        """
+        Inserts the solutions of a quantum in the TOP-K data structure. If a
+        pool of worker processes is given, and if the ORDER BY clause has
+        expressions, the keys of pages of at least `batch` solutions are
+        evaluated by the workers, by batches of `batch` solutions that only
+        hold the variables of the ORDER BY clause, while this process inserts
+        the solutions of the batches already evaluated. Smaller pages are
+        evaluated in this process, as sending them would cost more than
+        evaluating them.
+
+        Parameters
+        ----------
+        page: List[Dict[str, str]]
+            The solutions mappings sent by the server in a quantum.
+        pool: None | Pool - (default = None)
+            The worker processes used to evaluate the ORDER BY keys.
+        batch: int - (default = 512)
+            The number of solutions evaluated per task of the workers, and
+            the minimum size of a page evaluated by the workers.
+        """
+        if pool is None or not self._expressions or len(page) < batch:
+            for mappings in page:
+                self.insert(mappings)
+            return
+        tasks = [
+            (self._query, self._needed, [
+                tuple(mappings.get(variable) for variable in self._needed)
+                for mappings in page[start:start + batch]])
+            for start in range(0, len(page), batch)]
+        index = 0
+        for keys in pool.imap(evaluate_keys, tasks):
+            for key in keys:
+                self.__insert__(key, page[index])
+                index += 1
+
+    def can_change(self, sorted_access: Dict[str, Any]) -> bool:
+        """
+        Returns False if the TOP-K cannot change anymore because the server
+        produces solutions sorted on some variables, i.e. if the TOP-K is full
+        and the next solutions cannot be ordered before its lowest solution.
+
+        Parameters
+        ----------
+        sorted_access: Dict[str, Any]
+            The variables on which the solutions are sorted, with their order
+            ("ASC" or "DESC"), and their values in the last solution scanned
+            by the server, as reported by the server.
+
+        Returns
+        -------
+        bool
+            False if the TOP-K cannot change anymore, True otherwise.
+        """
+        key = []
+        for variable, (name, order) in zip(
+            self._variables, sorted_access["variables"]
+        ):
+            if variable != (name, order):
+                break
+            key.append(sorted_access["last"][name])
+        if len(key) == 0:
+            return True
+        return self._topk.can_change(key, len(key))
+
+    def __len__(self) -> int:
+        return len(self._topk)
+
+    def solutions(self) -> List[Solution]:
+        """
+        Returns the records held by the TOP-K, without removing them from the
+        TOP-K.
+
+        Returns
+        -------
+        List[Solution]
+            A list of records.
+        """
+        return self._topk.flatten()
+
+    def last(self) -> Optional[Tuple[Dict[str, str], int]]:
+        """
+        Returns the last solution of the TOP-K, as sent by the server, and
+        the number of solutions of the TOP-K that share its ORDER BY key.
+
+        Returns
+        -------
+        None | Tuple[Dict[str, str], int]
+            The last solution and its number of ties, or None if the TOP-K is
+            empty.
+        """
+        if len(self._topk) == 0:
+            return None
+        solutions = self._topk.flatten()
+        last = solutions[-1]
+        ties = 0
+        for solution in reversed(solutions):
+            if solution.key != last.key:
+                break
+            ties += 1
+        return self._schema.decode(last.values), ties
+
+    def snapshot(self) -> bytes:
+        """
+        Returns a binary snapshot of the TOP-K. ORDER BY keys are evaluated by
+        the client, so they are not stored, but evaluated again when the
+        snapshot is restored.
+
+        Returns
+        -------
+        bytes
+            The snapshot of the TOP-K.
+        """
+        return self._topk.snapshot(
+            variables=self._schema.variables, keys=False)
+
+    def restore(self, snapshot: bytes) -> None:
+        """
+        Inserts the solutions of a snapshot in the TOP-K. Restoring several
+        snapshots of the same query merges them.
+
+        Parameters
+        ----------
+        snapshot: bytes
+            A snapshot of a TOP-K of the same query.
+        """
+        variables, solutions = Snapshot.unpack(snapshot)
+        positions = self._schema.align(variables)
+        for solution in solutions:
+            values = solution.values
+            if positions is not None:
+                values = self._schema.remap(values, positions)
+            key = self.__key__(self._schema.decode(values))
+            self._topk.insert(Solution(key, values))
+
+    def flatten(self, offset: int = 0) -> List[Dict[str, str]]:
         """
         Returns the TOP-K as an ordered list of solutions mappings.
 
         Parameters
         ----------
+        offset: int - (default = 0)
+            The number of solutions to skip at the beginning of the TOP-K.
+
+        Returns
+        -------
         List[Dict[str, str]]
             A list of solutions mappings.
         """
-        solutions = list()
-        for mappings in self._topk.flatten():
-            for index in range(len(self._exprs)):
-                del mappings[f"__order_condition_{index}"]
-            solutions.append(mappings)
-        return solutions
+        decode = self._schema.decode
+        return [
+            decode(solution.values)
+            for solution in self._topk.flatten(offset=offset)]
 
 
 class SaGe(Approach):
@@ -137,12 +376,76 @@ class SaGe(Approach):
     config: Dict[str, Any]
         The configuration file of the experimental study. It is used to
         retrieve the URL of the endpoint and the name of the RDF graph.
+    transport: None | Transport - (default = None)
+        The transport used to send requests to the server. By default,
+        requests are sent over HTTP, and spread over the replicas of the
+        endpoint, if any.
     """
 
     def __init__(self, name: str, config: Dict[str, Any], **kwargs):
         super().__init__(name)
         self._endpoint = config["endpoints"]["sage"]["url"]
         self._graph = config["endpoints"]["sage"]["graph"]
+        self._transport = kwargs.get("transport")
+        if self._transport is None:
+            self._transport = create_transport(
+                self._endpoint,
+                replicas=config["endpoints"]["sage"].get("replicas"),
+                balancing=config["endpoints"]["sage"].get(
+                    "balancing", "round-robin"))
+            self._resources.append(self._transport)
+        self._pool = None
+        self._workers = 0
+
+    def __pool__(self, workers: int) -> Optional[Pool]:
+        """
+        Returns the pool of worker processes used to evaluate ORDER BY keys,
+        created once and reused by the next queries until the approach is
+        closed. Worker processes, e.g. of a benchmark, cannot have their own
+        workers, so keys are evaluated in process.
+
+        Parameters
+        ----------
+        workers: int
+            The number of worker processes, 0 to evaluate keys in process.
+
+        Returns
+        -------
+        None | Pool
+            The pool of worker processes, or None if keys are evaluated in
+            process.
+        """
+        if workers == 0:
+            return None
+        if multiprocessing.current_process().daemon:
+            logging.warning((
+                f"{self.name} - a worker process cannot start evaluation "
+                "workers, keys are evaluated in process"))
+            return None
+        if self._pool is None or self._workers != workers:
+            self.__close_pool__()
+            self._pool = Pool(workers)
+            self._workers = workers
+        return self._pool
+
+    def __close_pool__(self) -> None:
+        """
+        Stops the pool of worker processes used to evaluate ORDER BY keys, if
+        any.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._workers = 0
+
+    def close(self) -> None:
+        """
+        Stops the pool of worker processes used to evaluate ORDER BY keys, if
+        any, and closes the transport created by the approach.
+        """
+        super().close()
+        self.__close_pool__()
 
     def __remove_topk__(self, query: str) -> str:
         """
@@ -184,25 +487,57 @@ class SaGe(Approach):
         early_pruning = kwargs.setdefault("early_pruning", False)
         stateless = kwargs.setdefault("stateless", True)
         max_limit = kwargs.setdefault("max_limit", None)
-
+        layout = kwargs.setdefault("layout", "nested")
+        offset = kwargs.setdefault("offset", None)
+        continuation = kwargs.setdefault("continuation", None)
+        checkpoint = kwargs.setdefault("checkpoint", None)
+        resume = kwargs.setdefault("resume", False)
+        eval_workers = kwargs.setdefault("eval_workers", 0)
+        eval_batch = kwargs.setdefault("eval_batch", 512)
+
+        if not stateless and self._transport.replicas > 1:
+            raise Exception((
+                "Saved plans stored by a server cannot be resumed by its "
+                "replicas, queries must be stateless..."))
         if limit == 0:
             limit = self.__extract_limit__(query)
-        topk = TOPKOperator(query, limit=limit)  # client-side top-k operator
+        if offset is None:
+            offset = self.__extract_offset__(query)
+        # only the solutions after the previous page are kept by the client
+        position, after, skip = self.__resume_page__(continuation, offset)
+        # client-side top-k operator
+        topk = TOPKOperator(
+            query, limit=skip + limit, layout=layout, start=after)
+
+        # an interrupted execution is resumed from the state saved in its
+        # checkpoint, if any
+        header = {
+            "approach": self.name, "query": query, "limit": limit,
+            "position": position}
+        state = None
+        if checkpoint is not None and resume:
+            state = checkpoint.load(header)
 
         orderby_variables = self.__get_orderby_variables__(query)
+        # the order of the scan, if the server follows the join order
+        scan_order = self.__scan_order__(query) if force_order else []
 
         query = self.__set_projection__(query, ['*'])
         query = self.__remove_topk__(query)  # top-k is computed by the client
 
         logging.info(f"{self.name} - query sent to the server:\n{query}")
         logging.info(f"{self.name} - limit = {limit} (max={max_limit})")
+        logging.info(f"{self.name} - offset = {position} (skip={skip})")
         logging.info(f"{self.name} - quota = {quota} (ms)")
         logging.info(f"{self.name} - stateless = {stateless}")
         logging.info(f"{self.name} - early-pruning = {early_pruning}")
+        logging.info(f"{self.name} - layout = {layout}")
+        logging.info((
+            f"{self.name} - evaluation workers = {eval_workers} "
+            f"(batch={eval_batch})"))
+
+        pool = self.__pool__(eval_workers)
 
-        headers = {
-            "accept": "text/html",
-            "content-type": "application/json"}
         payload = {
             "query": query,
             "defaultGraph": self._graph,
@@ -213,43 +548,84 @@ class SaGe(Approach):
             "stateless": stateless,
             "maxLimit": max_limit}
 
+        quanta = 0
+        if state is not None:
+            payload["next"] = state["next"]
+            quanta = state["quanta"]
+            with spy.measure("topk_time"):
+                topk.restore(b64decode(state["snapshot"]))
+
         has_next = True
 
-        start = time.time()
+        start = time.perf_counter()
+        start_cpu = time.process_time()
 
         while has_next:
-            data = json.dumps(payload)
-            response = requests.post(
-                self._endpoint, headers=headers, data=data).json()
+            with spy.measure("encode_time"):
+                data = json.dumps(payload)
+            with spy.measure("http_time"):
+                body = self._transport.post(data)
+            with spy.measure("decode_time"):
+                response = json.loads(body)
 
             payload["next"] = response["next"]
             has_next = response["next"] is not None
 
-            for solution in response["bindings"]:
-                topk.insert(solution)
+            with spy.measure("topk_time"):
+                topk.insert_page(
+                    response["bindings"], pool=pool, batch=eval_batch)
+                # stops once the next solutions cannot change the TOP-K,
+                # if the server reports its sorted access paths, i.e.
+                # only the stand-in, or if the scan is sorted
+                sorted_access = self.__sorted_access__(scan_order, response)
+                if has_next and sorted_access is not None and (
+                    not topk.can_change(sorted_access)
+                ):
+                    has_next = False
+                    spy.report_early_termination(
+                        sorted_access.get("remaining"),
+                        response["stats"].get("scanned"))
 
             spy.report_http_calls(1)
-            spy.report_data_transfer(sys.getsizeof(data))
-            spy.report_data_transfer(sys.getsizeof(json.dumps(response)))
+            spy.report_data_transfer(len(data.encode("utf-8")) + len(body))
             spy.report_loading_time(response["stats"]["resuming_time"])
             spy.report_saving_time(response["stats"]["saving_time"])
 
-        results = topk.flatten()
+            quanta += 1
+            if has_next and checkpoint is not None and checkpoint.due():
+                with spy.measure("checkpoint_time"):
+                    checkpoint.save({
+                        **header, "next": payload["next"], "quanta": quanta,
+                        "snapshot": b64encode(topk.snapshot()).decode(
+                            "utf-8")})
+
+        if checkpoint is not None:  # the query is completed
+            checkpoint.clear()
+
+        if spy.tracks_memory:  # estimating the size of solutions is costly
+            spy.report_topk_memory(topk.solutions())
+
+        with spy.measure("topk_time"):
+            results = topk.flatten(offset=skip)
+            spy.report_continuation(self.__next_page__(
+                position, len(results), limit, last=topk.last()))
 
-        elapsed_time = (time.time() - start) * 1000
+        elapsed_time = (time.perf_counter() - start) * 1000
 
         spy.report_execution_time(elapsed_time)
+        spy.report_cpu_time((time.process_time() - start_cpu) * 1000)
         spy.report_solutions(len(results))
 
-        solutions = []  # solutions are formated to make the validation easier
-        for mappings in results:
-            solution = {}
-            for key, value in mappings.items():
-                if key in orderby_variables:  # to make the validation easier
-                    if value.startswith('"') and value.endswith('"'):
-                        solution[key] = value[1:-1]
-                    else:
-                        solution[key] = value
-            solutions.append(solution)
+        with spy.measure("formatting_time"):
+            solutions = []  # solutions are formated to ease the validation
+            for mappings in results:
+                solution = {}
+                for key, value in mappings.items():
+                    if key in orderby_variables:  # to ease the validation
+                        if value.startswith('"') and value.endswith('"'):
+                            solution[key] = value[1:-1]
+                        else:
+                            solution[key] = value
+                solutions.append(solution)
 
         return solutions
@@ -1,16 +1,19 @@
-import requests
 import json
 import time
-import sys
 import logging
 
-from typing import Dict, Any, List
+from itertools import islice
+from typing import Dict, Any, List, Optional, Tuple
 from base64 import b64decode, b64encode
 from rdflib.plugins.sparql.parser import parseQuery
 from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.plugins.sparql.parserutils import Expr
+from rdflib.term import Variable
 
 from approaches.approach import Approach
-from approaches.topk_struct import TOPKStruct
+from approaches.transport import create_transport
+from approaches.threshold_cache import ThresholdCache
+from approaches.topk_struct import Schema, Snapshot, Solution, TOPKStruct
 from approaches.iterators_pb2 import RootTree
 from spy import Spy
 
@@ -19,7 +22,9 @@ class TOPKOperator():
     """
     This class implements a data structure that allows to maitain a
     multiple-keys order between the solutions mappings. It is used to compute
-    the TOP-K on the client.
+    the TOP-K on the client. Solutions are stored as compact records, i.e. the
+    values of their ORDER BY keys, as computed by the server, and the values of
+    their variables, aligned to a shared schema.
 
     Parameters
     ----------
@@ -27,19 +32,55 @@ class TOPKOperator():
         The SPARQL TOP-K query for which we want to compute the TOP-K.
     limit: int
         The size of the TOP-K.
+    layout: str - (default = "nested")
+        The layout of the TOP-K data structure, "nested" for one level per
+        ORDER BY key, or "flat" for a single level of composite keys.
+    start: None | Dict[str, str] - (default = None)
+        The last solution of the previous page, as sent by the server. If
+        defined, the solutions ordered before it are not inserted, i.e. the
+        TOP-K is computed after it.
+    seed: None | Dict[str, str] - (default = None)
+        A solution, as sent by the server, that is strictly ordered after the
+        last solution of the TOP-K. If defined, it is used as threshold until
+        the TOP-K holds a better one, and the solutions that leave the TOP-K
+        are tracked to compute the seed of the next executions.
     """
 
-    def __init__(self, query: str, limit: int = 10):
+    def __init__(
+        self, query: str, limit: int = 10, layout: str = "nested",
+        start: Optional[Dict[str, str]] = None,
+        seed: Optional[Dict[str, str]] = None, seeding: bool = False
+    ):
         self._exprs = translateQuery(parseQuery(query)).algebra.p.p.p.expr
         self._limit = limit
         self._keys = []
+        self._variables = []
         for index, order_condition in enumerate(self._exprs):
             if order_condition.order is None or order_condition.order == "ASC":
                 order = "ASC"
             else:
                 order = "DESC"
             self._keys.append((f"__order_condition_{index}", order))
-        self._topk = TOPKStruct(self._keys, limit=limit)
+            self._variables.append((self.__variable__(order_condition), order))
+        self._names = [name for name, _ in self._keys]
+        self._topk = TOPKStruct(self._keys, limit=limit, layout=layout)
+        self._schema = Schema(excluded=self._names)
+        self._start = None
+        if start is not None:
+            self._start = tuple(start[name] for name in self._names)
+        self._seed = seed
+        self._seeding = seeding or seed is not None
+        # the two best distinct keys of the solutions that left the TOP-K
+        self._left = []
+
+    def __variable__(self, order_condition: Expr) -> Optional[str]:
+        """
+        Returns the variable of an ORDER BY condition, or None if the
+        condition is an expression.
+        """
+        if isinstance(order_condition.expr, Variable):
+            return order_condition.expr.n3()
+        return None
 
     @property
     def key(self) -> List[str]:
@@ -54,7 +95,161 @@ class TOPKOperator():
         mappings: Dict[str, str]
             A solution mappings.
         """
-        self._topk.insert(mappings)
+        key = self.__key__(mappings)
+        if self._start is not None and self._topk.compare(
+            key, self._start
+        ) < 0:
+            return
+        if not self.__insert__(key, mappings) and self._seeding:
+            self.__leave__(Solution(key, None), mappings)
+
+    def __insert__(
+        self, key: Tuple[str, ...], mappings: Dict[str, str]
+    ) -> bool:
+        """
+        Inserts a solution mappings in the TOP-K data structure, if it can
+        enter the TOP-K, and returns True if it was inserted.
+        """
+        if not self._topk.can_insert(key):
+            return False
+        if self._seeding and len(self._topk) == self._limit:
+            self.__leave__(self._topk.lower_bound())
+        self._topk.push(Solution(key, self._schema.encode(mappings)))
+        return True
+
+    def insert_page(self, page: List[Dict[str, str]]) -> None:
+        """
+        Inserts the solutions of a quantum in the TOP-K data structure. The
+        partial_topk iterator of the server sends its partial TOP-K, i.e. the
+        solutions of a page are sorted, so the insertion stops at the first
+        solution that cannot enter the TOP-K, as the next ones cannot either.
+        Only the first and the last solutions of the page are compared to
+        check this order, and the solutions of a page whose last solution is
+        ordered before its first one are inserted one at a time.
+
+        Parameters
+        ----------
+        page: List[Dict[str, str]]
+            The solutions mappings sent by the server in a quantum.
+        """
+        if len(page) == 0:
+            return
+        compare = self._topk.compare
+        if compare(self.__key__(page[0]), self.__key__(page[-1])) > 0:
+            for mappings in page:
+                self.insert(mappings)
+            return
+        for index, mappings in enumerate(page):
+            key = self.__key__(mappings)
+            if self._start is not None and compare(key, self._start) < 0:
+                continue
+            if not self.__insert__(key, mappings):
+                break
+        else:
+            return
+        if self._seeding:  # tracks the two best distinct rejected keys
+            for mappings in page[index:]:
+                rejected = self.__key__(mappings)
+                self.__leave__(Solution(rejected, None), mappings)
+                if compare(rejected, key) != 0:
+                    break
+
+    def __leave__(
+        self, solution: Solution, mappings: Optional[Dict[str, str]] = None
+    ) -> None:
+        """
+        Tracks a solution that is evicted from the TOP-K, or that cannot be
+        inserted in it. Only the two best distinct keys are kept, as the best
+        one can be tied with the last solution of the TOP-K.
+        """
+        compare = self._topk.compare
+        for index, (key, _) in enumerate(self._left):
+            order = compare(solution.key, key)
+            if order == 0:
+                return
+            elif order < 0:
+                break
+        else:
+            index = len(self._left)
+            if index == 2:
+                return
+        if mappings is not None:  # only encoded when it is kept
+            solution = Solution(solution.key, self._schema.encode(mappings))
+        self._left.insert(index, (solution.key, solution))
+        del self._left[2:]
+
+    def next_seed(self) -> Optional[Dict[str, str]]:
+        """
+        Returns a solution, as sent by the server, that is strictly ordered
+        after the last solution of the TOP-K, i.e. a valid seed to compute
+        this TOP-K again.
+
+        Returns
+        -------
+        None | Dict[str, str]
+            The seed, or None if the TOP-K is not full or if no solution
+            ordered after its last solution was received.
+        """
+        if len(self._topk) < self._limit:
+            return None
+        last = self._topk.lower_bound().key
+        for key, solution in self._left:
+            if self._topk.compare(key, last) > 0:
+                return self.__to_mappings__(solution)
+        return None
+
+    def __key__(self, mappings: Dict[str, str]) -> Tuple[str, ...]:
+        """
+        Returns the ORDER BY key of a solution, as computed by the server.
+        """
+        return tuple(mappings[name] for name in self._names)
+
+    def __to_mappings__(self, solution: Solution) -> Dict[str, str]:
+        """
+        Converts a record back into a solution mappings, with its ORDER BY
+        keys, as sent by the server.
+        """
+        mappings = self._schema.decode(solution.values)
+        mappings.update(zip(self._names, solution.key))
+        return mappings
+
+    def threshold(self) -> Optional[Dict[str, str]]:
+        """
+        Returns the threshold of the TOP-K, i.e. the tightest of its lowest
+        solution, once it holds k solutions, and of its seed.
+
+        Returns
+        -------
+        None | Dict[str, str]
+            The threshold, as sent by the server, or None if it is not
+            defined yet.
+        """
+        threshold = self._seed
+        if len(self._topk) == self._limit:
+            lower_bound = self._topk.lower_bound()
+            if threshold is None or self._topk.compare(
+                lower_bound.key, self.__key__(threshold)
+            ) <= 0:
+                # the threshold is sent as the server sent it, i.e. with all
+                # variables
+                threshold = self.__to_mappings__(lower_bound)
+        return threshold
+
+    def tighten(self, threshold: Dict[str, str]) -> None:
+        """
+        Uses the threshold of another TOP-K of the same query as seed, if it
+        is tighter than the current seed. As the TOP-K of each partition of a
+        query holds k solutions, its threshold is valid for all partitions.
+
+        Parameters
+        ----------
+        threshold: Dict[str, str]
+            The threshold of another TOP-K, as sent by the server.
+        """
+        if self._seed is None or self._topk.compare(
+            self.__key__(threshold), self.__key__(self._seed)
+        ) < 0:
+            self._seed = threshold
 
     def update_threshold(self, saved_plan: str) -> str:
         """
@@ -66,11 +261,10 @@ class TOPKOperator():
         saved_plan: str
             The saved plan of the query received by the server.
         """
-        if len(self._topk) < self._limit:  # the threshold is not defined
+        threshold = self.threshold()
+        if threshold is None:  # the threshold is not defined
             return saved_plan
 
-        threshold = self._topk.lower_bound()
-
         root = RootTree()
         root.ParseFromString(b64decode(saved_plan))
 
@@ -82,21 +276,148 @@ class TOPKOperator():
 
         return b64encode(root.SerializeToString()).decode("utf-8")
 
-    def flatten(self) -> List[Dict[str, str]]:
+    def can_change(self, sorted_access: Dict[str, Any]) -> bool:
+        """
+        Returns False if the TOP-K cannot change anymore because the server
+        produces solutions sorted on some variables, i.e. if the TOP-K is full
+        and the next solutions cannot be ordered before its lowest solution.
+
+        Parameters
+        ----------
+        sorted_access: Dict[str, Any]
+            The variables on which the solutions are sorted, with their order
+            ("ASC" or "DESC"), and their values in the last solution scanned
+            by the server, as reported by the server.
+
+        Returns
+        -------
+        bool
+            False if the TOP-K cannot change anymore, True otherwise.
+        """
+        key = []
+        for variable, (name, order) in zip(
+            self._variables, sorted_access["variables"]
+        ):
+            if variable != (name, order):
+                break
+            key.append(sorted_access["last"][name])
+        if len(key) == 0:
+            return True
+        return self._topk.can_change(key, len(key))
+
+    def __len__(self) -> int:
+        return len(self._topk)
+
+    def solutions(self) -> List[Solution]:
+        """
+        Returns the records held by the TOP-K, without removing them from the
+        TOP-K.
+
+        Returns
+        -------
+        List[Solution]
+            A list of records.
+        """
+        return self._topk.flatten()
+
+    def last(self) -> Optional[Tuple[Dict[str, str], int]]:
+        """
+        Returns the last solution of the TOP-K, as sent by the server, and
+        the number of solutions of the TOP-K that share its ORDER BY key.
+
+        Returns
+        -------
+        None | Tuple[Dict[str, str], int]
+            The last solution and its number of ties, or None if the TOP-K is
+            empty.
+        """
+        if len(self._topk) == 0:
+            return None
+        solutions = self._topk.flatten()
+        last = solutions[-1]
+        ties = 0
+        for solution in reversed(solutions):
+            if solution.key != last.key:
+                break
+            ties += 1
+        return self.__to_mappings__(last), ties
+
+    def snapshot(self) -> bytes:
+        """
+        Returns a binary snapshot of the TOP-K, i.e. the ORDER BY keys of its
+        solutions, as computed by the server, and their values.
+
+        Returns
+        -------
+        bytes
+            The snapshot of the TOP-K.
+        """
+        return self._topk.snapshot(variables=self._schema.variables)
+
+    def restore(self, snapshot: bytes) -> None:
+        """
+        Inserts the solutions of a snapshot in the TOP-K. Restoring several
+        snapshots of the same query merges them, e.g. the TOP-K of its
+        partitions.
+
+        Parameters
+        ----------
+        snapshot: bytes
+            A snapshot of a TOP-K of the same query.
+        """
+        variables, solutions = Snapshot.unpack(snapshot)
+        positions = self._schema.align(variables)
+        for solution in solutions:
+            if positions is not None:
+                solution.values = self._schema.remap(
+                    solution.values, positions)
+            self._topk.insert(solution)
+
+    def flatten(self, offset: int = 0) -> List[Dict[str, str]]:
         """
         Returns the TOP-K as an ordered list of solutions mappings.
 
         Parameters
         ----------
+        offset: int - (default = 0)
+            The number of solutions to skip at the beginning of the TOP-K.
+
+        Returns
+        -------
         List[Dict[str, str]]
             A list of solutions mappings.
         """
-        solutions = list()
-        for mappings in self._topk.flatten():
-            for key, _ in self._keys:
-                del mappings[key]
-            solutions.append(mappings)
-        return solutions
+        decode = self._schema.decode
+        return [
+            decode(solution.values)
+            for solution in self._topk.flatten(offset=offset)]
+
+    def merge(
+        self, others: List["TOPKOperator"], limit: int, offset: int = 0
+    ) -> List[Dict[str, str]]:
+        """
+        Merges the TOP-K with the TOP-K of other partitions of the same query,
+        with a k-way merge of their ordered solutions.
+
+        Parameters
+        ----------
+        others: List[TOPKOperator]
+            The TOP-K of the other partitions of the query.
+        limit: int
+            The number of solutions to return.
+        offset: int - (default = 0)
+            The number of solutions to skip at the beginning of the merge.
+
+        Returns
+        -------
+        List[Dict[str, str]]
+            The first solutions mappings of the merge.
+        """
+        operators = [self, *others]
+        merged = self._topk.merged(*[operator._topk for operator in others])
+        return [
+            operators[index]._schema.decode(solution.values)
+            for index, solution in islice(merged, offset, offset + limit)]
 
 
 class SaGePartialTopK(Approach):
@@ -109,7 +430,9 @@ class SaGePartialTopK(Approach):
     is completed. To improve performance, the client also sends the lowest
     solution in the TOP-K to the server. Thus, the server can use this
     information to perform early pruning and to avoid transferring useless
-    solutions to the client.
+    solutions to the client. As the lowest solution is only defined once the
+    client holds k solutions, the threshold can also be seeded from previous
+    executions of the query, to prune solutions from the first quanta.
 
     Parameters
     ----------
@@ -119,12 +442,28 @@ class SaGePartialTopK(Approach):
     config: Dict[str, Any]
         The configuration file of the experimental study. It is used to
         retrieve the URL of the endpoint and the name of the RDF graph.
+    transport: None | Transport - (default = None)
+        The transport used to send requests to the server. By default,
+        requests are sent over HTTP, and spread over the replicas of the
+        endpoint, if any.
+    seeds: None | str - (default = None)
+        The JSON file in which the thresholds used to seed queries are
+        persisted. By default, they are only kept in memory.
     """
 
     def __init__(self, name: str, config: Dict[str, Any], **kwargs):
         super(SaGePartialTopK, self).__init__(name)
         self._endpoint = config["endpoints"]["sage"]["url"]
         self._graph = config["endpoints"]["sage"]["graph"]
+        self._transport = kwargs.get("transport")
+        if self._transport is None:
+            self._transport = create_transport(
+                self._endpoint,
+                replicas=config["endpoints"]["sage"].get("replicas"),
+                balancing=config["endpoints"]["sage"].get(
+                    "balancing", "round-robin"))
+            self._resources.append(self._transport)
+        self._seeds = ThresholdCache(kwargs.get("seeds"))
 
     def execute_query(
         self, query: str, spy: Spy, **kwargs
@@ -150,25 +489,66 @@ class SaGePartialTopK(Approach):
         early_pruning = kwargs.setdefault("early_pruning", False)
         stateless = kwargs.setdefault("stateless", True)
         max_limit = kwargs.setdefault("max_limit", None)
-
+        layout = kwargs.setdefault("layout", "nested")
+        offset = kwargs.setdefault("offset", None)
+        continuation = kwargs.setdefault("continuation", None)
+        checkpoint = kwargs.setdefault("checkpoint", None)
+        resume = kwargs.setdefault("resume", False)
+        seeding = kwargs.setdefault("seeding", False)
+
+        if not stateless and self._transport.replicas > 1:
+            raise Exception((
+                "Saved plans stored by a server cannot be resumed by its "
+                "replicas, queries must be stateless..."))
         if limit == 0:
             limit = self.__extract_limit__(query)
-        topk = TOPKOperator(query, limit=limit)
+        if offset is None:
+            offset = self.__extract_offset__(query)
+        # only the solutions after the previous page are kept by the client
+        position, after, skip = self.__resume_page__(continuation, offset)
+        seed = None
+        if seeding:  # thresholds are cached for the query of the user
+            seed = self._seeds.get(self._graph, query, position + limit)
+            seeded_query = query
+        topk = TOPKOperator(
+            query, limit=skip + limit, layout=layout, start=after, seed=seed,
+            seeding=seeding)
+
+        # an interrupted execution is resumed from the state saved in its
+        # checkpoint, if any
+        header = {
+            "approach": self.name, "query": query, "limit": limit,
+            "position": position}
+        state = None
+        if checkpoint is not None and resume:
+            state = checkpoint.load(header)
 
         orderby_variables = self.__get_orderby_variables__(query)
+        # the order of the scan, if the server follows the join order
+        scan_order = self.__scan_order__(query) if force_order else []
 
         query = self.__set_projection__(query, ['*'])
-        query = self.__set_limit__(query, limit=limit)
+        # the server only sends the solutions that are not ordered before the
+        # previous page, so the solutions of the page are ranked up to skip +
+        # limit in a quantum, whatever the depth of the page. ORDER BY
+        # expressions cannot be filtered, so their solutions are ranked up to
+        # position + limit, and the client only keeps those after the page
+        keyset = self.__keyset__(query, after)
+        if keyset is not None:
+            query = self.__set_limit__(keyset, limit=skip + limit)
+        else:
+            query = self.__set_limit__(query, limit=position + limit)
 
         logging.info(f"{self.name} - query sent to the server:\n{query}")
         logging.info(f"{self.name} - limit = {limit} (max={max_limit})")
+        logging.info(f"{self.name} - offset = {position} (skip={skip})")
         logging.info(f"{self.name} - quota = {quota} (ms)")
         logging.info(f"{self.name} - stateless = {stateless}")
         logging.info(f"{self.name} - early-pruning = {early_pruning}")
+        logging.info(f"{self.name} - layout = {layout}")
+        logging.info(
+            f"{self.name} - seeding = {seeding} (seeded={seed is not None})")
 
-        headers = {
-            "accept": "text/html",
-            "content-type": "application/json"}
         payload = {
             "query": query,
             "defaultGraph": self._graph,
@@ -180,47 +560,95 @@ class SaGePartialTopK(Approach):
             "stateless": stateless,
             "maxLimit": max_limit}
 
+        quanta = 0
+        if state is not None:
+            payload["next"] = state["next"]
+            quanta = state["quanta"]
+            with spy.measure("topk_time"):
+                topk.restore(b64decode(state["snapshot"]))
+
         has_next = True
 
-        start = time.time()
+        start = time.perf_counter()
+        start_cpu = time.process_time()
 
         while has_next:
-            data = json.dumps(payload)
-            response = requests.post(
-                self._endpoint, headers=headers, data=data).json()
+            with spy.measure("encode_time"):
+                data = json.dumps(payload)
+            with spy.measure("http_time"):
+                body = self._transport.post(data)
+            with spy.measure("decode_time"):
+                response = json.loads(body)
 
             has_next = response["next"] is not None
 
             # merges the TOP-K with the client's TOP-K
-            for solution in response["bindings"]:
-                topk.insert(solution)
+            with spy.measure("topk_time"):
+                topk.insert_page(response["bindings"])
+                # stops once the next solutions cannot change the TOP-K,
+                # if the server reports its sorted access paths, i.e.
+                # only the stand-in, or if the scan is sorted
+                sorted_access = self.__sorted_access__(scan_order, response)
+                if has_next and sorted_access is not None and (
+                    not topk.can_change(sorted_access)
+                ):
+                    has_next = False
+                    spy.report_early_termination(
+                        sorted_access.get("remaining"),
+                        response["stats"].get("scanned"))
 
             # updates the threshold in the saved plan
             if has_next:
-                payload["next"] = topk.update_threshold(response["next"])
+                with spy.measure("threshold_time"):
+                    payload["next"] = topk.update_threshold(response["next"])
 
             spy.report_http_calls(1)
-            spy.report_data_transfer(sys.getsizeof(data))
-            spy.report_data_transfer(sys.getsizeof(json.dumps(response)))
+            spy.report_data_transfer(len(data.encode("utf-8")) + len(body))
             spy.report_loading_time(response["stats"]["resuming_time"])
             spy.report_saving_time(response["stats"]["saving_time"])
 
-        results = topk.flatten()
+            quanta += 1
+            if has_next and checkpoint is not None and checkpoint.due():
+                with spy.measure("checkpoint_time"):
+                    checkpoint.save({
+                        **header, "next": payload["next"], "quanta": quanta,
+                        "snapshot": b64encode(topk.snapshot()).decode(
+                            "utf-8")})
+
+        if checkpoint is not None:  # the query is completed
+            checkpoint.clear()
+
+        if seeding:  # seeds the next executions of the query
+            next_seed = topk.next_seed()
+            if next_seed is not None:
+                self._seeds.put(
+                    self._graph, seeded_query, position + limit, next_seed)
+                self._seeds.save()
+
+        if spy.tracks_memory:  # estimating the size of solutions is costly
+            spy.report_topk_memory(topk.solutions())
+
+        with spy.measure("topk_time"):
+            results = topk.flatten(offset=skip)
+            spy.report_continuation(self.__next_page__(
+                position, len(results), limit, last=topk.last()))
 
-        elapsed_time = (time.time() - start) * 1000
+        elapsed_time = (time.perf_counter() - start) * 1000
 
         spy.report_execution_time(elapsed_time)
+        spy.report_cpu_time((time.process_time() - start_cpu) * 1000)
         spy.report_solutions(len(results))
 
-        solutions = []  # solutions are formated to make the validation easier
-        for mappings in results:
-            solution = {}
-            for key, value in mappings.items():
-                if key in orderby_variables:  # to make the validation easier
-                    if value.startswith('"') and value.endswith('"'):
-                        solution[key] = value[1:-1]
-                    else:
-                        solution[key] = value
-            solutions.append(solution)
+        with spy.measure("formatting_time"):
+            solutions = []  # solutions are formated to ease the validation
+            for mappings in results:
+                solution = {}
+                for key, value in mappings.items():
+                    if key in orderby_variables:  # to ease the validation
+                        if value.startswith('"') and value.endswith('"'):
+                            solution[key] = value[1:-1]
+                        else:
+                            solution[key] = value
+                solutions.append(solution)
 
         return solutions
@@ -0,0 +1,302 @@
+import json
+import re
+import time
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple
+
+from approaches.approach import Approach
+from approaches.transport import create_transport
+from approaches.sage_partial_topk import TOPKOperator
+from spy import Spy
+
+
+class SaGePartitionedTopK(Approach):
+    """
+    This class executes SPARQL TOP-K queries as several partitions executed
+    concurrently against preemptable SPARQL endpoints that support a partial
+    TOP-K iterator. The query is split into N disjoint partitions, on the hash
+    of the subject of its first triple pattern. Each partition follows its
+    own chain of next links, as done by SaGePartialTopK, but the partitions
+    share the tightest threshold: as the TOP-K of a partition holds k
+    solutions, its lowest solution is a valid threshold for all partitions.
+    Once all partitions are completed, their TOP-K are merged with a k-way
+    merge.
+
+    Parameters
+    ----------
+    name: str
+        The name of the approach. It is used to differentiate between the
+        different approaches.
+    config: Dict[str, Any]
+        The configuration file of the experimental study. It is used to
+        retrieve the URL of the endpoint and the name of the RDF graph.
+    transport: None | Transport - (default = None)
+        The transport used to send requests to the server, shared by all the
+        partitions, so it must be thread-safe. By default, requests are sent
+        over HTTP, with one session per partition, and spread over the
+        replicas of the endpoint, if any.
+    """
+
+    # the maximum number of partitions, i.e. two hexadecimal digits of a hash
+    MAX_PARTITIONS = 256
+
+    def __init__(self, name: str, config: Dict[str, Any], **kwargs):
+        super().__init__(name)
+        self._endpoint = config["endpoints"]["sage"]["url"]
+        self._graph = config["endpoints"]["sage"]["graph"]
+        self._transport = kwargs.get("transport")
+        if self._transport is None:
+            self._transport = create_transport(
+                self._endpoint,
+                replicas=config["endpoints"]["sage"].get("replicas"),
+                balancing=config["endpoints"]["sage"].get(
+                    "balancing", "round-robin"))
+            self._resources.append(self._transport)
+
+    def __partition__(self, query: str, index: int, partitions: int) -> str:
+        """
+        Restricts a query to one of its partitions, i.e. to the solutions for
+        which the hash of the subject of the first triple pattern starts with
+        some hexadecimal digits.
+
+        Parameters
+        ----------
+        query: str
+            A SPARQL TOP-K query.
+        index: int
+            The index of the partition, between 0 and partitions - 1.
+        partitions: int
+            The number of partitions.
+
+        Returns
+        -------
+        str
+            The SPARQL TOP-K query of the partition.
+        """
+        if partitions == 1:
+            return query
+        match = re.search(r"WHERE\s*{\s*(\?\w+)", query)
+        if match is None:
+            raise Exception((
+                "The query cannot be partitioned, the subject of its first "
+                "triple pattern is not a variable..."))
+        width = 1 if partitions <= 16 else 2
+        digits = ", ".join([
+            f'"{digit:0{width}x}"' for digit in range(16 ** width)
+            if digit % partitions == index])
+        expression = (
+            f"SUBSTR(MD5(STR({match.group(1)})), 1, {width}) IN ({digits})")
+        end = query.rfind("}")
+        return f"{query[:end]}\tFILTER({expression})\n{query[end:]}"
+
+    def __execute_partition__(
+        self, query: str, topk: TOPKOperator, shared: Dict[str, Any],
+        lock: threading.Lock, spy: Spy, options: Dict[str, Any],
+        scan_order: List[Tuple[str, str]]
+    ) -> None:
+        """
+        Executes a partition of a query until it is completed, while sharing
+        the tightest threshold with the other partitions.
+
+        Parameters
+        ----------
+        query: str
+            The SPARQL TOP-K query of the partition.
+        topk: TOPKOperator
+            The TOP-K of the partition.
+        shared: Dict[str, Any]
+            The tightest threshold of all partitions.
+        lock: threading.Lock
+            The lock that protects the shared threshold.
+        spy: Spy
+            An object used to collect statistics about the execution of the
+            partition.
+        options: Dict[str, Any]
+            The parameters of the requests sent to the server.
+        scan_order: List[Tuple[str, str]]
+            The variables on which the scan of the query is sorted, or an
+            empty list if it is not sorted.
+        """
+        payload = {
+            "query": query,
+            "defaultGraph": self._graph,
+            "next": None,
+            "topkStrategy": "partial_topk",
+            **options}
+
+        has_next = True
+        while has_next:
+            with spy.measure("encode_time"):
+                data = json.dumps(payload)
+            with spy.measure("http_time"):
+                body = self._transport.post(data)
+            with spy.measure("decode_time"):
+                response = json.loads(body)
+
+            has_next = response["next"] is not None
+
+            with spy.measure("topk_time"):
+                topk.insert_page(response["bindings"])
+                # stops once the next solutions cannot change the TOP-K,
+                # if the server reports its sorted access paths, i.e.
+                # only the stand-in, or if the scan is sorted
+                sorted_access = self.__sorted_access__(scan_order, response)
+                if has_next and sorted_access is not None and (
+                    not topk.can_change(sorted_access)
+                ):
+                    has_next = False
+                    spy.report_early_termination(
+                        sorted_access.get("remaining"),
+                        response["stats"].get("scanned"))
+
+            # shares the tightest threshold, and updates the saved plan
+            if has_next:
+                with spy.measure("threshold_time"):
+                    with lock:
+                        if shared["threshold"] is not None:
+                            topk.tighten(shared["threshold"])
+                        shared["threshold"] = topk.threshold()
+                    payload["next"] = topk.update_threshold(response["next"])
+
+            spy.report_http_calls(1)
+            spy.report_data_transfer(len(data.encode("utf-8")) + len(body))
+            spy.report_loading_time(response["stats"]["resuming_time"])
+            spy.report_saving_time(response["stats"]["saving_time"])
+
+    def execute_query(
+        self, query: str, spy: Spy, **kwargs
+    ) -> List[Dict[str, str]]:
+        """
+        Executes a SPARQL TOP-K query as several partitions executed
+        concurrently against preemptable SPARQL endpoints.
+
+        Parameters
+        ----------
+        query: str
+            A SPARQL TOP-K query.
+        spy: Spy
+            An object used to collect statistics about the execution of the
+            query.
+        partitions: int - (default = 4)
+            The number of partitions of the query.
+
+        Returns
+        -------
+            The result of the query.
+        """
+        limit = kwargs.setdefault("limit", 10)
+        quota = kwargs.setdefault("quota", None)
+        force_order = kwargs.setdefault("force_order", False)
+        early_pruning = kwargs.setdefault("early_pruning", False)
+        stateless = kwargs.setdefault("stateless", True)
+        max_limit = kwargs.setdefault("max_limit", None)
+        layout = kwargs.setdefault("layout", "nested")
+        offset = kwargs.setdefault("offset", None)
+        continuation = kwargs.setdefault("continuation", None)
+        checkpoint = kwargs.setdefault("checkpoint", None)
+        seeding = kwargs.setdefault("seeding", False)
+        partitions = kwargs.setdefault("partitions", 4)
+
+        if partitions < 1 or partitions > SaGePartitionedTopK.MAX_PARTITIONS:
+            raise Exception((
+                f"The number of partitions must be between 1 and "
+                f"{SaGePartitionedTopK.MAX_PARTITIONS}..."))
+        if not stateless and self._transport.replicas > 1:
+            raise Exception((
+                "Saved plans stored by a server cannot be resumed by its "
+                "replicas, queries must be stateless..."))
+        if continuation is not None:
+            raise Exception(f"The approach {self.name} cannot be resumed...")
+        if checkpoint is not None:
+            raise Exception(
+                f"The approach {self.name} cannot save checkpoints...")
+        if seeding:
+            raise Exception(
+                f"The approach {self.name} cannot seed its thresholds...")
+        if limit == 0:
+            limit = self.__extract_limit__(query)
+        if offset is None:
+            offset = self.__extract_offset__(query)
+
+        # each partition computes the TOP-(offset + limit) of its solutions
+        topks = [
+            TOPKOperator(query, limit=offset + limit, layout=layout)
+            for _ in range(partitions)]
+
+        orderby_variables = self.__get_orderby_variables__(query)
+        # the order of the scan, if the server follows the join order
+        scan_order = self.__scan_order__(query) if force_order else []
+
+        query = self.__set_projection__(query, ['*'])
+        query = self.__set_limit__(query, limit=offset + limit)
+        queries = [
+            self.__partition__(query, index, partitions)
+            for index in range(partitions)]
+
+        logging.info(f"{self.name} - query sent to the server:\n{query}")
+        logging.info(f"{self.name} - limit = {limit} (max={max_limit})")
+        logging.info(f"{self.name} - offset = {offset}")
+        logging.info(f"{self.name} - partitions = {partitions}")
+        logging.info(f"{self.name} - replicas = {self._transport.replicas}")
+        logging.info(f"{self.name} - quota = {quota} (ms)")
+        logging.info(f"{self.name} - stateless = {stateless}")
+        logging.info(f"{self.name} - early-pruning = {early_pruning}")
+        logging.info(f"{self.name} - layout = {layout}")
+
+        options = {
+            "quota": quota,
+            "forceOrder": force_order,
+            "earlyPruning": early_pruning,
+            "stateless": stateless,
+            "maxLimit": max_limit}
+
+        shared = {"threshold": None}
+        lock = threading.Lock()
+        spies = [Spy() for _ in range(partitions)]
+
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+
+        with ThreadPoolExecutor(max_workers=partitions) as pool:
+            futures = [
+                pool.submit(
+                    self.__execute_partition__, queries[index],
+                    topks[index], shared, lock, spies[index], options,
+                    scan_order)
+                for index in range(partitions)]
+            for future in futures:
+                future.result()
+
+        # partitions ran concurrently, so the phases of the slowest one are
+        # reported, while HTTP calls and data transfer are summed
+        spy.merge_concurrent(spies)
+
+        if spy.tracks_memory:  # estimating the size of solutions is costly
+            spy.report_topk_memory([
+                solution for topk in topks for solution in topk.solutions()])
+
+        with spy.measure("topk_time"):
+            results = topks[0].merge(topks[1:], limit, offset=offset)
+
+        elapsed_time = (time.perf_counter() - start) * 1000
+
+        spy.report_execution_time(elapsed_time)
+        spy.report_cpu_time((time.process_time() - start_cpu) * 1000)
+        spy.report_solutions(len(results))
+
+        with spy.measure("formatting_time"):
+            solutions = []  # solutions are formated to ease the validation
+            for mappings in results:
+                solution = {}
+                for key, value in mappings.items():
+                    if key in orderby_variables:  # to ease the validation
+                        if value.startswith('"') and value.endswith('"'):
+                            solution[key] = value[1:-1]
+                        else:
+                            solution[key] = value
+                solutions.append(solution)
+
+        return solutions
@@ -1,12 +1,11 @@
-import requests
 import json
 import time
-import sys
 import logging
 
 from typing import Dict, Any, List
 
 from approaches.approach import Approach
+from approaches.transport import create_transport
 from spy import Spy
 
 
@@ -24,12 +23,24 @@ class SaGeTopK(Approach):
     config: Dict[str, Any]
         The configuration file of the experimental study. It is used to
         retrieve the URL of the endpoint and the name of the RDF graph.
+    transport: None | Transport - (default = None)
+        The transport used to send requests to the server. By default,
+        requests are sent over HTTP, and spread over the replicas of the
+        endpoint, if any.
     """
 
     def __init__(self, name: str, config: Dict[str, Any], **kwargs):
         super().__init__(name)
         self._endpoint = config["endpoints"]["sage"]["url"]
         self._graph = config["endpoints"]["sage"]["graph"]
+        self._transport = kwargs.get("transport")
+        if self._transport is None:
+            self._transport = create_transport(
+                self._endpoint,
+                replicas=config["endpoints"]["sage"].get("replicas"),
+                balancing=config["endpoints"]["sage"].get(
+                    "balancing", "round-robin"))
+            self._resources.append(self._transport)
 
     def execute_query(
         self, query: str, spy: Spy, **kwargs
@@ -55,21 +66,52 @@ class SaGeTopK(Approach):
         early_pruning = kwargs.setdefault("early_pruning", False)
         stateless = kwargs.setdefault("stateless", True)
         max_limit = kwargs.setdefault("max_limit", None)
+        offset = kwargs.setdefault("offset", None)
+        continuation = kwargs.setdefault("continuation", None)
+        checkpoint = kwargs.setdefault("checkpoint", None)
+        resume = kwargs.setdefault("resume", False)
+
+        if not stateless and self._transport.replicas > 1:
+            raise Exception((
+                "Saved plans stored by a server cannot be resumed by its "
+                "replicas, queries must be stateless..."))
+        if limit == 0:
+            limit = self.__extract_limit__(query)
+        if offset is None:
+            offset = self.__extract_offset__(query)
+        position, after, skip = self.__resume_page__(continuation, offset)
+
+        # an interrupted execution is resumed from the state saved in its
+        # checkpoint, if any
+        header = {
+            "approach": self.name, "query": query, "limit": limit,
+            "position": position}
+        state = None
+        if checkpoint is not None and resume:
+            state = checkpoint.load(header)
 
         orderby_variables = self.__get_orderby_variables__(query)
 
+        # the server only computes the TOP-(skip + limit) of the solutions
+        # that are not ordered before the previous page, and the ties of its
+        # last solution that were already returned are skipped by the client.
+        # ORDER BY expressions cannot be filtered, so the server computes the
+        # TOP-(position + limit), and the previous pages are skipped
         query = self.__set_projection__(query, ['*'])
-        query = self.__set_limit__(query, limit=limit)
+        keyset = self.__keyset__(query, after)
+        if keyset is not None:
+            query = self.__set_limit__(keyset, limit=skip + limit)
+        else:
+            query = self.__set_limit__(query, limit=position + limit)
+            skip = position
 
         logging.info(f"{self.name} - query sent to the server:\n{query}")
         logging.info(f"{self.name} - limit = {limit} (max={max_limit})")
+        logging.info(f"{self.name} - offset = {position} (skip={skip})")
         logging.info(f"{self.name} - quota = {quota} (ms)")
         logging.info(f"{self.name} - stateless = {stateless}")
         logging.info(f"{self.name} - early-pruning = {early_pruning}")
 
-        headers = {
-            "accept": "text/html",
-            "content-type": "application/json"}
         payload = {
             "query": query,
             "defaultGraph": self._graph,
@@ -82,39 +124,76 @@ class SaGeTopK(Approach):
             "maxLimit": max_limit}
 
         results = []
+        quanta = 0
+        if state is not None:
+            payload["next"] = state["next"]
+            quanta = state["quanta"]
+            results.extend(state["solutions"])
         has_next = True
 
-        start = time.time()
+        start = time.perf_counter()
+        start_cpu = time.process_time()
 
         while has_next:
-            data = json.dumps(payload)
-            response = requests.post(
-                self._endpoint, headers=headers, data=data).json()
+            with spy.measure("encode_time"):
+                data = json.dumps(payload)
+            with spy.measure("http_time"):
+                body = self._transport.post(data)
+            with spy.measure("decode_time"):
+                response = json.loads(body)
             results.extend(response["bindings"])
 
             payload["next"] = response["next"]
             has_next = response["next"] is not None
 
             spy.report_http_calls(1)
-            spy.report_data_transfer(sys.getsizeof(data))
-            spy.report_data_transfer(sys.getsizeof(json.dumps(response)))
+            spy.report_data_transfer(len(data.encode("utf-8")) + len(body))
             spy.report_loading_time(response["stats"]["resuming_time"])
             spy.report_saving_time(response["stats"]["saving_time"])
 
-        elapsed_time = (time.time() - start) * 1000
+            quanta += 1
+            if has_next and checkpoint is not None and checkpoint.due():
+                with spy.measure("checkpoint_time"):
+                    checkpoint.save({
+                        **header, "next": payload["next"], "quanta": quanta,
+                        "solutions": results})
+
+        if checkpoint is not None:  # the query is completed
+            checkpoint.clear()
+
+        if spy.tracks_memory:  # estimating the size of solutions is costly
+            spy.report_topk_memory(results)
+
+        last = None
+        if keyset is not None and len(results) > 0:
+            # the solutions sent with the ORDER BY key of the last one
+            key = [results[-1].get(name) for name in orderby_variables]
+            ties = 0
+            for mappings in reversed(results):
+                if [mappings.get(name) for name in orderby_variables] != key:
+                    break
+                ties += 1
+            last = (results[-1], ties)
+        results = results[skip:]
+        spy.report_continuation(
+            self.__next_page__(position, len(results), limit, last=last))
+
+        elapsed_time = (time.perf_counter() - start) * 1000
 
         spy.report_execution_time(elapsed_time)
+        spy.report_cpu_time((time.process_time() - start_cpu) * 1000)
         spy.report_solutions(len(results))
 
-        solutions = []  # solutions are formated to make the validation easier
-        for mappings in results:
-            solution = {}
-            for key, value in mappings.items():
-                if key in orderby_variables:  # to make the validation easier
-                    if value.startswith('"') and value.endswith('"'):
-                        solution[key] = value[1:-1]
-                    else:
-                        solution[key] = value
-            solutions.append(solution)
+        with spy.measure("formatting_time"):
+            solutions = []  # solutions are formated to ease the validation
+            for mappings in results:
+                solution = {}
+                for key, value in mappings.items():
+                    if key in orderby_variables:  # to ease the validation
+                        if value.startswith('"') and value.endswith('"'):
+                            solution[key] = value[1:-1]
+                        else:
+                            solution[key] = value
+                solutions.append(solution)
 
         return solutions
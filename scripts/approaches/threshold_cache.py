@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import re
+
+from typing import Dict, Optional
+
+
+class ThresholdCache():
+    """
+    This class caches thresholds that can seed the partial TOP-K of a query.
+    A threshold recorded for the rank n of a query is a solution strictly
+    ordered after the n-th solution of the query, so the server can prune all
+    the solutions that are not ordered before it without losing any solution
+    of a TOP-k with k <= n, even before the client has received k solutions.
+    Thresholds are only valid as long as the dataset does not change.
+
+    Parameters
+    ----------
+    path: None | str - (default = None)
+        The JSON file in which thresholds are persisted, so that they can be
+        shared between processes. By default, thresholds are kept in memory.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._path = path
+        self._thresholds = self.__load__()
+        # the thresholds recorded by this process, merged with the file
+        self._updates = dict()
+        if path is not None:
+            logging.info(f"{len(self._thresholds)} thresholds loaded")
+
+    def __load__(self) -> Dict[str, Dict[str, Dict[str, str]]]:
+        """
+        Returns the thresholds of the JSON file of the cache, if any.
+        """
+        if self._path is None or not os.path.exists(self._path):
+            return dict()
+        with open(self._path, "r") as cachefile:
+            return json.load(cachefile)
+
+    def __key__(self, graph: str, query: str) -> str:
+        """
+        Returns the key of a query in the cache, i.e. the query without its
+        LIMIT and OFFSET clauses, as thresholds do not depend on them.
+        """
+        query = re.sub(r"\s*\b(LIMIT|OFFSET)\s+\d+", "", query).strip()
+        return f"{graph}\n{query}"
+
+    def get(
+        self, graph: str, query: str, rank: int
+    ) -> Optional[Dict[str, str]]:
+        """
+        Returns the tightest threshold that is valid for the TOP-k of a query,
+        i.e. the threshold recorded for the smallest rank n >= k.
+
+        Parameters
+        ----------
+        graph: str
+            The default graph of the query.
+        query: str
+            A SPARQL TOP-k query.
+        rank: int
+            The rank k of the last solution of the TOP-k.
+
+        Returns
+        -------
+        None | Dict[str, str]
+            The threshold, as sent by the server, or None if no threshold is
+            valid for this TOP-k.
+        """
+        thresholds = self._thresholds.get(self.__key__(graph, query), {})
+        ranks = [int(n) for n in thresholds if int(n) >= rank]
+        if len(ranks) == 0:
+            return None
+        return thresholds[str(min(ranks))]
+
+    def put(
+        self, graph: str, query: str, rank: int, threshold: Dict[str, str]
+    ) -> None:
+        """
+        Records a threshold strictly ordered after the n-th solution of a
+        query.
+
+        Parameters
+        ----------
+        graph: str
+            The default graph of the query.
+        query: str
+            A SPARQL TOP-k query.
+        rank: int
+            The rank n of the solution after which the threshold is ordered.
+        threshold: Dict[str, str]
+            The threshold, as sent by the server.
+        """
+        key = self.__key__(graph, query)
+        self._thresholds.setdefault(key, {})[str(rank)] = threshold
+        self._updates.setdefault(key, {})[str(rank)] = threshold
+
+    def save(self) -> None:
+        """
+        Saves the thresholds in the JSON file of the cache, if any. The
+        thresholds recorded by this process are merged with those saved by
+        other processes since the file was loaded, and the file is replaced
+        atomically, so an interruption while saving does not corrupt it.
+        """
+        if self._path is None:
+            return
+        thresholds = self.__load__()
+        for key, updates in self._updates.items():
+            thresholds.setdefault(key, {}).update(updates)
+        temporary = f"{self._path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as cachefile:
+            json.dump(thresholds, cachefile)
+        os.replace(temporary, self._path)
+        self._thresholds = thresholds
@@ -0,0 +1,28 @@
+# Declarations used when topk_struct.py is compiled with Cython, so that the
+# nodes and the levels of the topk are extension types with typed fields.
+# The Python file is unchanged, and stays the fallback when not compiled.
+
+cdef class Node:
+    cdef public object key
+    cdef public object value
+    cdef public Node parent
+    cdef public Node left
+    cdef public Node right
+    cdef public int color
+    cdef public Py_ssize_t weight
+    cdef public Py_ssize_t total
+
+
+cdef class OrderedDict:
+    cdef public Node TNULL
+    cdef public Node root
+    cdef public Py_ssize_t length
+    cdef public object default
+
+
+    cpdef delete_fix(self, Node x)
+    cpdef fix_insert(self, Node k)
+    cpdef Node minimum(self, Node node)
+    cpdef Node maximum(self, Node node)
+    cpdef left_rotate(self, Node x)
+    cpdef right_rotate(self, Node x)
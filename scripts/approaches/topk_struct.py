@@ -1,4 +1,13 @@
 # import logging
+import heapq
+import struct
+import zlib
+
+from itertools import islice, repeat
+
+# True if the module was compiled with Cython (see scripts/setup.py), in which
+# case the extension module is imported instead of this file
+COMPILED = not __file__.endswith(".py")
 
 
 class Node():
@@ -6,13 +15,15 @@ class Node():
     :description: Class for each individual node of the red black tree
     """
 
-    def __init__(self, key, value=None):
+    def __init__(self, key, value=None, weight=1):
         self.key = key
         self.value = value
         self.parent = None
         self.left = None
         self.right = None
         self.color = 1
+        self.weight = weight  # the number of elements held by the node
+        self.total = weight  # the sum of the weights of the subtree
 
     def __repr__(self):
         return "<key = "+str(self.key)+", value = "+str(self.value)+">"
@@ -23,17 +34,20 @@ class OrderedDict():
     :description: Class for the ordered dictionary
     :data_structure: The ordered dict implemented as a red black tree
     :restriction: All keys must be of the same data type
+    :augmentation: Each node holds the sum of the weights of its subtree,
+        so ranks are computed in O(log n). By default, each key weighs 1,
+        i.e. ranks are numbers of keys, but a key can weigh the number of
+        elements held by its value, e.g. to rank the solutions of a nested
+        topk instead of its keys
     """
 
     def __init__(self, default=None):
-        self.TNULL = Node(0, 0)  # TNULL refers to the NIL node
+        self.TNULL = Node(0, 0, weight=0)  # TNULL refers to the NIL node
         self.TNULL.color = 0
         self.TNULL.left = None
         self.TNULL.right = None
         self.root = self.TNULL
         self.length = 0
-        self.curr = None  # needed for iteration
-        self.stack = []  # needed for iteration
         self.default = default  # the default value to return if key not found
 
     # update the value for a key, or add a new key-value pair
@@ -44,7 +58,7 @@ class OrderedDict():
     def __getitem__(self, key):
         # if nil, return key error, else return value
         node = self.search(self.get_root(), key)
-        if node == self.TNULL:
+        if node is self.TNULL:
             if self.default is not None:
                 return self.default
             message = "Key Error! " + \
@@ -55,40 +69,36 @@ class OrderedDict():
 
     # checks if dict contains the given key (the in operator)
     def __contains__(self, key):
-        return False if self.search(self.root, key) == self.TNULL else True
+        return False if self.search(self.root, key) is self.TNULL else True
 
-    # initialise iteration
+    # iterates the dict in order of keys, the state of the iteration being
+    # local to the generator, so several iterations can run at the same time
     def __iter__(self):
-        self.curr = self.root
-        self.stack = []
-        return self
-
-    # returns the next element on every call
-    def __next__(self):
-        while self.curr != self.TNULL or self.stack:
-            if self.curr != self.TNULL:
-                self.stack.append(self.curr)
-                self.curr = self.curr.left
-            elif self.stack:
-                self.curr = self.stack.pop()
-                temp = self.curr
-                self.curr = self.curr.right
-                return temp
-        else:
-            raise StopIteration
+        TNULL = self.TNULL
+        stack = []
+        node = self.root
+        while node is not TNULL or stack:
+            if node is not TNULL:
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                yield node
+                node = node.right
 
     # iterates the dict in reverse order of keys
     def reverse_iterate(self):
-        self.curr = self.root
-        self.stack = []
-        while self.curr != self.TNULL or self.stack:
-            if self.curr != self.TNULL:
-                self.stack.append(self.curr)
-                self.curr = self.curr.right
-            elif self.stack:
-                self.curr = self.stack.pop()
-                yield self.curr
-                self.curr = self.curr.left
+        TNULL = self.TNULL
+        stack = []
+        node = self.root
+        while node is not TNULL or stack:
+            if node is not TNULL:
+                stack.append(node)
+                node = node.right
+            else:
+                node = stack.pop()
+                yield node
+                node = node.left
 
     # returns list of all key values in dict in formatted manner
     def __repr__(self):
@@ -107,12 +117,20 @@ class OrderedDict():
 
     # Search the tree
     def search(self, node, key):
-        if node == self.TNULL or key == node.key:
-            return node
+        TNULL = self.TNULL
+        while node is not TNULL and key != node.key:
+            if key < node.key:
+                node = node.left
+            else:
+                node = node.right
+        return node
 
-        if key < node.key:
-            return self.search(node.left, key)
-        return self.search(node.right, key)
+    # returns the value corresponding to a key, or default if key is absent
+    def get(self, key, default=None):
+        node = self.search(self.root, key)
+        if node is self.TNULL:
+            return default
+        return node.value
 
     # returns the next greater key in dict corresponding to a given value
     def upper_bound(self, n):
@@ -121,11 +139,16 @@ class OrderedDict():
         :param type: any
         :return: key value pair
         """
-        for x in self:
-            if x.key > n:
-                self.stack = []
-                return x
-        return None
+        TNULL = self.TNULL
+        node = self.root
+        bound = None
+        while node is not TNULL:
+            if n < node.key:
+                bound = node
+                node = node.left
+            else:
+                node = node.right
+        return bound
 
     # delete all elements of bst
     def clear(self):
@@ -134,9 +157,8 @@ class OrderedDict():
         :function: clears the dictionary
         :returns: None
         """
-        for node in self:
-            del node
         self.root = self.TNULL
+        self.length = 0
 
     # returns the next smaller key in dict corresponding to a given value
     def lower_bound(self, n):
@@ -145,19 +167,140 @@ class OrderedDict():
         :param type: any
         :return: key value pair
         """
-        for x in self.reverse_iterate():
-            if x.key < n:
-                self.stack = []
+        TNULL = self.TNULL
+        node = self.root
+        bound = None
+        while node is not TNULL:
+            if node.key < n:
+                bound = node
+                node = node.right
+            else:
+                node = node.left
+        return bound
+
+    # returns the sum of the weights of the keys smaller than a given value,
+    # i.e. the number of smaller keys when keys weigh 1
+    def rank(self, n, inclusive=False):
+        """
+        :param name: n - key for which the rank is to be computed
+        :param type: any
+        :param name: inclusive - True to also count the key n itself
+        :param type: bool
+        :returns: int
+        """
+        TNULL = self.TNULL
+        node = self.root
+        rank = 0
+        while node is not TNULL:
+            if n < node.key:
+                node = node.left
+            elif node.key < n:
+                rank += node.left.total + node.weight
+                node = node.right
+            elif inclusive:
+                return rank + node.left.total + node.weight
+            else:
+                return rank + node.left.total
+        return rank
+
+    # returns the node that holds the element at a given position, as
+    # defined by the weights of the keys, and the position in this node
+    def select(self, position, reverse=False):
+        """
+        :param name: position - position of the element, from 0
+        :param type: int
+        :param name: reverse - True to count from the biggest key
+        :param type: bool
+        :returns: node, int
+        """
+        node, position, _ = self.__seek__(position, reverse)
+        return node, position
+
+    # returns an iterator over the keys of the dict that starts from the
+    # node that holds the element at a given position, and the position of
+    # the element in this node
+    def seek(self, position, reverse=False):
+        """
+        :param name: position - position of the element, from 0
+        :param type: int
+        :param name: reverse - True to count and iterate from the biggest key
+        :param type: bool
+        :returns: int, iterator
+        """
+        _, position, stack = self.__seek__(position, reverse)
+        return position, self.__resume__(stack, reverse)
+
+    def __seek__(self, position, reverse):
+        if position < 0 or position >= self.root.total:
+            raise Exception('position should be between 0 and size of dict')
+        stack = []  # the nodes to visit after the current one
+        node = self.root
+        while True:
+            near = node.right if reverse else node.left
+            if position < near.total:
+                stack.append(node)
+                node = near
+                continue
+            position -= near.total
+            if position < node.weight:
+                stack.append(node)
+                return node, position, stack
+            position -= node.weight
+            node = node.left if reverse else node.right
+
+    # resumes an in-order traversal whose next node is on top of the stack
+    def __resume__(self, stack, reverse):
+        TNULL = self.TNULL
+        node = TNULL
+        while node is not TNULL or stack:
+            if node is not TNULL:
+                stack.append(node)
+                node = node.right if reverse else node.left
+            else:
+                node = stack.pop()
+                yield node
+                node = node.left if reverse else node.right
+
+    # adds a weight to the node of a key, e.g. when its value holds more
+    # elements. The weights of the subtrees are updated while searching the
+    # key, so no walk back to the root is needed.
+    def add(self, key, weight, factory=None):
+        """
+        :param name: key - key whose weight changes
+        :param type: any
+        :param name: weight - weight to add to the key
+        :param type: int
+        :param name: factory - if the key is absent, returns the value of a
+            new node that weighs weight, otherwise an exception is raised
+        :param type: callable
+        :returns: the node of the key
+        """
+        TNULL = self.TNULL
+        y = None
+        x = self.root
+        while x is not TNULL:
+            x.total += weight
+            if key == x.key:
+                x.weight += weight
                 return x
-        return None
+            y = x
+            x = x.left if key < x.key else x.right
+        if factory is None:
+            while y is not None:
+                y.total -= weight
+                y = y.parent
+            message = "Key Error! Key " + \
+                str(key)+" does not exist in dictionary."
+            raise Exception(message)
+        return self.__attach__(y, Node(key, factory(), weight=weight))
 
     # Balancing the tree after deletion
     def delete_fix(self, x):
         """
         :function: Rebalance tree after delete operation
         """
-        while x != self.root and x.color == 0:
-            if x == x.parent.left:
+        while x is not self.root and x.color == 0:
+            if x is x.parent.left:
                 s = x.parent.right
                 if s.color == 1:
                     s.color = 0
@@ -208,7 +351,7 @@ class OrderedDict():
     def __rb_transplant(self, u, v):
         if u.parent is None:
             self.root = v
-        elif u == u.parent.left:
+        elif u is u.parent.left:
             u.parent.left = v
         else:
             u.parent.right = v
@@ -220,7 +363,7 @@ class OrderedDict():
         :function: Deletes a node
         """
         z = self.TNULL
-        while node != self.TNULL:
+        while node is not self.TNULL:
             if node.key == key:
                 z = node
                 break
@@ -229,25 +372,38 @@ class OrderedDict():
             else:
                 node = node.left
 
-        if z == self.TNULL:
+        if z is self.TNULL:
             message = "Key Error! Key " + \
                 str(key)+" does not exist in dictionary."
             raise Exception(message)
             return
+        # the ancestors of a node moved or removed no longer count it
+        if z.weight != 0:
+            ancestor = z.parent
+            while ancestor is not None:
+                ancestor.total -= z.weight
+                ancestor = ancestor.parent
+        if z.left is not self.TNULL and z.right is not self.TNULL:
+            y = self.minimum(z.right)
+            ancestor = y.parent
+            while ancestor is not z:
+                ancestor.total -= y.weight
+                ancestor = ancestor.parent
+            y.total = z.total - z.weight
         y = z
         self.length -= 1
         y_original_color = y.color
-        if z.left == self.TNULL:
+        if z.left is self.TNULL:
             x = z.right
             self.__rb_transplant(z, z.right)
-        elif (z.right == self.TNULL):
+        elif (z.right is self.TNULL):
             x = z.left
             self.__rb_transplant(z, z.left)
         else:
             y = self.minimum(z.right)
             y_original_color = y.color
             x = y.right
-            if y.parent == z:
+            if y.parent is z:
                 x.parent = y
             else:
                 self.__rb_transplant(y, y.right)
@@ -268,7 +424,7 @@ class OrderedDict():
         :function: Rebalances tree after insert operation
         """
         while k.parent.color == 1:
-            if k.parent == k.parent.parent.right:
+            if k.parent is k.parent.parent.right:
                 u = k.parent.parent.left
                 if u.color == 1:
                     u.color = 0
@@ -276,7 +432,7 @@ class OrderedDict():
                     k.parent.parent.color = 1
                     k = k.parent.parent
                 else:
-                    if k == k.parent.left:
+                    if k is k.parent.left:
                         k = k.parent
                         self.right_rotate(k)
                     k.parent.color = 0
@@ -291,13 +447,13 @@ class OrderedDict():
                     k.parent.parent.color = 1
                     k = k.parent.parent
                 else:
-                    if k == k.parent.right:
+                    if k is k.parent.right:
                         k = k.parent
                         self.left_rotate(k)
                     k.parent.color = 0
                     k.parent.parent.color = 1
                     self.right_rotate(k.parent.parent)
-            if k == self.root:
+            if k is self.root:
                 break
         self.root.color = 0
 
@@ -307,9 +463,9 @@ class OrderedDict():
         :function: returns the smallest key of dicionary
         """
         node = self.root
-        while node.left and node.left != self.TNULL:
+        while node.left and node.left is not self.TNULL:
             node = node.left
-        if node and node == self.TNULL:
+        if node and node is self.TNULL:
             raise Exception("Dictionary empty")
             return
         return node
@@ -320,39 +476,39 @@ class OrderedDict():
         :function: returns the biggest key of dicionary
         """
         node = self.root
-        while node.right and node.right != self.TNULL:
+        while node.right and node.right is not self.TNULL:
             node = node.right
-        if node and node == self.TNULL:
+        if node and node is self.TNULL:
             raise Exception("Dictionary empty")
             return
         return node
 
     def minimum(self, node):
-        while node.left != self.TNULL:
+        while node.left is not self.TNULL:
             node = node.left
         return node
 
     def maximum(self, node):
-        while node.right != self.TNULL:
+        while node.right is not self.TNULL:
             node = node.right
         return node
 
     def successor(self, x):
-        if x.right != self.TNULL:
+        if x.right is not self.TNULL:
             return self.minimum(x.right)
 
         y = x.parent
-        while y != self.TNULL and x == y.right:
+        while y is not self.TNULL and x is y.right:
             x = y
             y = y.parent
         return y
 
     def predecessor(self,  x):
-        if (x.left != self.TNULL):
+        if (x.left is not self.TNULL):
             return self.maximum(x.left)
 
         y = x.parent
-        while y != self.TNULL and x == y.left:
+        while y is not self.TNULL and x is y.left:
             x = y
             y = y.parent
 
@@ -361,42 +517,46 @@ class OrderedDict():
     def left_rotate(self, x):
         y = x.right
         x.right = y.left
-        if y.left != self.TNULL:
+        if y.left is not self.TNULL:
             y.left.parent = x
 
         y.parent = x.parent
         if x.parent is None:
             self.root = y
-        elif x == x.parent.left:
+        elif x is x.parent.left:
             x.parent.left = y
         else:
             x.parent.right = y
         y.left = x
         x.parent = y
+        y.total = x.total
+        x.total = x.left.total + x.right.total + x.weight
 
     def right_rotate(self, x):
         y = x.left
         x.left = y.right
-        if y.right != self.TNULL:
+        if y.right is not self.TNULL:
             y.right.parent = x
 
         y.parent = x.parent
         if x.parent is None:
             self.root = y
-        elif x == x.parent.right:
+        elif x is x.parent.right:
             x.parent.right = y
         else:
             x.parent.left = y
         y.right = x
         x.parent = y
+        y.total = x.total
+        x.total = x.left.total + x.right.total + x.weight
 
     # insertion of key value pair
-    def insert(self, key, value):
+    def insert(self, key, value, weight=1):
         """
-        :param names: key, value
+        :param names: key, value, weight
         :param types: any
-        :function: Inserts new element
-        :returns: None
+        :function: Inserts new element, or updates the value of a key
+        :returns: the node of the key
         """
         if self.length == 0:
             if type(key) in [list, dict, OrderedDict]:
@@ -406,26 +566,29 @@ class OrderedDict():
         elif not isinstance(self.root.key, type(key)):
             raise Exception("Data types of all keys must match.")
             return
-        node = Node(key, value)
-        node.parent = None
-        # node.key = key
-        # node.value=value
-        node.left = self.TNULL
-        node.right = self.TNULL
-        # node.color = 1
-
         y = None
         x = self.root
-        self.length += 1
-        while x != self.TNULL:
-            y = x
-            if node.key == x.key:
+        while x is not self.TNULL:
+            x.total += weight  # undone if the key is already present
+            if key == x.key:
                 x.value = value
-                return
-            elif node.key < x.key:
+                node = x
+                while node is not None:
+                    node.total -= weight
+                    node = node.parent
+                return x
+            y = x
+            if key < x.key:
                 x = x.left
             else:
                 x = x.right
+        return self.__attach__(y, Node(key, value, weight=weight))
+
+    # adds a new node as a child of y, and rebalances the tree
+    def __attach__(self, y, node):
+        node.left = self.TNULL
+        node.right = self.TNULL
+        self.length += 1
         node.parent = y
         if y is None:
             self.root = node
@@ -436,12 +599,13 @@ class OrderedDict():
 
         if node.parent is None:
             node.color = 0
-            return
+            return node
 
         if node.parent.parent is None:
-            return
+            return node
 
         self.fix_insert(node)
+        return node
 
     # returns root of bst
     def get_root(self):
@@ -456,21 +620,9 @@ class OrderedDict():
         """
         self.delete_node_helper(self.root, key)
 
-    # returns the kth smallest key (along with value)
-    def ksmallUtil(self, root, k, ksmall):
-        """
-        :param names: root, k, ksmall
-        :param types: Node, int, list of size 1
-        :returns: None
-        """
-        if root == self.TNULL or ksmall[0] or k[0] < 0:
-            return
-        self.ksmallUtil(root.left, k, ksmall)
-        k[0] -= 1
-        if k[0] == 0:
-            ksmall[0] = root
-        self.ksmallUtil(root.right, k, ksmall)
-
+    # returns the kth smallest key (along with value). Ranks count keys,
+    # whatever their weights: they are selected in O(log n) when all the keys
+    # weigh 1, and found by walking the keys in order otherwise
     def KSmallest(self, k):
         """
         :param name: k
@@ -481,25 +633,12 @@ class OrderedDict():
         if self.length < k or k < 1:
             raise Exception('k should be between 1 and size of dict')
             return
-        ksmall = [None]
-        self.ksmallUtil(self.root, [k], ksmall)
-        return ksmall[0]
+        if self.root.total == self.length:  # as weights are at least 1
+            node, _ = self.select(k - 1)
+            return node
+        return next(islice(iter(self), k - 1, None))
 
     # returns the kth largest key (along with value)
-    def klargeUtil(self, root, k, klarge):
-        """
-        :param names: root, k, klarge
-        :param types: Node, int, list of size 1
-        :returns: None
-        """
-        if root == self.TNULL or klarge[0] or k[0] < 0:
-            return
-        self.klargeUtil(root.right, k, klarge)
-        k[0] -= 1
-        if k[0] == 0:
-            klarge[0] = root
-        self.klargeUtil(root.left, k, klarge)
-
     def KLargest(self, k):
         """
         :param name: k
@@ -510,145 +649,503 @@ class OrderedDict():
         if self.length < k or k < 1:
             raise Exception('k should be between 1 and size of dict')
             return
-        klarge = [None]
-        self.klargeUtil(self.root, [k], klarge)
-        return klarge[0]
+        if self.root.total == self.length:  # as weights are at least 1
+            node, _ = self.select(k - 1, reverse=True)
+            return node
+        return next(islice(self.reverse_iterate(), k - 1, None))
+
+
+class Solution():
+    """
+    :description: Compact record of a solution mappings held by the topk
+    :key: tuple of the values of the ORDER BY keys, in the order of the keys
+    :values: tuple of the values of the variables, aligned to a Schema
+    """
+    __slots__ = ("key", "values")
+
+    def __init__(self, key, values):
+        self.key = key
+        self.values = values
+
+    def __repr__(self):
+        return "<key = "+str(self.key)+", values = "+str(self.values)+">"
+
+
+class Schema():
+    """
+    :description: Positions of the variables in the values of the solutions
+    :restriction: Variables are never removed, so positions are stable and
+        solutions encoded before a new variable is seen are just shorter
+    """
+
+    def __init__(self, excluded=()):
+        self.variables = []
+        self.positions = {}
+        self.excluded = set(excluded)  # variables that are not stored
+
+    # returns the values of a solution mappings as a tuple
+    def encode(self, mappings):
+        values = [None] * len(self.variables)
+        for variable, value in mappings.items():
+            position = self.positions.get(variable)
+            if position is None:
+                if variable in self.excluded:
+                    continue
+                position = len(self.variables)
+                self.positions[variable] = position
+                self.variables.append(variable)
+                values.append(None)
+            values[position] = value
+        return tuple(values)
+
+    # adds the variables of another schema, and returns their positions in
+    # this schema, or None if they have the same positions in both schemas
+    def align(self, variables):
+        positions = []
+        for variable in variables:
+            position = self.positions.get(variable)
+            if position is None:
+                position = len(self.variables)
+                self.positions[variable] = position
+                self.variables.append(variable)
+            positions.append(position)
+        if positions == list(range(len(positions))):
+            return None
+        return positions
+
+    # returns the values of a solution encoded with another schema, given
+    # the positions of its variables in this schema
+    def remap(self, values, positions):
+        remapped = [None] * len(self.variables)
+        for position, value in zip(positions, values):
+            remapped[position] = value
+        return tuple(remapped)
+
+    # returns the solution mappings of a tuple of values
+    def decode(self, values):
+        return {
+            variable: value
+            for variable, value in zip(self.variables, values)
+            if value is not None}
+
+
+class Descending():
+    """
+    :description: Wraps the value of a DESC key in a composite key, so that
+        composite keys with mixed orders are sorted by tuple comparisons
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return "DESC("+str(self.value)+")"
+
+
+class Snapshot():
+    """
+    :description: Binary snapshot of the solutions of a topk, in the order of
+        the topk. A snapshot starts with a magic number and a header, i.e.
+        whether keys are stored, the number of keys, of variables, of values
+        per solution and of solutions, followed by a compressed body: the
+        lengths of all strings, then the strings, i.e. the variables of the
+        schema, the keys column and the values of the solutions, padded to
+        the same number of values
+    :restriction: Keys and values must be strings or None
+    """
+
+    MAGIC = b"TOPKSNP1"
+    HEADER = struct.Struct(">BHHHI")
+    NONE = 0xFFFFFFFF  # the length of a missing value
+
+    # returns the snapshot of a list of solutions, with the variables of
+    # their schema. Without keys, keys have to be computed from the values
+    # when the snapshot is restored.
+    @staticmethod
+    def pack(solutions, variables=(), keys=True):
+        width = len(variables)
+        for solution in solutions:
+            width = max(width, len(solution.values))
+        nkeys = len(solutions[0].key) if keys and solutions else 0
+        strings = list(variables)
+        padding = (None,) * width
+        for solution in solutions:
+            if keys:
+                strings.extend(solution.key)
+            strings.extend(solution.values)
+            strings.extend(padding[len(solution.values):])
+        encoded = [
+            b"" if string is None else string.encode("utf-8")
+            for string in strings]
+        lengths = [
+            Snapshot.NONE if string is None else len(data)
+            for string, data in zip(strings, encoded)]
+        body = struct.pack(f">{len(lengths)}I", *lengths) + b"".join(encoded)
+        header = Snapshot.HEADER.pack(
+            int(keys), nkeys, len(variables), width, len(solutions))
+        return Snapshot.MAGIC + header + zlib.compress(body, 1)
+
+    # returns the variables and the solutions of a snapshot, the keys of the
+    # solutions being None if they are not stored
+    @staticmethod
+    def unpack(data):
+        if data[:len(Snapshot.MAGIC)] != Snapshot.MAGIC:
+            raise Exception("The data is not a snapshot of a topk...")
+        offset = len(Snapshot.MAGIC)
+        keys, nkeys, nvariables, width, size = Snapshot.HEADER.unpack_from(
+            data, offset)
+        body = zlib.decompress(data[offset + Snapshot.HEADER.size:])
+        count = nvariables + size * (nkeys + width)
+        lengths = struct.unpack_from(f">{count}I", body)
+        strings = []
+        position = 4 * count
+        for length in lengths:
+            if length == Snapshot.NONE:
+                strings.append(None)
+            else:
+                end = position + length
+                strings.append(body[position:end].decode("utf-8"))
+                position = end
+        variables = strings[:nvariables]
+        if nkeys + width == 0:  # solutions without keys nor values
+            return variables, [Solution(None, ()) for _ in range(size)]
+        solutions = []
+        for start in range(nvariables, count, nkeys + width):
+            key = tuple(strings[start:start + nkeys]) if keys else None
+            values = strings[start + nkeys:start + nkeys + width]
+            while values and values[-1] is None:  # removes the padding
+                values.pop()
+            solutions.append(Solution(key, tuple(values)))
+        return variables, solutions
 
 
 class TOPKStruct():
+    """
+    :description: The topk, as levels of OrderedDict and a list of solutions
+        with the same keys at the last level
+    :layout: "nested" for one level per ORDER BY key, i.e. one OrderedDict
+        per distinct prefix of the keys, or "flat" for a single level whose
+        keys are the composite keys of the solutions. The flat layout
+        allocates much less for high-cardinality keys, but compares tuples.
+    :augmentation: Each key of a level weighs the number of solutions below
+        it, so the position of a solution in the topk is computed in
+        O(depth * log k)
+    """
 
-    def __init__(self, keys, limit=100):
+    def __init__(self, keys, limit=100, layout="nested"):
         self._keys = keys
+        self._descending = [order == 'DESC' for _, order in keys]
         self._limit = limit
         self._topk = OrderedDict()
         self._size = 0
+        self._lower_bound = None  # cached, as it is used by every insertion
+        if layout == "nested":
+            self._levels = self._descending  # whether a level is reversed
+            self._composite = None
+        elif layout == "flat":
+            if all(self._descending) or not any(self._descending):
+                # the whole level is reversed, keys are left untouched
+                self._levels = [self._descending[0]]
+                self._composite = tuple
+            else:
+                self._levels = [False]
+                self._composite = self.__composite__
+        else:
+            raise Exception(f"The layout {layout} does not exist...")
 
     def __len__(self):
         return self._size
 
-    # flattens the topk into an ordered list
-    def __flatten__(self, node, key_index=0):
-        if isinstance(node, OrderedDict):
-            nodes = []
-            if self._keys[key_index][1] == 'DESC':
-                for item in node.reverse_iterate():
-                    nodes.extend(self.__flatten__(item.value, key_index + 1))
+    # returns the composite key of a solution with mixed orders
+    def __composite__(self, key):
+        return tuple(
+            Descending(value) if descending else value
+            for value, descending in zip(key, self._descending))
+
+    # returns the keys of a solution in each level of the topk
+    def __path__(self, key):
+        if self._composite is None:
+            return key
+        return (self._composite(key),)
+
+    # iterates over the keys of a level of the topk, in the order of the key
+    def __children__(self, node, level):
+        if self._levels[level]:
+            return node.reverse_iterate()
+        return iter(node)
+
+    # returns the iterators over the levels of the topk that lead to the
+    # solution at a given position, and the position of this solution in the
+    # list of the last level
+    def __seek__(self, position):
+        stack = []
+        node = self._topk
+        for descending in self._levels:
+            position, children = node.seek(position, reverse=descending)
+            stack.append(children)
+            node = next(children).value
+        return stack, node, position
+
+    # returns the topk as an ordered list, without its first offset solutions
+    def flatten(self, offset=0):
+        if offset >= self._size:
+            return []
+        depth = len(self._levels)
+        if offset > 0:
+            stack, node, position = self.__seek__(offset)
+            solutions = node[position:]
+        else:
+            solutions = []
+            stack = [self.__children__(self._topk, 0)]
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+            elif len(stack) == depth:
+                solutions.extend(item.value)
             else:
-                for item in node:
-                    nodes.extend(self.__flatten__(item.value, key_index + 1))
-            return nodes
-        return node
+                stack.append(self.__children__(item.value, len(stack)))
+        return solutions
 
-    # returns the topk as an ordered list
-    def flatten(self):
-        return self.__flatten__(self._topk)
+    # iterates over the topk, in order, without building the whole list
+    def __iter__(self):
+        depth = len(self._levels)
+        stack = [self.__children__(self._topk, 0)]
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+            elif len(stack) == depth:
+                yield from item.value
+            else:
+                stack.append(self.__children__(item.value, len(stack)))
+
+    # iterates over the solutions of this topk and of other topk with the
+    # same keys, in order, with the index of the topk of each solution (0 for
+    # this topk). As each topk is sorted, they are merged lazily with a heap
+    # of one iterator per topk, and ties keep the order of the topk.
+    def merged(self, *topks):
+        reverse = False
+        if not any(self._descending):
+            key = None
+        elif all(self._descending):
+            key, reverse = None, True
+        else:
+            key = self.__composite__
+        sources = [
+            zip(repeat(index), topk)
+            for index, topk in enumerate((self, *topks))]
+        if key is None:
+            return heapq.merge(
+                *sources, key=lambda item: item[1].key, reverse=reverse)
+        return heapq.merge(*sources, key=lambda item: key(item[1].key))
+
+    # returns the solutions of the union of this topk and of other topk with
+    # the same keys, in order, without their first offset solutions, and up
+    # to limit solutions (the limit of this topk by default). Solutions are
+    # not inserted again, and the merge stops after limit solutions.
+    def merge(self, *topks, limit=None, offset=0):
+        if limit is None:
+            limit = self._limit
+        merged = islice(self.merged(*topks), offset, offset + limit)
+        return [solution for _, solution in merged]
 
     # returns the lowest topk solution
     def lower_bound(self):
-        node = self._topk
-        key_index = 0
-        while isinstance(node, OrderedDict):
-            if self._keys[key_index][1] == 'DESC':
-                node = node.smallest().value
-            else:
-                node = node.biggest().value
-            key_index += 1
-        return node[0]
+        if self._lower_bound is None:
+            node = self._topk
+            for descending in self._levels:
+                if descending:
+                    node = node.smallest().value
+                else:
+                    node = node.biggest().value
+            self._lower_bound = node[0]
+        return self._lower_bound
 
     # returns the highest topk solution
     def upper_bound(self):
         node = self._topk
-        key_index = 0
-        while isinstance(node, OrderedDict):
-            if self._keys[key_index][1] == 'DESC':
+        for descending in self._levels:
+            if descending:
                 node = node.biggest().value
             else:
                 node = node.smallest().value
-            key_index += 1
         return node[0]
 
-    # returns True if the solution can be added to the topk, False otherwise
-    def can_insert(self, mappings):
+    # returns the solution at a given position of the topk
+    def select(self, position):
+        if position < 0 or position >= self._size:
+            raise Exception('position should be between 0 and size of topk')
+        _, node, position = self.__seek__(position)
+        return node[position]
+
+    # returns the position that a solution with this key would take in the
+    # topk, i.e. the number of solutions before it, ties being inserted after
+    # the solutions already in the topk. The solution enters the topk only if
+    # its rank is lower than the limit.
+    def rank(self, key):
+        rank = 0
+        node = self._topk
+        for index, value in enumerate(self.__path__(key)):
+            if self._levels[index]:
+                rank += node.root.total - node.rank(value, inclusive=True)
+            else:
+                rank += node.rank(value)
+            child = node.search(node.root, value)
+            if child is node.TNULL:
+                return rank
+            node = child.value
+        return rank + len(node)
+
+    # compares two keys, i.e. returns -1 if the first one comes before the
+    # second one in the topk, 1 if it comes after, and 0 if they are equal
+    def compare(self, first, second):
+        for index, descending in enumerate(self._descending):
+            if first[index] == second[index]:
+                continue
+            before = first[index] < second[index]
+            if descending:
+                before = not before
+            return -1 if before else 1
+        return 0
+
+    # returns False if the topk cannot change anymore when the next keys are
+    # not ordered before this key on its first `prefix` values, i.e. if the
+    # topk is full and these values come after the ones of the lower bound,
+    # or if the whole key is not ordered before the lower bound
+    def can_change(self, key, prefix):
+        if self._size < self._limit:
+            return True
+        lb = self.lower_bound().key
+        for index in range(prefix):
+            if key[index] == lb[index]:
+                continue
+            before = key[index] < lb[index]
+            if self._descending[index]:
+                before = not before
+            return before
+        return prefix < len(self._descending)
+
+    # returns True if a solution with this key can be added to the topk
+    def can_insert(self, key):
         if self._size < self._limit:
             return True
-        lb = self.lower_bound()
-        for key, order in self._keys:
-            if order == 'DESC':
-                if lb[key] < mappings[key]:
+        lb = self.lower_bound().key
+        for index, descending in enumerate(self._descending):
+            if descending:
+                if lb[index] < key[index]:
                     return True
-                elif lb[key] > mappings[key]:
+                elif lb[index] > key[index]:
                     return False
-            elif order == 'ASC':
-                if lb[key] > mappings[key]:
+            else:
+                if lb[index] > key[index]:
                     return True
-                elif lb[key] < mappings[key]:
+                elif lb[index] < key[index]:
                     return False
         return False
 
     # adds a new solution to the topk
-    def __insert__(self, node, mappings, key_index=0):
-        key = self._keys[key_index][0]
-        # logging.debug(f' __insert__ : {key} - {node}')
-        if key_index == len(self._keys) - 1:
-            if mappings[key] not in node:
-                node[mappings[key]] = []
-            node[mappings[key]].append(mappings)
-        else:
-            if mappings[key] not in node:
-                node[mappings[key]] = OrderedDict()
-            self.__insert__(node[mappings[key]], mappings, key_index + 1)
-        # logging.debug(f' __insert__ : {key} - {node}')
-
-    # adds a new solution to the topk
-    def insert(self, mappings):
-        # logging.debug(f' insert : {self._size}/{self._limit} - {mappings}')
-        if self.can_insert(mappings):
-            self.__insert__(self._topk, mappings)
-            self._size += 1
-            if self._size > self._limit:
-                self.delete(self.lower_bound())
+    def __insert__(self, solution):
+        node = self._topk
+        last = len(self._levels) - 1
+        for level, value in enumerate(self.__path__(solution.key)):
+            node = node.add(
+                value, 1, list if level == last else OrderedDict).value
+        node.append(solution)
+
+    # adds a new solution that can be added to the topk, i.e. whose key was
+    # checked with can_insert, and evicts the lowest solution if needed
+    def push(self, solution):
+        self.__insert__(solution)
+        self._size += 1
+        self._lower_bound = None
+        if self._size > self._limit:
+            self.delete(self.lower_bound())
+
+    # adds a new solution to the topk, if it can be added
+    def insert(self, solution):
+        if self.can_insert(solution.key):
+            self.push(solution)
             return True
         return False
 
     # deletes a solution from the topk
-    def __delete__(self, node, mappings, key_index=0):
-        key = self._keys[key_index][0]
-        # logging.debug(f' __delete__ : {key} - {node}')
-        if key_index == len(self._keys) - 1:
-            node[mappings[key]].remove(mappings)
-        else:
-            self.__delete__(node[mappings[key]], mappings, key_index + 1)
-        if len(node[mappings[key]]) == 0:
-            node.pop(mappings[key])
-        # logging.debug(f' __delete__ : {key} - {node}')
+    def __delete__(self, solution):
+        path = []
+        node = self._topk
+        for value in self.__path__(solution.key):
+            child = node.add(value, -1)
+            path.append((node, child))
+            node = child.value
+        node.remove(solution)
+        # removes the levels that became empty, from the deepest one
+        for node, child in reversed(path):
+            if child.weight > 0:
+                break
+            node.pop(child.key)
 
     # deletes a solution from the topk
-    def delete(self, mappings):
-        # logging.debug(f' delete : {self._size}/{self._limit} - {mappings}')
-        self.__delete__(self._topk, mappings)
+    def delete(self, solution):
+        self.__delete__(solution)
         self._size -= 1
+        self._lower_bound = None
+
+    # returns a binary snapshot of the solutions of the topk
+    def snapshot(self, variables=(), keys=True):
+        return Snapshot.pack(self.flatten(), variables=variables, keys=keys)
+
+    # inserts the solutions of a snapshot in the topk, so a topk can be
+    # restored, or several snapshots merged, as only the best solutions are
+    # kept. Returns the variables of the snapshot.
+    def restore(self, data):
+        variables, solutions = Snapshot.unpack(data)
+        for solution in solutions:
+            if solution.key is None:
+                raise Exception("The snapshot does not store the keys...")
+            self.insert(solution)
+        return variables
 
     def pop(self):
         if self._size == 0:
             raise Exception("Dictionary empty")
-        mappings = self.upper_bound()
-        self.delete(mappings)
-        return mappings
+        solution = self.upper_bound()
+        self.delete(solution)
+        return solution
 
 
 if __name__ == "__main__":
     keys = [('__o1', 'ASC'), ('__o2', 'DESC'), ('__o3', 'ASC')]
     topk = TOPKStruct(keys, limit=3)
-
-    print(topk.insert({'__o1': 1, '__o2': 20, '__o3': 100, '?x': "A"}))
-    print(topk.insert({'__o1': 1, '__o2': 20, '__o3': 200, '?x': "A"}))
-    print(topk.insert({'__o1': 1, '__o2': 40, '__o3': 200, '?x': "A"}))
-    print(topk.insert({'__o1': 2, '__o2': 40, '__o3': 400, '?x': "B"}))
-    print(topk.insert({'__o1': 2, '__o2': 30, '__o3': 100, '?x': "A"}))
+    schema = Schema(excluded=[key for key, _ in keys])
+
+    def solution(mappings):
+        key = tuple(mappings[name] for name, _ in keys)
+        return Solution(key, schema.encode(mappings))
+
+    for mappings in [
+        {'__o1': 1, '__o2': 20, '__o3': 100, '?x': "A"},
+        {'__o1': 1, '__o2': 20, '__o3': 200, '?x': "A"},
+        {'__o1': 1, '__o2': 40, '__o3': 200, '?x': "A"},
+        {'__o1': 2, '__o2': 40, '__o3': 400, '?x': "B"},
+        {'__o1': 2, '__o2': 30, '__o3': 100, '?x': "A"}
+    ]:
+        print(topk.insert(solution(mappings)))
     print(topk.flatten())
     print(len(topk))
 
     print(f'lower bound: {topk.lower_bound()}')
+    print(f'rank of (1, 30, 0): {topk.rank((1, 30, 0))}')
+    print(f'second solution: {topk.select(1)}')
 
     print(f'upper bound: {topk.upper_bound()}')
     print(topk.pop())
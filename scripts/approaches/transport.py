@@ -0,0 +1,507 @@
+import json
+import logging
+import random
+import struct
+import threading
+import time
+import zlib
+import requests
+
+from abc import ABC, abstractmethod
+from typing import Any, BinaryIO, Dict, List, Optional
+
+
+class Transport(ABC):
+    """
+    This class defines how the SaGe approaches send requests to a SaGe server.
+    A request is the JSON payload of a quantum, and its response is the raw
+    JSON body sent back by the server, so that decoding stays on the client
+    side.
+    """
+
+    @abstractmethod
+    def post(self, data: str) -> bytes:
+        """
+        Sends a request to the server.
+
+        Parameters
+        ----------
+        data: str
+            The JSON payload of the request.
+
+        Returns
+        -------
+        bytes
+            The JSON body of the response.
+        """
+        pass
+
+    @property
+    def replicas(self) -> int:
+        """
+        The number of servers to which requests can be sent.
+        """
+        return 1
+
+    def close(self) -> None:
+        pass
+
+
+class HTTPTransport(Transport):
+    """
+    This class sends requests to a SaGe server over HTTP. Connections are kept
+    alive between requests. As requests.Session is not thread-safe, each
+    thread that sends requests, e.g. each partition of a query, uses its own
+    session.
+
+    Parameters
+    ----------
+    url: str
+        The URL of the SaGe server.
+    """
+
+    HEADERS = {
+        "accept": "text/html",
+        "content-type": "application/json"}
+
+    def __init__(self, url: str) -> None:
+        self._url = url
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    def __session__(self) -> requests.Session:
+        """
+        Returns the session of the current thread, created on its first
+        request.
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def post(self, data: str) -> bytes:
+        response = self.__session__().post(
+            self._url, headers=HTTPTransport.HEADERS, data=data)
+        response.raise_for_status()
+        return response.content
+
+    def close(self) -> None:
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+        self._local = threading.local()
+
+
+class BalancedTransport(Transport):
+    """
+    This class spreads requests over several replicas of a SaGe server, i.e.
+    servers that host the same dataset. As stateless saved plans are sent
+    back to the client, any replica can resume any quantum, so the replica is
+    chosen for each request. If a replica fails, the request is sent to the
+    next one, and the failed replica is not chosen again for some time.
+
+    Parameters
+    ----------
+    transports: List[HTTPTransport]
+        The transports used to send requests to each replica.
+    policy: str - (default = "round-robin")
+        How replicas are chosen, "round-robin", "least-latency" to choose the
+        replica with the lowest average latency, or "power-of-two" to choose
+        the best of two random replicas given their latencies and pending
+        requests.
+    cooldown: float - (default = 5.0)
+        The time during which a failed replica is not chosen (seconds).
+    seed: None | int - (default = None)
+        The seed of the random choices of the "power-of-two" policy.
+    """
+
+    POLICIES = ["round-robin", "least-latency", "power-of-two"]
+
+    # the weight of the last latency in the moving average of latencies
+    ALPHA = 0.3
+
+    def __init__(
+        self, transports: List[HTTPTransport], policy: str = "round-robin",
+        cooldown: float = 5.0, seed: Optional[int] = None
+    ) -> None:
+        if len(transports) == 0:
+            raise Exception("At least one replica is required...")
+        if policy not in BalancedTransport.POLICIES:
+            raise Exception(f"The balancing policy {policy} does not exist...")
+        self._transports = transports
+        self._policy = policy
+        self._cooldown = cooldown
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cursor = 0
+        self._latencies = [0.0] * len(transports)
+        self._pending = [0] * len(transports)
+        self._failed_until = [0.0] * len(transports)
+        self._requests = [0] * len(transports)
+        self._failures = [0] * len(transports)
+
+    @property
+    def replicas(self) -> int:
+        return len(self._transports)
+
+    def __choose__(self, excluded: List[int]) -> int:
+        """
+        Chooses the replica to which the next request is sent, among the
+        replicas that have not failed recently. If all of them have failed,
+        they are all considered again, except the ones already tried for this
+        request.
+        """
+        now = time.monotonic()
+        candidates = [
+            index for index in range(len(self._transports))
+            if index not in excluded and self._failed_until[index] <= now]
+        if len(candidates) == 0:
+            candidates = [
+                index for index in range(len(self._transports))
+                if index not in excluded]
+        if self._policy == "round-robin":
+            index = min(
+                candidates,
+                key=lambda i: (i - self._cursor) % len(self._transports))
+            self._cursor = index + 1
+            return index
+        elif self._policy == "least-latency":
+            return min(candidates, key=lambda i: self._latencies[i])
+        sample = self._random.sample(candidates, min(2, len(candidates)))
+        return min(
+            sample, key=lambda i: self._latencies[i] * (self._pending[i] + 1))
+
+    def post(self, data: str) -> bytes:
+        excluded = []
+        while True:
+            with self._lock:
+                index = self.__choose__(excluded)
+                self._pending[index] += 1
+                self._requests[index] += 1
+            start_time = time.perf_counter()
+            try:
+                response = self._transports[index].post(data)
+            except requests.RequestException as error:
+                if isinstance(error, requests.HTTPError) and (
+                    error.response.status_code < 500
+                ):  # the request is invalid, whatever the replica
+                    with self._lock:
+                        self._pending[index] -= 1
+                    raise error
+                with self._lock:
+                    self._pending[index] -= 1
+                    self._failures[index] += 1
+                    self._failed_until[index] = (
+                        time.monotonic() + self._cooldown)
+                excluded.append(index)
+                url = self._transports[index].url
+                if len(excluded) == len(self._transports):
+                    logging.error(f"balancing - all replicas failed: {error}")
+                    raise error
+                logging.warning(f"balancing - {url} failed: {error}")
+                continue
+            elapsed_time = time.perf_counter() - start_time
+            with self._lock:
+                self._pending[index] -= 1
+                self._latencies[index] = elapsed_time if (
+                    self._latencies[index] == 0.0
+                ) else (
+                    BalancedTransport.ALPHA * elapsed_time
+                    + (1 - BalancedTransport.ALPHA) * self._latencies[index])
+            return response
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """
+        Returns, for each replica, the number of requests sent to it, the
+        number of failed requests, and its average latency (ms).
+        """
+        return [
+            {"url": transport.url,
+             "requests": self._requests[index],
+             "failures": self._failures[index],
+             "latency": self._latencies[index] * 1000}
+            for index, transport in enumerate(self._transports)]
+
+    def close(self) -> None:
+        for replica in self.stats():
+            logging.info((
+                f"balancing - {replica['url']}: {replica['requests']} "
+                f"requests, {replica['failures']} failures, "
+                f"{replica['latency']:.2f} ms"))
+        for transport in self._transports:
+            transport.close()
+
+
+class RetryingTransport(Transport):
+    """
+    This class retries the requests that fail because of transient errors,
+    i.e. connection errors, server errors (5xx) and responses that are not
+    JSON documents, with an exponential backoff. As stateless saved plans are
+    sent back to the client, sending a quantum again does not change the
+    result of the query. A saved plan stored by the server is removed once
+    it is resumed, so the quanta that resume one are not retried.
+
+    Parameters
+    ----------
+    transport: Transport
+        The transport used to send requests.
+    retries: int - (default = 3)
+        The maximum number of retries of a request.
+    backoff: float - (default = 0.5)
+        The time to wait before the first retry (seconds). It doubles after
+        each retry, up to 30 seconds, with a random jitter.
+    """
+
+    # the maximum time to wait before a retry (seconds)
+    MAX_BACKOFF = 30.0
+
+    def __init__(
+        self, transport: Transport, retries: int = 3, backoff: float = 0.5
+    ) -> None:
+        self._transport = transport
+        self._retries = retries
+        self._backoff = backoff
+        self._random = random.Random()
+
+    @property
+    def replicas(self) -> int:
+        return self._transport.replicas
+
+    def __send__(self, data: str) -> bytes:
+        """
+        Sends a request, and raises an exception if the response is not a
+        JSON document, e.g. the error page of a proxy.
+        """
+        response = self._transport.post(data)
+        if response.lstrip()[:1] != b"{":
+            raise Exception(
+                f"The response is not a JSON document: {response[:64]!r}...")
+        return response
+
+    def __stateful__(self, data: str) -> bool:
+        """
+        Returns True if a request resumes a saved plan stored by the server,
+        which the failed request may have removed.
+        """
+        payload = json.loads(data)
+        return payload.get("next") is not None and (
+            not payload.get("stateless", True))
+
+    def post(self, data: str) -> bytes:
+        attempt = 0
+        while True:
+            try:
+                return self.__send__(data)
+            except Exception as error:
+                if isinstance(error, requests.HTTPError) and (
+                    error.response.status_code < 500
+                ):  # the request is invalid, retrying it is useless
+                    raise error
+                if self.__stateful__(data):
+                    logging.error((
+                        f"retry - the request failed: {error}, and it "
+                        f"resumes a saved plan stored by the server"))
+                    raise error
+                if attempt == self._retries:
+                    logging.error(f"retry - the request failed: {error}")
+                    raise error
+                delay = min(
+                    self._backoff * 2 ** attempt,
+                    RetryingTransport.MAX_BACKOFF)
+                delay = self._random.uniform(delay / 2, delay)
+                attempt += 1
+                logging.warning((
+                    f"retry - {error}, retrying in {delay:.2f} seconds "
+                    f"({attempt}/{self._retries})"))
+                time.sleep(delay)
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class Trace():
+    """
+    This class reads and writes traces of SaGe requests. A trace starts with a
+    magic number, followed by one frame per request. A frame is made of a
+    header, i.e. the time spent waiting for the response (seconds) and the
+    sizes of the compressed request and response, followed by the request and
+    the response compressed with zlib.
+    """
+
+    MAGIC = b"SAGETRC1"
+    HEADER = struct.Struct(">dII")
+
+    @staticmethod
+    def write_header(writer: BinaryIO) -> None:
+        writer.write(Trace.MAGIC)
+
+    @staticmethod
+    def read_header(reader: BinaryIO) -> None:
+        if reader.read(len(Trace.MAGIC)) != Trace.MAGIC:
+            raise Exception("The file is not a trace of SaGe requests...")
+
+    @staticmethod
+    def write_frame(
+        writer: BinaryIO, elapsed_time: float, request: bytes, response: bytes
+    ) -> None:
+        request = zlib.compress(request)
+        response = zlib.compress(response)
+        writer.write(Trace.HEADER.pack(
+            elapsed_time, len(request), len(response)))
+        writer.write(request)
+        writer.write(response)
+
+    @staticmethod
+    def read_frame(reader: BinaryIO) -> Optional[Dict[str, Any]]:
+        header = reader.read(Trace.HEADER.size)
+        if len(header) < Trace.HEADER.size:
+            return None
+        elapsed_time, request_size, response_size = Trace.HEADER.unpack(
+            header)
+        request = zlib.decompress(reader.read(request_size))
+        response = zlib.decompress(reader.read(response_size))
+        return {
+            "elapsed_time": elapsed_time,
+            "request": request,
+            "response": response}
+
+
+class RecordingTransport(Transport):
+    """
+    This class records all the requests sent through a transport, with their
+    responses, in a trace file. As requests can be sent concurrently, e.g. by
+    the partitions of a query, frames are written under a lock, so that they
+    do not interleave.
+
+    Parameters
+    ----------
+    transport: Transport
+        The transport used to send requests.
+    path: str
+        The path to the trace file.
+    """
+
+    def __init__(self, transport: Transport, path: str) -> None:
+        self._transport = transport
+        self._writer = open(path, "wb")
+        self._lock = threading.Lock()
+        Trace.write_header(self._writer)
+
+    @property
+    def replicas(self) -> int:
+        return self._transport.replicas
+
+    def post(self, data: str) -> bytes:
+        start_time = time.perf_counter()
+        response = self._transport.post(data)
+        elapsed_time = time.perf_counter() - start_time
+        with self._lock:
+            Trace.write_frame(
+                self._writer, elapsed_time, data.encode("utf-8"), response)
+        return response
+
+    def close(self) -> None:
+        self._transport.close()
+        with self._lock:
+            self._writer.close()
+
+
+class ReplayTransport(Transport):
+    """
+    This class replays the responses recorded in a trace file, in the order
+    of the trace. As the client is deterministic, it sends the same requests
+    as when the trace was recorded, except for the wall time.
+
+    Parameters
+    ----------
+    path: str
+        The path to the trace file.
+    timing: str - (default = "fast")
+        "fast" to send the responses back immediately, or "original" to wait
+        as long as the server did when the trace was recorded.
+    """
+
+    def __init__(self, path: str, timing: str = "fast") -> None:
+        if timing not in ["fast", "original"]:
+            raise Exception(f"The timing {timing} does not exist...")
+        self._timing = timing
+        self._reader = open(path, "rb")
+        Trace.read_header(self._reader)
+
+    def post(self, data: str) -> bytes:
+        frame = Trace.read_frame(self._reader)
+        if frame is None:
+            raise Exception("The trace does not contain more requests...")
+        recorded = json.loads(frame["request"])
+        if recorded["query"] != json.loads(data)["query"]:
+            raise Exception("The request does not match the trace...")
+        if recorded != json.loads(data):
+            logging.warning("replay - the request differs from the trace")
+        if self._timing == "original":
+            time.sleep(frame["elapsed_time"])
+        return frame["response"]
+
+    def close(self) -> None:
+        self._reader.close()
+
+
+def create_transport(
+    url: str, record: Optional[str] = None, replay: Optional[str] = None,
+    timing: str = "fast", replicas: Optional[List[str]] = None,
+    balancing: str = "round-robin", retries: int = 0, backoff: float = 0.5
+) -> Transport:
+    """
+    Creates the transport used by the SaGe approaches.
+
+    Parameters
+    ----------
+    url: str
+        The URL of the SaGe server.
+    record: None | str - (default = None)
+        The path to a trace file in which requests are recorded.
+    replay: None | str - (default = None)
+        The path to a trace file from which responses are replayed. If
+        defined, no request is sent to the server.
+    timing: str - (default = "fast")
+        The timing used to replay responses, "fast" or "original".
+    replicas: None | List[str] - (default = None)
+        The URLs of the replicas of the SaGe server. If several replicas are
+        defined, requests are spread over them instead of being sent to url.
+    balancing: str - (default = "round-robin")
+        How requests are spread over the replicas, see BalancedTransport.
+    retries: int - (default = 0)
+        The maximum number of retries of a request that fails because of a
+        transient error, see RetryingTransport.
+    backoff: float - (default = 0.5)
+        The time to wait before the first retry of a request (seconds).
+
+    Returns
+    -------
+    Transport
+        The transport used by the SaGe approaches.
+    """
+    if replay is not None:
+        return ReplayTransport(replay, timing=timing)
+    if replicas is None or len(replicas) == 0:
+        replicas = [url]
+    if len(replicas) > 1:
+        transport = BalancedTransport(
+            [HTTPTransport(replica) for replica in replicas],
+            policy=balancing)
+    else:
+        transport = HTTPTransport(replicas[0])
+    if retries > 0:
+        transport = RetryingTransport(
+            transport, retries=retries, backoff=backoff)
+    if record is not None:
+        return RecordingTransport(transport, record)
+    return transport
@@ -1,10 +1,13 @@
 import logging
 import time
-import json
-import sys
+import csv
+import io
+import re
+import requests
 
-from typing import Dict, Any, List
-from SPARQLWrapper import SPARQLWrapper, JSON
+from typing import Dict, Any, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 from approaches.approach import Approach
 from spy import Spy
@@ -14,6 +17,12 @@ class Virtuoso(Approach):
     """
     This class executes SPARQL TOP-K queries against the Virtuoso endpoint.
 
+    All queries go through a single keep-alive HTTP session whose connection
+    pool is sized to the number of workers, so that batches of queries can be
+    executed concurrently without opening a new connection per query. Queries
+    are prepared once: the rewritten query and its ORDER BY variables are
+    cached and reused for every limit.
+
     Parameters
     ----------
     name: str
@@ -22,16 +31,139 @@ class Virtuoso(Approach):
     config: Dict[str, Any]
         The configuration file of the experimental study. It is used to
         retrieve the URL of the endpoint and the name of the RDF graph.
+    format: str - (default = "json")
+        The format of the query results sent by Virtuoso. Accepted values are
+        "json", "csv" or "tsv". CSV and TSV results are much more compact
+        than JSON results.
+    workers: int - (default = 4)
+        The maximum number of queries executed concurrently by
+        `execute_batch`.
     """
 
+    FORMATS = {
+        "json": "application/sparql-results+json",
+        "csv": "text/csv",
+        "tsv": "text/tab-separated-values"}
+
+    ESCAPES = {"n": "\n", "r": "\r", "t": "\t"}
+
     def __init__(self, name: str, config: Dict[str, Any], **kwargs) -> None:
         super().__init__(name)
         self._endpoint = config["endpoints"]["virtuoso"]["url"]
         self._graph = config["endpoints"]["virtuoso"]["graph"]
+        self._format = kwargs.get("format", "json")
+        self._workers = kwargs.get("workers", 4)
+        if self._format not in Virtuoso.FORMATS:
+            raise Exception(f"The format {self._format} is not supported...")
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(self._workers, 1))
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._resources.append(self._session)
+        self._templates = dict()
 
     def __insert_force_order_pragma__(self, query: str) -> str:
         return f'DEFINE sql:select-option "order" {query}'
 
+    def __prepare__(
+        self, query: str, force_order: bool = False
+    ) -> Tuple[str, List[str]]:
+        """
+        Prepares a SPARQL TOP-K query for its execution on Virtuoso. Prepared
+        queries are cached, so parsing the query to retrieve its ORDER BY
+        variables is only done once whatever the number of executions.
+
+        Parameters
+        ----------
+        query: str
+            A SPARQL TOP-K query.
+        force_order: bool - (default = False)
+            True to force Virtuoso to follow the join order of the query,
+            False otherwise.
+
+        Returns
+        -------
+        Tuple[str, List[str]]
+            The query template to which a LIMIT clause can be appended, and
+            the variables that appear in its ORDER BY clause.
+        """
+        if (query, force_order) not in self._templates:
+            orderby_variables = self.__get_orderby_variables__(query)
+            template = query
+            if force_order:
+                template = self.__insert_force_order_pragma__(template)
+            template = self.__set_projection__(template, ["*"])
+            self._templates[(query, force_order)] = (
+                template, orderby_variables)
+        return self._templates[(query, force_order)]
+
+    def __parse_tsv_term__(self, term: str) -> str:
+        """
+        Extracts the value of an RDF term serialized in the N-Triples format,
+        as done by the SPARQL TSV results format.
+
+        Parameters
+        ----------
+        term: str
+            An RDF term in the N-Triples format.
+
+        Returns
+        -------
+        str
+            The lexical form of a literal, the IRI of an IRI, or the term
+            itself for blank nodes and numbers.
+        """
+        if term.startswith("<") and term.endswith(">"):
+            return term[1:-1]
+        elif term.startswith('"'):
+            index = term.rfind('"')
+            return re.sub(
+                r"\\(.)",
+                lambda match: Virtuoso.ESCAPES.get(
+                    match.group(1), match.group(1)),
+                term[1:index])
+        return term
+
+    def __parse_results__(self, response: requests.Response) -> List[Dict]:
+        """
+        Decodes the results of a query according to the requested format.
+
+        Parameters
+        ----------
+        response: requests.Response
+            The response sent by Virtuoso.
+
+        Returns
+        -------
+        List[Dict]
+            The solutions mappings of the query as dictionaries that associate
+            variables (without the leading "?") to the value of RDF terms.
+        """
+        if self._format == "json":
+            bindings = list()
+            for mappings in response.json()["results"]["bindings"]:
+                bindings.append({
+                    key: value["value"] for key, value in mappings.items()})
+            return bindings
+        text = response.content.decode("utf-8")
+        if self._format == "csv":
+            rows = csv.reader(io.StringIO(text))
+            header = next(rows, [])
+            return [
+                {key: value for key, value in zip(header, row) if value != ""}
+                for row in rows]
+        rows = text.split("\n")
+        header = [variable[1:] for variable in rows[0].split("\t")]
+        bindings = list()
+        for row in rows[1:]:
+            if row == "":
+                continue
+            bindings.append({
+                key: self.__parse_tsv_term__(term)
+                for key, term in zip(header, row.split("\t")) if term != ""})
+        return bindings
+
     def execute_query(
         self, query: str, spy: Spy, **kwargs
     ) -> List[Dict[str, str]]:
@@ -52,37 +184,81 @@ class Virtuoso(Approach):
         """
         limit = kwargs.setdefault("limit", 10)
         force_order = kwargs.setdefault("force_order", False)
+        offset = kwargs.setdefault("offset", None)
+        continuation = kwargs.setdefault("continuation", None)
 
-        orderby_variables = self.__get_orderby_variables__(query)
+        if limit == 0:
+            limit = self.__extract_limit__(query)
+        if offset is None:
+            offset = self.__extract_offset__(query)
+        position, _, _ = self.__resume_page__(continuation, offset)
 
-        if force_order:
-            query = self.__insert_force_order_pragma__(query)
-        query = self.__set_projection__(query, ["*"])
-        query = self.__set_limit__(query, limit=limit)
+        template, orderby_variables = self.__prepare__(query, force_order)
+        query = self.__set_limit__(template, limit=limit, offset=position)
 
         logging.info(f"{self.name} - query sent to the server:\n{query}")
         logging.info(f"{self.name} - limit = {limit}")
+        logging.info(f"{self.name} - offset = {position}")
 
-        sparql = SPARQLWrapper(self._endpoint)
-        sparql.setQuery(query)
-        sparql.addDefaultGraph(self._graph)
-        sparql.setReturnFormat(JSON)
+        headers = {"accept": Virtuoso.FORMATS[self._format]}
+        data = {"query": query, "default-graph-uri": self._graph}
 
-        start_time = time.time()
-        response = sparql.queryAndConvert()
-        elapsed_time = time.time() - start_time
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        with spy.measure("http_time"):
+            response = self._session.post(
+                self._endpoint, headers=headers, data=data)
+            response.raise_for_status()
+        with spy.measure("decode_time"):
+            bindings = self.__parse_results__(response)
+        elapsed_time = (time.perf_counter() - start) * 1000
 
         spy.report_http_calls(1)
-        spy.report_data_transfer(sys.getsizeof(json.dumps(response)))
+        spy.report_data_transfer(
+            len(response.request.body or "") + len(response.content))
         spy.report_execution_time(elapsed_time)
-        spy.report_solutions(len(response["results"]["bindings"]))
+        spy.report_cpu_time((time.process_time() - start_cpu) * 1000)
+        spy.report_solutions(len(bindings))
+        spy.report_continuation(
+            self.__next_page__(position, len(bindings), limit))
 
         solutions = []
-        for mappings in sparql.queryAndConvert()["results"]["bindings"]:
+        for mappings in bindings:
             solution = {}
             for key in mappings:
                 # to make the validation easier
                 if f"?{key}" in orderby_variables:
-                    solution[f"?{key}"] = str(mappings[key]["value"])
+                    solution[f"?{key}"] = str(mappings[key])
             solutions.append(solution)
         return solutions
+
+    def execute_batch(
+        self, queries: List[Tuple[str, Dict[str, Any]]]
+    ) -> List[Tuple[List[Dict[str, str]], Spy]]:
+        """
+        Executes a batch of SPARQL TOP-K queries against the Virtuoso endpoint.
+        At most `workers` queries are executed concurrently.
+
+        Parameters
+        ----------
+        queries: List[Tuple[str, Dict[str, Any]]]
+            The queries to execute, each one with the keyword arguments to
+            pass to `execute_query` (e.g. the limit).
+
+        Returns
+        -------
+        List[Tuple[List[Dict[str, str]], Spy]]
+            For each query, in the same order, its result and the statistics
+            collected during its execution.
+        """
+        # the SPARQL parser is not thread-safe, queries are prepared first
+        for query, kwargs in queries:
+            self.__prepare__(query, kwargs.get("force_order", False))
+
+        def execute(job: Tuple[str, Dict[str, Any]]):
+            query, kwargs = job
+            spy = Spy()
+            return self.execute_query(query, spy, **kwargs), spy
+
+        with ThreadPoolExecutor(max_workers=max(self._workers, 1)) as pool:
+            return list(pool.map(execute, queries))
@@ -0,0 +1,308 @@
+import csv
+import json
+import math
+import time
+import logging
+
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from spy import Spy
+from profiler import create_profiler
+from approaches.factory import ApproachFactory
+
+
+# the columns of a benchmark report, in the order of the CSV file
+COLUMNS = [
+    "approach", "queries", "repetitions", "concurrency", "executions",
+    "errors", "wall_time", "qps", "latency_mean", "latency_p50",
+    "latency_p95", "latency_p99", "latency_max", "bytes_per_query",
+    "http_calls_per_query", "cpu_time", "cpu_time_per_query"]
+
+# the state of a benchmark worker, initialized once per process
+_context = dict()
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Computes a percentile with a linear interpolation between the closest
+    ranks, i.e. as numpy.percentile does by default.
+
+    Parameters
+    ----------
+    values: List[float]
+        The values, in any order.
+    p: float
+        The percentile to compute, between 0 and 100.
+
+    Returns
+    -------
+    float
+        The p-th percentile of the values, or NaN if there are no values.
+    """
+    if len(values) == 0:
+        return math.nan
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def init_worker(
+    config: Dict[str, Any], options: Dict[str, Any],
+    profile: Optional[str] = None, profile_dir: str = "profiles"
+) -> None:
+    _context["config"] = config
+    _context["options"] = options
+    _context["engines"] = dict()
+    _context["profile"] = profile
+    _context["profile_dir"] = profile_dir
+    _context["profilers"] = dict()
+
+
+def init_pool_worker(
+    config: Dict[str, Any], options: Dict[str, Any]
+) -> None:
+    """
+    Initializes a worker process of the pool of a benchmark. The approaches
+    of the worker are closed when the pool is closed: as workers exit without
+    running atexit handlers, they are closed by a finalizer of
+    multiprocessing, which workers run before exiting.
+    """
+    init_worker(config, options)
+    Finalize(None, close_engines, exitpriority=10)
+
+
+def close_engines() -> None:
+    """
+    Closes the approaches created by `execute` in this process, e.g. to stop
+    their worker processes.
+    """
+    for engine in _context.get("engines", {}).values():
+        engine.close()
+    _context["engines"] = dict()
+
+
+def execute(task: Tuple[str, str, str, bool]) -> Dict[str, Any]:
+    """
+    Executes a query with an approach, and measures its latency and the CPU
+    time spent by the client. If profiling is enabled, measured executions
+    are profiled, and the profiles of all the executions of a query are
+    accumulated in {profile_dir}/{approach}/{query}.
+
+    Parameters
+    ----------
+    task: Tuple[str, str, str, bool]
+        The approach, the name of the query, the query, and True if the
+        execution is measured, False if it is part of the warmup.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The measures of the execution.
+    """
+    approach, name, query, measured = task
+    engines = _context["engines"]
+    if approach not in engines:
+        engines[approach] = ApproachFactory.create(
+            approach, _context["config"])
+    profiler = None
+    if measured and _context["profile"] is not None:
+        profiler = _context["profilers"].setdefault(
+            (approach, name), create_profiler(_context["profile"]))
+    spy = Spy()
+    error = None
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    try:
+        if profiler is None:
+            engines[approach].execute_query(
+                query, spy, **_context["options"])
+        else:
+            with profiler:
+                engines[approach].execute_query(
+                    query, spy, **_context["options"])
+    except Exception as e:
+        logging.warning(f"{approach} - {name} failed: {e}")
+        error = str(e)
+    latency = (time.perf_counter() - start) * 1000
+    cpu_time = (time.process_time() - start_cpu) * 1000
+    if profiler is not None:
+        profiler.dump(f"{_context['profile_dir']}/{approach}/{name}")
+    return {
+        "approach": approach,
+        "query": name,
+        "latency": latency,
+        "cpu_time": cpu_time,
+        "data_transfer": spy.data_transfer,
+        "http_calls": spy.http_calls,
+        **spy.timers,
+        "error": error}
+
+
+def summarize(
+    approach: str, measures: List[Dict[str, Any]], wall_time: float,
+    queries: int, repetitions: int, concurrency: int
+) -> Dict[str, Any]:
+    """
+    Aggregates the measures of the executions of an approach.
+
+    Parameters
+    ----------
+    approach: str
+        The name of the approach.
+    measures: List[Dict[str, Any]]
+        The measures of each execution, as returned by `execute`.
+    wall_time: float
+        The time spent executing all the queries (ms).
+    queries: int
+        The number of queries of the workload.
+    repetitions: int
+        The number of times each query was executed.
+    concurrency: int
+        The number of queries executed at the same time.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The report of the approach, whose keys are the COLUMNS.
+    """
+    succeeded = [measure for measure in measures if measure["error"] is None]
+    latencies = [measure["latency"] for measure in succeeded]
+    cpu_time = sum(measure["cpu_time"] for measure in measures)
+    executions = max(len(succeeded), 1)
+    return {
+        "approach": approach,
+        "queries": queries,
+        "repetitions": repetitions,
+        "concurrency": concurrency,
+        "executions": len(measures),
+        "errors": len(measures) - len(succeeded),
+        "wall_time": wall_time,
+        "qps": len(succeeded) / (wall_time / 1000) if wall_time > 0 else 0,
+        "latency_mean": sum(latencies) / executions,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies, default=math.nan),
+        "bytes_per_query": sum(
+            measure["data_transfer"] for measure in succeeded) / executions,
+        "http_calls_per_query": sum(
+            measure["http_calls"] for measure in succeeded) / executions,
+        "cpu_time": cpu_time,
+        "cpu_time_per_query": cpu_time / max(len(measures), 1)}
+
+
+def run_benchmark(
+    approaches: List[str], queries: List[Tuple[str, str]],
+    config: Dict[str, Any], options: Dict[str, Any], warmup: int = 1,
+    repetitions: int = 5, concurrency: int = 1,
+    profile: Optional[str] = None, profile_dir: str = "profiles"
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Benchmarks approaches on a workload. For each approach, all the queries
+    are first executed `warmup` times, then `repetitions` times while being
+    measured. Up to `concurrency` queries are executed at the same time, each
+    one in its own process, so that the CPU time of each query is measured
+    separately.
+
+    Parameters
+    ----------
+    approaches: List[str]
+        The approaches to benchmark.
+    queries: List[Tuple[str, str]]
+        The name and the text of each query of the workload.
+    config: Dict[str, Any]
+        The configuration file of the experimental study.
+    options: Dict[str, Any]
+        The parameters given to `execute_query`, e.g. limit or quota.
+    warmup: int - (default = 1)
+        The number of times each query is executed before measures.
+    repetitions: int - (default = 5)
+        The number of times each query is executed while being measured.
+    concurrency: int - (default = 1)
+        The number of queries executed at the same time.
+    profile: None | str - (default = None)
+        The profiler used during measures, i.e. "cprofile" or "sampling", or
+        None to disable profiling. Profiling requires a concurrency of 1.
+    profile_dir: str - (default = "profiles")
+        The directory in which profiles are saved.
+
+    Returns
+    -------
+    Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]
+        The report of each approach, and the measures of each execution.
+    """
+    if profile is not None and concurrency > 1:
+        raise Exception("Profiling requires a concurrency of 1...")
+    reports = list()
+    executions = list()
+    if concurrency > 1:
+        pool = Pool(
+            concurrency, initializer=init_pool_worker,
+            initargs=(config, options))
+        run = pool.imap_unordered
+    else:
+        pool = None
+        init_worker(config, options, profile=profile, profile_dir=profile_dir)
+        run = map
+    try:
+        for approach in approaches:
+            tasks = [(approach, name, query) for name, query in queries]
+            for _ in run(execute, [(*task, False) for task in tasks] * warmup):
+                pass
+            start = time.perf_counter()
+            measures = list(run(
+                execute, [(*task, True) for task in tasks] * repetitions))
+            wall_time = (time.perf_counter() - start) * 1000
+            reports.append(summarize(
+                approach, measures, wall_time, len(queries), repetitions,
+                concurrency))
+            executions.extend(measures)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        else:
+            close_engines()
+    return reports, executions
+
+
+def save_report(
+    reports: Iterable[Dict[str, Any]], metadata: Dict[str, Any], output: str,
+    format: str = "json"
+) -> None:
+    """
+    Saves a benchmark report. The JSON format contains the metadata of the
+    benchmark and one object per approach, while the CSV format contains one
+    row per approach, whose columns are always in the same order.
+
+    Parameters
+    ----------
+    reports: Iterable[Dict[str, Any]]
+        The report of each approach, as returned by `summarize`.
+    metadata: Dict[str, Any]
+        The parameters of the benchmark.
+    output: str
+        The path to the report.
+    format: str - (default = "json")
+        The format of the report, "json" or "csv".
+    """
+    if format == "csv":
+        with open(output, "w", newline="") as writer:
+            csv_writer = csv.DictWriter(writer, fieldnames=COLUMNS)
+            csv_writer.writeheader()
+            csv_writer.writerows(reports)
+    else:
+        reports = [
+            {
+                key: None if isinstance(value, float) and math.isnan(value)
+                else value for key, value in report.items()
+            } for report in reports]
+        with open(output, "w") as writer:
+            json.dump({
+                "metadata": metadata,
+                "approaches": reports
+            }, writer, indent=4)
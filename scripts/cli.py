@@ -6,14 +6,26 @@ import os
 import re
 import glob
 import logging
-import hashlib
+import platform
+import threading
 import urllib.parse
 
+from contextlib import ExitStack
 from pandas import DataFrame
+from datetime import datetime, timezone
+from multiprocessing import Pool
 from typing import Tuple, List
 
 from spy import Spy
+from benchmark import run_benchmark, save_report
+from profiler import create_profiler
+from validation import compare_files, list_checks, get_orderby_variables
 from approaches.factory import ApproachFactory
+from approaches.checkpoint import Checkpoint
+from approaches.transport import create_transport
+from standin.dataset import generate_watdiv
+from standin.engine import StandInEngine
+from standin.server import StandInServer
 
 
 ###############################################################################
@@ -74,6 +86,15 @@ def cli():
     "--approach", type=click.Choice(ApproachFactory.types()), default="sage")
 @click.option(
     "--limit", type=click.INT, default=0)
+@click.option(
+    "--offset", type=click.INT, default=None,
+    help=(
+        "The number of solutions to skip, by default the OFFSET of the query."
+        " With a continuation, the solutions to skip after the previous page."
+    ))
+@click.option(
+    "--continuation", type=click.STRING, default=None,
+    help="The token returned with the previous page, to get the next one.")
 @click.option(
     "--max-limit", type=click.INT, default=10000)
 @click.option(
@@ -84,15 +105,79 @@ def cli():
     "--stateless", type=click.BOOL, default=True)
 @click.option(
     "--force-order/--default-ordering", default=False)
+@click.option(
+    "--layout", type=click.Choice(["nested", "flat"]), default="nested",
+    help="The layout of the client-side TOP-K data structure.")
+@click.option(
+    "--seeds", type=click.Path(exists=False, dir_okay=False), default=None,
+    help=(
+        "Seeds the threshold of sage-partial-topk with the thresholds of "
+        "previous executions, saved in this JSON file."))
+@click.option(
+    "--partitions", type=click.INT, default=4,
+    help="The number of partitions of sage-partitioned-topk.")
+@click.option(
+    "--eval-workers", type=click.INT, default=0,
+    help=(
+        "The number of processes that evaluate the ORDER BY expressions of "
+        "the sage approach, 0 to evaluate them in process."))
+@click.option(
+    "--eval-batch", type=click.INT, default=512,
+    help=(
+        "The number of solutions per batch evaluated by a process. Smaller "
+        "pages are evaluated in process."))
 @click.option(
     "--stats", type=click.Path(exists=False), default=None)
 @click.option(
     "--output", type=click.Path(exists=False), default=None)
+@click.option(
+    "--record", type=click.Path(exists=False, dir_okay=False), default=None,
+    help="Records the requests sent to the SaGe server in a trace file.")
+@click.option(
+    "--replay", type=click.Path(exists=True, dir_okay=False), default=None,
+    help="Replays the responses of a trace file instead of the server.")
+@click.option(
+    "--replay-timing", type=click.Choice(["fast", "original"]),
+    default="fast")
+@click.option(
+    "--retries", type=click.INT, default=0,
+    help="The maximum number of retries of a quantum on transient errors.")
+@click.option(
+    "--backoff", type=click.FLOAT, default=0.5,
+    help="The time to wait before the first retry of a quantum (seconds).")
+@click.option(
+    "--checkpoint", type=click.Path(exists=False, dir_okay=False),
+    default=None,
+    help="Saves the state of the query in this file during its execution.")
+@click.option(
+    "--checkpoint-interval", type=click.FLOAT, default=30.0,
+    help="The minimum time between two saves of the state (seconds).")
+@click.option(
+    "--resume/--restart", default=False,
+    help="Resumes the query from the state saved in its checkpoint.")
+@click.option(
+    "--profile", type=click.Choice(["cprofile", "sampling"]), default=None,
+    help=(
+        "Profiles the client, and saves the profile next to the stats. "
+        "cprofile only profiles the main thread, sampling profiles all the "
+        "threads, e.g. the partitions of sage-partitioned-topk."))
+@click.option(
+    "--profile-interval", type=click.FLOAT, default=1.0,
+    help="The time between two samples of the sampling profiler (ms).")
+@click.option(
+    "--memory", type=click.Choice(["rss", "tracemalloc"]), default=None,
+    help=(
+        "Tracks the peak RSS of the client process, the solutions held by "
+        "the client, and with tracemalloc, the peak of memory allocated by "
+        "Python during the query."))
 @click.option(
     "--verbose/--quiet", default=False)
 def topk_run(
-    queryfile, configfile, approach, limit, max_limit, quota, early_pruning,
-    stateless, force_order, stats, output, verbose
+    queryfile, configfile, approach, limit, offset, continuation, max_limit,
+    quota, early_pruning, stateless, force_order, layout, seeds, partitions,
+    eval_workers, eval_batch, stats, output, record, replay, replay_timing,
+    retries, backoff, checkpoint, checkpoint_interval, resume, profile,
+    profile_interval, memory, verbose
 ):
     if verbose:
         logging.basicConfig(
@@ -107,17 +192,66 @@ def topk_run(
         return
 
     spy = Spy()  # used to collect statistics
-    engine = ApproachFactory.create(approach, config)
-
-    solutions = engine.execute_query(
-        query, spy, limit=limit, max_limit=max_limit, quota=quota,
-        early_pruning=early_pruning, stateless=stateless,
-        force_order=force_order)
+    if checkpoint is not None and approach not in [
+        "sage", "sage-topk", "sage-partial-topk"
+    ]:
+        raise Exception(f"The approach {approach} cannot be checkpointed...")
+    elif checkpoint is not None:
+        checkpoint = Checkpoint(checkpoint, interval=checkpoint_interval)
+    elif resume:
+        raise Exception("A checkpoint is required to resume a query...")
+
+    if approach == "sage-partitioned-topk" and (
+        record is not None or replay is not None
+    ):  # the order of the requests of concurrent partitions is not defined
+        raise Exception(f"The approach {approach} cannot record traces...")
+    elif approach.startswith("sage"):
+        endpoint = config["endpoints"]["sage"]
+        transport = create_transport(
+            endpoint["url"], record=record, replay=replay,
+            timing=replay_timing, replicas=endpoint.get("replicas"),
+            balancing=endpoint.get("balancing", "round-robin"),
+            retries=retries, backoff=backoff)
+        engine = ApproachFactory.create(
+            approach, config, transport=transport, seeds=seeds)
+    elif record is not None or replay is not None:
+        raise Exception(f"The approach {approach} cannot record traces...")
+    else:
+        transport = None
+        engine = ApproachFactory.create(approach, config)
+
+    profiler = create_profiler(profile, interval=profile_interval / 1000)
+
+    try:
+        with ExitStack() as stack:
+            if profiler is not None:
+                stack.enter_context(profiler)
+            if memory is not None:
+                stack.enter_context(spy.track_memory(
+                    allocations=(memory == "tracemalloc")))
+            solutions = engine.execute_query(
+                query, spy, limit=limit, max_limit=max_limit, quota=quota,
+                early_pruning=early_pruning, stateless=stateless,
+                force_order=force_order, layout=layout, offset=offset,
+                continuation=continuation, seeding=(seeds is not None),
+                partitions=partitions, checkpoint=checkpoint, resume=resume,
+                eval_workers=eval_workers, eval_batch=eval_batch)
+    finally:
+        engine.close()
+        if transport is not None:
+            transport.close()
     dataframe = spy.to_dataframe()
 
+    if profiler is not None:
+        prefix = os.path.splitext(stats or output or filename)[0]
+        logging.info(f"{approach} - profile saved in {profiler.dump(prefix)}")
+
     logging.info((
         f"{approach} - query executed in {spy.execution_time / 1000} seconds "
         f"with {len(solutions)} solutions"))
+    if spy.continuation is not None:
+        logging.info(
+            f"{approach} - next page: --continuation {spy.continuation}")
     if len(solutions) > 0:
         first_solution = json.dumps(solutions[0], indent=4)
         last_solution = json.dumps(solutions[-1], indent=4)
@@ -129,6 +263,63 @@ def topk_run(
     save_dataframe(dataframe, stats)
 
 
+@cli.command()
+@click.argument(
+    "workload", type=click.Path(exists=True, file_okay=True, dir_okay=True))
+@click.argument(
+    "output", type=click.Path(exists=False, file_okay=False, dir_okay=True))
+@click.option(
+    "--configfile",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    default="config/xp-watdiv.yaml")
+@click.option(
+    "--limit", type=click.INT, multiple=True, default=[0])
+@click.option(
+    "--format", type=click.Choice(["json", "csv", "tsv"]), default="tsv")
+@click.option(
+    "--workers", type=click.INT, default=8)
+@click.option(
+    "--force-order/--default-ordering", default=False)
+@click.option(
+    "--verbose/--quiet", default=False)
+def reference_run(
+    workload, output, configfile, limit, format, workers, force_order,
+    verbose
+):
+    """
+    Computes the reference TOP-k of a whole workload using Virtuoso. Results
+    are written in OUTPUT/{limit}/1/{query}.json, and the statistics in
+    OUTPUT/{limit}/1/{query}.csv, i.e. the layout expected for the virtuoso
+    approach by the Snakefile.
+    """
+    if verbose:
+        logging.basicConfig(
+            level="INFO",
+            format="%(asctime)s - %(message)s",
+            datefmt="%m/%d/%Y %I:%M:%S")
+    config = yaml.safe_load(stream=open(configfile, "r"))
+    engine = ApproachFactory.create(
+        "virtuoso", config, format=format, workers=workers)
+
+    jobs = list()
+    for filename, query in load_queries(workload):
+        for k in limit:
+            jobs.append((filename, k, query))
+
+    results = engine.execute_batch([
+        (query, {"limit": k, "force_order": force_order})
+        for _, k, query in jobs])
+
+    for (filename, k, _), (solutions, spy) in zip(jobs, results):
+        os.makedirs(f"{output}/{k}/1", exist_ok=True)
+        save_json(solutions, f"{output}/{k}/1/{filename}.json")
+        save_dataframe(spy.to_dataframe(), f"{output}/{k}/1/{filename}.csv")
+        logging.info((
+            f"virtuoso - {filename} (limit = {k}) executed in "
+            f"{spy.execution_time / 1000} seconds with {len(solutions)} "
+            f"solutions"))
+
+
 @cli.command()
 @click.argument(
     "reference", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -136,38 +327,29 @@ def topk_run(
     "actual", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.option(
     "--output", type=click.Path(exists=False), default=None)
+@click.option(
+    "--ordered/--unordered", default=False)
+@click.option(
+    "--query", type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    default=None)
 @click.option(
     "--verbose/--quiet", default=False)
-def compare(reference, actual, output, verbose):
+def compare(reference, actual, output, ordered, query, verbose):
+    """
+    Checks the solutions in ACTUAL against the solutions in REFERENCE. If the
+    query is given, solutions are validated as a TOP-K, i.e. they must be
+    sorted as in the reference, and any tie-break at the k-th position is
+    accepted.
+    """
     if verbose:
         logging.basicConfig(
             level="INFO",
             format="%(asctime)s - %(message)s",
             datefmt="%m/%d/%Y %I:%M:%S")
-    reference = json.load(open(reference, "r"))
-    actual = json.load(open(actual, "r"))
-
-    correct = True
-    memory = {}
-    for mappings in reference:
-        sorted_mappings = {k: mappings[k] for k in sorted(mappings.keys())}
-        key = hashlib.md5(str(sorted_mappings).encode("utf-8")).digest()
-        if key not in memory:
-            memory[key] = 0
-        memory[key] += 1
-    for mappings in actual:
-        sorted_mappings = {k: mappings[k] for k in sorted(mappings.keys())}
-        key = hashlib.md5(str(sorted_mappings).encode("utf-8")).digest()
-        if key not in memory:
-            logging.info(f"Incorrect solution: {sorted_mappings}")
-            correct = False
-            break
-        memory[key] -= 1
-        if memory[key] < 0:
-            logging.info(f"Duplicated solution: {sorted_mappings}")
-            correct = False
-            break
-    correct = all([value == 0 for value in memory.values()])
+    keys = None
+    if query is not None:
+        keys = get_orderby_variables(load_queries(query)[0][1])
+    correct = compare_files(reference, actual, ordered=ordered, keys=keys)
 
     if correct:
         logging.info("The TOP-K is correct")
@@ -176,6 +358,253 @@ def compare(reference, actual, output, verbose):
     save_dataframe(DataFrame([[correct]], columns=["correct"]), output)
 
 
+def check(job: Tuple[str, str, str, bool, str]) -> bool:
+    reference, actual, output, ordered, queryfile = job
+    keys = None
+    if queryfile is not None:
+        keys = get_orderby_variables(load_queries(queryfile)[0][1])
+    correct = compare_files(reference, actual, ordered=ordered, keys=keys)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    save_dataframe(DataFrame([[correct]], columns=["correct"]), output)
+    return correct
+
+
+@cli.command()
+@click.argument(
+    "directory", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option(
+    "--workers", type=click.INT, default=os.cpu_count())
+@click.option(
+    "--ordered/--unordered", default=False)
+@click.option(
+    "--workloads", type=click.Path(file_okay=False, dir_okay=True),
+    default="workloads")
+@click.option(
+    "--workload", type=click.STRING, default=None,
+    help="Only validates the results of this workload.")
+@click.option(
+    "--summary", type=click.Path(exists=False, file_okay=True, dir_okay=False),
+    default=None,
+    help="A CSV file in which the outcomes of all validations are saved.")
+@click.option(
+    "--verbose/--quiet", default=False)
+def compare_all(
+    directory, workers, ordered, workloads, workload, summary, verbose
+):
+    """
+    Validates all the results of an experiment against the results of
+    Virtuoso, in a single process that uses a pool of workers. DIRECTORY is
+    the directory of an experiment, e.g. output/data/stateless. The outcome of
+    each validation is written next to the result, and in the summary, with
+    the query, the limit, the approach, the workload and the experiment of
+    the result. Results whose query is found in the workloads are validated
+    as a TOP-K.
+    """
+    if verbose:
+        logging.basicConfig(
+            level="INFO",
+            format="%(asctime)s - %(message)s",
+            datefmt="%m/%d/%Y %I:%M:%S")
+    jobs = [
+        (reference, actual, output, ordered, queryfile)
+        for reference, actual, output, queryfile
+        in list_checks(directory, workloads=workloads, workload=workload)]
+    with Pool(processes=workers) as pool:
+        outcomes = pool.map(check, jobs, chunksize=16)
+    rows = list()
+    for (_, actual, _, _, _), correct in zip(jobs, outcomes):
+        if not correct:
+            logging.info(f"The TOP-K is incorrect: {actual}")
+        # {xp}/{workload}/{approach}-{quota}ms/{limit}/1/{query}.json
+        parts = os.path.normpath(actual).split(os.sep)
+        approach = re.sub(r"-[0-9]+ms$", "", parts[-4])
+        query = parts[-1].split(".")[0]
+        rows.append([
+            correct, query, parts[-3], approach, parts[-5], parts[-6]])
+    logging.info(f"{sum(outcomes)}/{len(outcomes)} TOP-K are correct")
+    if summary is not None:
+        os.makedirs(os.path.dirname(summary) or ".", exist_ok=True)
+        save_dataframe(DataFrame(rows, columns=[
+            "correct", "query", "limit", "approach", "workload", "xp"]),
+            summary)
+
+
+@cli.command()
+@click.option(
+    "--host", type=click.STRING, default="localhost")
+@click.option(
+    "--port", type=click.INT, default=8080)
+@click.option(
+    "--scale", type=click.INT, default=1000)
+@click.option(
+    "--seed", type=click.INT, default=0)
+@click.option(
+    "--quota", type=click.INT, default=75)
+@click.option(
+    "--steps-per-ms", type=click.INT, default=100)
+@click.option(
+    "--max-limit", type=click.INT, default=10000)
+@click.option(
+    "--verbose/--quiet", default=False)
+def standin(host, port, scale, seed, quota, steps_per_ms, max_limit, verbose):
+    """
+    Runs a stand-in SaGe server over a generated WatDiv-like dataset. It can be
+    used instead of a real SaGe server to benchmark the clients without any
+    dataset.
+    """
+    logging.basicConfig(
+        level="DEBUG" if verbose else "INFO",
+        format="%(asctime)s - %(message)s",
+        datefmt="%m/%d/%Y %I:%M:%S")
+    store = generate_watdiv(scale=scale, seed=seed)
+    engine = StandInEngine(
+        store, quota=quota, steps_per_ms=steps_per_ms, max_limit=max_limit)
+    server = StandInServer(engine, host=host, port=port)
+    logging.info(f"stand-in - {len(store)} triples generated")
+    logging.info(f"stand-in - listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+@cli.command()
+@click.argument(
+    "workload", type=click.Path(exists=True, file_okay=True, dir_okay=True))
+@click.option(
+    "--configfile",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    default="config/watdiv.yaml")
+@click.option(
+    "--approach", type=click.Choice(ApproachFactory.types()), multiple=True,
+    default=["sage", "sage-topk", "sage-partial-topk"])
+@click.option(
+    "--limit", type=click.INT, default=10)
+@click.option(
+    "--max-limit", type=click.INT, default=10000)
+@click.option(
+    "--quota", type=click.INT, default=75)
+@click.option(
+    "--early-pruning", type=click.BOOL, default=False)
+@click.option(
+    "--stateless", type=click.BOOL, default=True)
+@click.option(
+    "--force-order/--default-ordering", default=False)
+@click.option(
+    "--layout", type=click.Choice(["nested", "flat"]), default="nested",
+    help="The layout of the client-side TOP-K data structure.")
+@click.option(
+    "--seeding/--no-seeding", default=False,
+    help=(
+        "Seeds the threshold of sage-partial-topk with the thresholds of the "
+        "previous executions of each query, e.g. of the warmup."))
+@click.option(
+    "--partitions", type=click.INT, default=4,
+    help="The number of partitions of sage-partitioned-topk.")
+@click.option(
+    "--eval-workers", type=click.INT, default=0,
+    help=(
+        "The number of processes that evaluate the ORDER BY expressions of "
+        "the sage approach, 0 to evaluate them in process."))
+@click.option(
+    "--eval-batch", type=click.INT, default=512,
+    help=(
+        "The number of solutions per batch evaluated by a process. Smaller "
+        "pages are evaluated in process."))
+@click.option(
+    "--warmup", type=click.INT, default=1,
+    help="The number of times each query is executed before measures.")
+@click.option(
+    "--repetitions", type=click.INT, default=5,
+    help="The number of times each query is measured.")
+@click.option(
+    "--concurrency", type=click.INT, default=1,
+    help="The number of queries executed at the same time.")
+@click.option(
+    "--standin/--endpoint", default=False,
+    help="Runs the queries against a local stand-in SaGe server.")
+@click.option(
+    "--scale", type=click.INT, default=1000)
+@click.option(
+    "--seed", type=click.INT, default=0)
+@click.option(
+    "--steps-per-ms", type=click.INT, default=100)
+@click.option(
+    "--output", type=click.Path(exists=False, dir_okay=False), default=None)
+@click.option(
+    "--format", type=click.Choice(["json", "csv"]), default="json")
+@click.option(
+    "--executions", type=click.Path(exists=False, dir_okay=False),
+    default=None, help="Saves the measures of each execution in a CSV file.")
+@click.option(
+    "--profile", type=click.Choice(["cprofile", "sampling"]), default=None,
+    help=(
+        "Profiles each query, once per approach. cprofile only profiles the "
+        "main thread, sampling profiles all the threads."))
+@click.option(
+    "--profile-dir", type=click.Path(file_okay=False), default="profiles")
+@click.option(
+    "--verbose/--quiet", default=False)
+def bench(
+    workload, configfile, approach, limit, max_limit, quota, early_pruning,
+    stateless, force_order, layout, seeding, partitions, eval_workers,
+    eval_batch, warmup, repetitions, concurrency, standin, scale, seed,
+    steps_per_ms, output, format, executions, profile, profile_dir, verbose
+):
+    """
+    Benchmarks approaches on a workload, and reports the latency percentiles,
+    the throughput, the data transfer and the client CPU time per approach.
+    """
+    if verbose:
+        logging.basicConfig(
+            level="INFO",
+            format="%(asctime)s - %(message)s",
+            datefmt="%m/%d/%Y %I:%M:%S")
+    config = yaml.safe_load(stream=open(configfile, "r"))
+    queries = sorted(load_queries(workload))
+
+    server = None
+    if standin:
+        if "virtuoso" in approach:
+            raise Exception("The stand-in server does not support virtuoso...")
+        store = generate_watdiv(scale=scale, seed=seed)
+        server = StandInServer(
+            StandInEngine(store, steps_per_ms=steps_per_ms), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        config["endpoints"]["sage"]["url"] = server.url
+        config["endpoints"]["sage"].pop("replicas", None)
+        logging.info(f"stand-in - {len(store)} triples at {server.url}")
+
+    options = {
+        "limit": limit, "max_limit": max_limit, "quota": quota,
+        "early_pruning": early_pruning, "stateless": stateless,
+        "force_order": force_order, "layout": layout, "seeding": seeding,
+        "partitions": partitions, "eval_workers": eval_workers,
+        "eval_batch": eval_batch}
+    try:
+        reports, measures = run_benchmark(
+            list(approach), queries, config, options, warmup=warmup,
+            repetitions=repetitions, concurrency=concurrency,
+            profile=profile, profile_dir=profile_dir)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    click.echo(DataFrame(reports).set_index("approach").T.to_string())
+    if output is not None:
+        metadata = {
+            "date": datetime.now(timezone.utc).isoformat(),
+            "workload": workload,
+            "python": platform.python_version(),
+            "standin": {"scale": scale, "seed": seed,
+                        "steps_per_ms": steps_per_ms} if standin else None,
+            "warmup": warmup,
+            **options}
+        save_report(reports, metadata, output, format=format)
+    save_dataframe(DataFrame(measures), executions)
+
+
 @cli.command()
 @click.argument(
     "queries", type=click.Path(exists=True, dir_okay=False, file_okay=True))
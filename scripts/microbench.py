@@ -0,0 +1,491 @@
+import click
+import itertools
+import json
+import math
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime, timezone
+from multiprocessing.pool import Pool
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from approaches import topk_struct
+from approaches.topk_struct import OrderedDict, Solution, TOPKStruct
+from approaches.sage import TOPKOperator
+
+
+XSD_INTEGER = "http://www.w3.org/2001/XMLSchema#integer"
+
+LIMITS = [10, 100, 1000, 10000]
+ARITIES = [1, 2, 3]
+STREAMS = ["uniform", "skewed", "sorted", "reverse"]
+LAYOUTS = ["nested", "flat"]
+PARTITIONS = [2, 8]
+WORKERS = [2, 4]
+
+# the pools of processes that evaluate ORDER BY keys, shared by all cases
+_pools = dict()
+
+
+###############################################################################
+# ### Input streams
+###############################################################################
+
+
+def orders(arity: int) -> Dict[str, List[str]]:
+    """
+    Returns the ASC/DESC mixes tested for a given number of keys.
+
+    Parameters
+    ----------
+    arity: int
+        The number of keys of the ORDER BY clause.
+
+    Returns
+    -------
+    Dict[str, List[str]]
+        The order of each key, for each mix.
+    """
+    mixes = {"asc": ["ASC"] * arity, "desc": ["DESC"] * arity}
+    if arity > 1:
+        mixes["mixed"] = [
+            "ASC" if index % 2 == 0 else "DESC" for index in range(arity)]
+    return mixes
+
+
+def generate_keys(
+    size: int, arity: int, stream: str, seed: int = 0
+) -> List[Tuple[int, ...]]:
+    """
+    Generates the keys of a stream of solutions.
+
+    Parameters
+    ----------
+    size: int
+        The number of solutions in the stream.
+    arity: int
+        The number of keys of each solution.
+    stream: str
+        "uniform" for uniformly distributed keys, "skewed" for keys that
+        follow a power law, i.e. with many ties, "sorted" and "reverse" for
+        uniform keys sorted in the ascending and descending order.
+    seed: int - (default = 0)
+        The seed of the random generator.
+
+    Returns
+    -------
+    List[Tuple[int, ...]]
+        The keys of the solutions, in the order of the stream.
+    """
+    rng = random.Random(seed)
+    if stream == "skewed":
+        keys = [
+            tuple(int(rng.paretovariate(1.2)) for _ in range(arity))
+            for _ in range(size)]
+    else:
+        keys = [
+            tuple(rng.randint(0, 10 ** 6) for _ in range(arity))
+            for _ in range(size)]
+    if stream == "sorted":
+        keys.sort()
+    elif stream == "reverse":
+        keys.sort(reverse=True)
+    return keys
+
+
+def generate_solutions(
+    size: int, arity: int, stream: str, seed: int = 0
+) -> List[Solution]:
+    """
+    Generates a stream of solutions as received by TOPKStruct, i.e. records
+    with their ORDER BY keys already evaluated.
+    """
+    return [
+        Solution(key, (f"http://example.org/s{index}",))
+        for index, key in enumerate(
+            generate_keys(size, arity, stream, seed))]
+
+
+###############################################################################
+# ### Benchmark cases
+###############################################################################
+
+
+def measure(
+    setup: Callable[[], Any], run: Callable[[Any], Any], operations: int,
+    repetitions: int, memory: bool = False
+) -> Dict[str, float]:
+    """
+    Measures the time spent by a benchmark case. The setup is not measured.
+    If requested, the memory held by the state of the benchmark case once
+    executed is measured by an extra repetition, as tracemalloc slows down
+    the execution.
+
+    Parameters
+    ----------
+    setup: Callable[[], Any]
+        Builds the state of the benchmark case, before each repetition.
+    run: Callable[[Any], Any]
+        The benchmark case, that takes the state built by the setup.
+    operations: int
+        The number of operations performed by the benchmark case.
+    repetitions: int
+        The number of times the benchmark case is executed.
+    memory: bool - (default = False)
+        True to measure the memory held by the state of the benchmark case.
+
+    Returns
+    -------
+    Dict[str, float]
+        Statistics about the time spent per operation (nanoseconds), and the
+        memory held by the state (bytes).
+    """
+    timings = list()
+    for _ in range(repetitions):
+        state = setup()
+        start = time.perf_counter_ns()
+        run(state)
+        timings.append((time.perf_counter_ns() - start) / operations)
+    result = {
+        "operations": operations,
+        "repetitions": repetitions,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0}
+    if memory:
+        tracemalloc.start()
+        try:
+            state = setup()
+            run(state)
+            result["memory"], _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def ordered_dict_cases(
+    size: int
+) -> List[Tuple[str, Callable, Callable, int]]:
+    keys = [key for key, in generate_keys(size, 1, "uniform")]
+    keys = list(dict.fromkeys(keys))  # OrderedDict keys are unique
+
+    def fill() -> OrderedDict:
+        tree = OrderedDict()
+        for key in keys:
+            tree[key] = key
+        return tree
+
+    def insert(tree: OrderedDict) -> None:
+        for key in keys:
+            tree[key] = key
+
+    def delete(tree: OrderedDict) -> None:
+        for key in keys:
+            tree.pop(key)
+
+    def iterate(tree: OrderedDict) -> None:
+        for _ in tree:
+            pass
+
+    def ksmallest(tree: OrderedDict) -> None:
+        for k in range(1, len(keys) + 1):
+            tree.KSmallest(k)
+
+    def rank(tree: OrderedDict) -> None:
+        for key in keys:
+            tree.rank(key)
+
+    return [
+        (f"ordered_dict/insert/n={len(keys)}", OrderedDict, insert,
+            len(keys)),
+        (f"ordered_dict/delete/n={len(keys)}", fill, delete, len(keys)),
+        (f"ordered_dict/iterate/n={len(keys)}", fill, iterate, len(keys)),
+        (f"ordered_dict/ksmallest/n={len(keys)}", fill, ksmallest,
+            len(keys)),
+        (f"ordered_dict/rank/n={len(keys)}", fill, rank, len(keys))]
+
+
+def layout_suffix(layout: str) -> str:
+    """
+    Returns the suffix of the name of a case for a layout of TOPKStruct. The
+    cases of the default layout keep their names, so that they can be
+    compared with older results.
+    """
+    return "" if layout == "nested" else f"/layout={layout}"
+
+
+def topk_struct_cases(
+    size: int
+) -> List[Tuple[str, Callable, Callable, int]]:
+    cases = list()
+    for arity in ARITIES:
+        # with a single key, both layouts are the same
+        layouts = LAYOUTS if arity > 1 else ["nested"]
+        for stream in STREAMS:
+            solutions = generate_solutions(size, arity, stream)
+            for mix, directions in orders(arity).items():
+                keys = [
+                    (f"__order_condition_{index}", direction)
+                    for index, direction in enumerate(directions)]
+                for limit, layout in itertools.product(LIMITS, layouts):
+                    if limit > size:
+                        continue
+
+                    def setup(
+                        keys=keys, limit=limit, layout=layout
+                    ) -> TOPKStruct:
+                        return TOPKStruct(keys, limit=limit, layout=layout)
+
+                    def insert(topk, solutions=solutions) -> None:
+                        for solution in solutions:
+                            topk.insert(solution)
+
+                    name = (
+                        f"topk_struct/insert/k={limit}/keys={arity}/"
+                        f"order={mix}/stream={stream}"
+                        f"{layout_suffix(layout)}")
+                    cases.append((name, setup, insert, size))
+    for limit, layout in itertools.product(LIMITS, LAYOUTS):
+        if limit > size:
+            continue
+        solutions = generate_solutions(size, 2, "uniform")
+        keys = [("__order_condition_0", "ASC"), ("__order_condition_1", "ASC")]
+
+        def fill(
+            keys=keys, limit=limit, layout=layout, solutions=solutions
+        ) -> TOPKStruct:
+            topk = TOPKStruct(keys, limit=limit, layout=layout)
+            for solution in solutions:
+                topk.insert(solution)
+            return topk
+
+        def flatten(topk: TOPKStruct) -> None:
+            topk.flatten()
+
+        def rank(topk: TOPKStruct, solutions=solutions) -> None:
+            for solution in solutions:
+                topk.rank(solution.key)
+
+        suffix = layout_suffix(layout)
+        cases.append((
+            f"topk_struct/flatten/k={limit}{suffix}", fill, flatten, limit))
+        cases.append((f"topk_struct/rank/k={limit}{suffix}", fill, rank, size))
+    # merging the topk of several partitions, compared to inserting their
+    # solutions again in a new topk
+    for limit, partitions, mix in itertools.product(
+        LIMITS, PARTITIONS, ["asc", "mixed"]
+    ):
+        if limit > size:
+            continue
+        solutions = generate_solutions(size, 2, "uniform")
+        keys = [
+            (f"__order_condition_{index}", direction)
+            for index, direction in enumerate(orders(2)[mix])]
+
+        def split(
+            keys=keys, limit=limit, partitions=partitions,
+            solutions=solutions
+        ) -> List[TOPKStruct]:
+            topks = [
+                TOPKStruct(keys, limit=limit) for _ in range(partitions)]
+            for index, solution in enumerate(solutions):
+                topks[index % partitions].insert(solution)
+            return topks
+
+        def merge(topks: List[TOPKStruct]) -> None:
+            topks[0].merge(*topks[1:])
+
+        def reinsert(topks: List[TOPKStruct], keys=keys, limit=limit) -> None:
+            topk = TOPKStruct(keys, limit=limit)
+            for partition in topks:
+                for solution in partition.flatten():
+                    topk.insert(solution)
+
+        suffix = f"k={limit}/partitions={partitions}/order={mix}"
+        cases.append((f"topk_struct/merge/{suffix}", split, merge, limit))
+        cases.append((
+            f"topk_struct/reinsert/{suffix}", split, reinsert, limit))
+    return cases
+
+
+def topk_operator_cases(
+    size: int
+) -> List[Tuple[str, Callable, Callable, int]]:
+    queries = {
+        "variable": "ORDER BY DESC(?price) ?s",
+        "expression": "ORDER BY DESC(?price * 2) STR(?s)"}
+    keys = generate_keys(size, 1, "uniform")
+    cases = list()
+    for name, orderby in queries.items():
+        for limit in LIMITS:
+            if limit > size:
+                continue
+            query = (
+                "SELECT * WHERE { ?s <http://example.org/price> ?price } "
+                f"{orderby} LIMIT {limit}")
+
+            def setup(query=query, limit=limit) -> Tuple[
+                TOPKOperator, List[Dict[str, str]]
+            ]:
+                solutions = [
+                    {
+                        "?s": f"http://example.org/s{index}",
+                        "?price": f'"{value}"^^{XSD_INTEGER}'
+                    } for index, (value,) in enumerate(keys)]
+                return TOPKOperator(query, limit=limit), solutions
+
+            def insert(state) -> None:
+                topk, solutions = state
+                for mappings in solutions:
+                    topk.insert(mappings)
+
+            cases.append((
+                f"topk_operator/insert/k={limit}/orderby={name}", setup,
+                insert, size))
+            if name != "expression":
+                continue
+            # the keys of the whole stream are evaluated as a single page
+            for workers in WORKERS:
+
+                def insert_page(state, workers=workers) -> None:
+                    topk, solutions = state
+                    if workers not in _pools:
+                        _pools[workers] = Pool(workers)
+                    topk.insert_page(solutions, pool=_pools[workers])
+
+                cases.append((
+                    f"topk_operator/insert_page/k={limit}/orderby={name}/"
+                    f"workers={workers}", setup, insert_page, size))
+    return cases
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def echo(name: str, result: Dict[str, float]) -> None:
+    message = f"{name}: {result['median']:.0f} ns/op"
+    if "memory" in result:
+        message += f", {result['memory'] / 1024:.0f} KiB"
+    click.echo(message)
+
+
+###############################################################################
+# ### Command-line interface
+###############################################################################
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option(
+    "--output", type=click.Path(exists=False, dir_okay=False), default=None,
+    help="The JSON file in which results are saved.")
+@click.option(
+    "--size", type=click.INT, default=10000,
+    help="The number of solutions inserted by each case.")
+@click.option(
+    "--repetitions", type=click.INT, default=3)
+@click.option(
+    "--filter", "pattern", type=click.STRING, default=None,
+    help="A regular expression to select the cases to run.")
+@click.option(
+    "--memory/--no-memory", default=False,
+    help="Also measures the memory held by each case, e.g. by the TOP-K.")
+def run(output, size, repetitions, pattern, memory):
+    """
+    Runs the microbenchmarks of the client-side TOP-K stack.
+    """
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    results = dict()
+    for generator in [ordered_dict_cases, topk_struct_cases]:
+        cases = generator(size)
+        for name, setup, benchmark, operations in cases:
+            if pattern is not None and re.search(pattern, name) is None:
+                continue
+            results[name] = measure(
+                setup, benchmark, operations, repetitions, memory=memory)
+            echo(name, results[name])
+    # the evaluation of expressions is much slower, so the stream is smaller
+    for name, setup, benchmark, operations in topk_operator_cases(
+        max(size // 10, 10)
+    ):
+        if pattern is not None and re.search(pattern, name) is None:
+            continue
+        results[name] = measure(
+            setup, benchmark, operations, repetitions, memory=memory)
+        echo(name, results[name])
+    for pool in _pools.values():
+        pool.close()
+        pool.join()
+    _pools.clear()
+    report = {
+        "metadata": {
+            "date": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "compiled": topk_struct.COMPILED,
+            "gil": getattr(sys, "_is_gil_enabled", lambda: True)(),
+            "size": size,
+            "repetitions": repetitions,
+            "memory": memory},
+        "results": results}
+    if output is not None:
+        with open(output, "w") as writer:
+            json.dump(report, writer, indent=4)
+
+
+@cli.command()
+@click.argument(
+    "baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument(
+    "current", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--threshold", type=click.FLOAT, default=0.1,
+    help="The relative slowdown above which a case is a regression.")
+def compare(baseline, current, threshold):
+    """
+    Compares two results of the microbenchmarks, and exits with an error if
+    a case is slower than in the baseline. Cases are compared on their
+    fastest repetition, which is the least sensitive to noise.
+    """
+    with open(baseline, "r") as reader:
+        expected = json.load(reader)["results"]
+    with open(current, "r") as reader:
+        found = json.load(reader)["results"]
+    regressions = 0
+    speedups = list()
+    for name in sorted(set(expected) & set(found)):
+        ratio = found[name]["min"] / expected[name]["min"]
+        speedups.append(ratio)
+        status = ""
+        if ratio > 1 + threshold:
+            status = "REGRESSION"
+            regressions += 1
+        click.echo(f"{name}: {ratio:.2f}x {status}".rstrip())
+    if len(speedups) > 0:
+        geomean = math.exp(statistics.mean(math.log(x) for x in speedups))
+        click.echo(f"geometric mean: {geomean:.2f}x")
+    if regressions > 0:
+        raise click.ClickException(f"{regressions} regression(s) detected")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,176 @@
+import os
+import sys
+import cProfile
+import threading
+
+from abc import ABC, abstractmethod
+from collections import Counter
+from types import FrameType
+from typing import Optional
+
+
+class Profiler(ABC):
+    """
+    This class defines a profiler of the client. A profiler can be started and
+    stopped several times, e.g. once per execution of a query, in which case
+    the profiles of all executions are accumulated.
+    """
+
+    @property
+    @abstractmethod
+    def extension(self) -> str:
+        pass
+
+    @abstractmethod
+    def start(self) -> None:
+        pass
+
+    @abstractmethod
+    def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    def save(self, path: str) -> None:
+        pass
+
+    def dump(self, prefix: str) -> str:
+        """
+        Saves the profile next to other files of a query.
+
+        Parameters
+        ----------
+        prefix: str
+            The path to the profile, without its extension.
+
+        Returns
+        -------
+        str
+            The path to the profile.
+        """
+        path = f"{prefix}{self.extension}"
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        self.save(path)
+        return path
+
+    def __enter__(self) -> "Profiler":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+class CProfiler(Profiler):
+    """
+    This class profiles the client with cProfile. Profiles are saved in the
+    pstats format, e.g. to be loaded with pstats or snakeviz.
+    """
+
+    def __init__(self) -> None:
+        self._profile = cProfile.Profile()
+
+    @property
+    def extension(self) -> str:
+        return ".pstats"
+
+    def start(self) -> None:
+        self._profile.enable()
+
+    def stop(self) -> None:
+        self._profile.disable()
+
+    def save(self, path: str) -> None:
+        self._profile.dump_stats(path)
+
+
+class SamplingProfiler(Profiler):
+    """
+    This class profiles the client by sampling the stacks of all its threads
+    at a regular interval, e.g. the threads of the partitions of a query, so
+    stacks start with the name of their thread. Idle threads are sampled too,
+    while they wait. Its overhead does not depend on the number of function
+    calls, contrary to cProfile, which only profiles the thread that started
+    it. As the sampler needs the GIL, the actual interval can be longer than
+    requested when the client is busy, i.e. up to sys.getswitchinterval().
+    Profiles are saved as collapsed stacks, i.e. one "frame;frame;frame count"
+    line per stack, as expected by flamegraph.pl or speedscope.
+
+    Parameters
+    ----------
+    interval: float - (default = 0.001)
+        The time between two samples (seconds).
+    """
+
+    def __init__(self, interval: float = 0.001) -> None:
+        self._interval = interval
+        self._stacks = Counter()
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    @property
+    def extension(self) -> str:
+        return ".folded"
+
+    @staticmethod
+    def __label__(frame: FrameType) -> str:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+    def __sample__(self) -> None:
+        sampler = threading.get_ident()
+        while not self._stopped.wait(self._interval):
+            names = {
+                thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == sampler:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(SamplingProfiler.__label__(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"Thread-{ident}"))
+                self._stacks[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self.__sample__, daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._sampler.join()
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as writer:
+            for stack, count in self._stacks.most_common():
+                writer.write(f"{stack} {count}\n")
+
+
+def create_profiler(
+    mode: Optional[str], interval: float = 0.001
+) -> Optional[Profiler]:
+    """
+    Creates a profiler.
+
+    Parameters
+    ----------
+    mode: None | str
+        "cprofile", "sampling", or None to disable profiling.
+    interval: float - (default = 0.001)
+        The time between two samples of the sampling profiler (seconds).
+
+    Returns
+    -------
+    None | Profiler
+        The profiler, or None if profiling is disabled.
+    """
+    if mode is None:
+        return None
+    elif mode == "cprofile":
+        return CProfiler()
+    elif mode == "sampling":
+        return SamplingProfiler(interval=interval)
+    raise Exception(f"The profiler {mode} does not exist...")
@@ -22,6 +22,17 @@ function stop_sage {
   fi
 }
 
+function start_standin {
+  if [[ -z "$(lsof -t -i:8080)" ]]
+  then
+    echo "Running the stand-in SaGe server..."
+    nohup python scripts/cli.py standin --port 8080 --scale 10000 > /dev/null 2>&1 &
+    sleep 10
+  else
+    echo "A SaGe server is already running..."
+  fi
+}
+
 function start_virtuoso {
   if [[ -z "$(lsof -t -i:8890)" ]]
   then
@@ -45,7 +56,7 @@ function stop_virtuoso {
 
 if [[ "$1" == "stop" || $# -eq 1 ]]
 then
-  if [[ "$2" == "sage" || "$2" == "all" ]]
+  if [[ "$2" == "sage" || "$2" == "standin" || "$2" == "all" ]]
   then
     stop_sage
   fi
@@ -61,6 +72,10 @@ then
   then
     start_sage
   fi
+  if [[ "$2" == "standin" ]]
+  then
+    start_standin
+  fi
   if [[ "$2" == "virtuoso" || "$2" == "all" ]]
   then
     start_virtuoso
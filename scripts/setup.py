@@ -0,0 +1,19 @@
+"""
+Builds the optional compiled version of approaches/topk_struct.py with
+Cython. The Python file is compiled as is, with the declarations of
+approaches/topk_struct.pxd, and the extension module is imported instead of
+the Python file once built. Removing the extension module falls back to the
+Python file.
+
+    pip install cython
+    cd scripts && python setup.py build_ext --inplace
+"""
+from setuptools import setup
+from Cython.Build import cythonize
+
+
+setup(
+    name="topk-struct",
+    ext_modules=cythonize(
+        ["approaches/topk_struct.py"],
+        compiler_directives={"language_level": 3}))
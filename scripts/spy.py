@@ -1,4 +1,60 @@
+import math
+import sys
+import time
+import tracemalloc
+
+from contextlib import contextmanager
 from pandas import DataFrame
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # resource is only available on Unix
+    resource = None
+
+
+def sizeof_solutions(solutions: Iterable[Any]) -> int:
+    """
+    Estimates the memory used by solutions, i.e. the size of each solution
+    plus the size of its keys and values. A solution is either a solution
+    mappings, or a compact record whose __slots__ are tuples of values.
+    Strings shared between solutions are counted once per solution.
+
+    Parameters
+    ----------
+    solutions: Iterable[Any]
+        The solutions mappings or records.
+
+    Returns
+    -------
+    int
+        The estimated size of the solutions (bytes).
+    """
+    size = 0
+    for solution in solutions:
+        size += sys.getsizeof(solution)
+        if isinstance(solution, dict):
+            for key, value in solution.items():
+                size += sys.getsizeof(key) + sys.getsizeof(value)
+            continue
+        for slot in solution.__slots__:
+            values = getattr(solution, slot)
+            size += sys.getsizeof(values)
+            size += sum(sys.getsizeof(value) for value in values)
+    return size
+
+
+def peak_rss() -> int:
+    """
+    Returns the peak resident set size of the process (bytes), or 0 if it
+    cannot be measured on this platform.
+    """
+    if resource is None:
+        return 0
+    value = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # bytes on macOS, kilobytes on Linux
+        return value
+    return value * 1024
 
 
 class Spy():
@@ -8,10 +64,11 @@ class Spy():
     Parameters
     ----------
     execution_time: float
-        The time spent on the execution of the query (seconds).
+        The time spent on the execution of the query, measured with
+        time.perf_counter (milliseconds).
     data_transfer: float
-        The amount of data transferred during the execution of the query
-        (bytes).
+        The amount of data transferred during the execution of the query,
+        i.e. the size of the bodies of the requests and responses (bytes).
     http_calls: int
         The number of HTTP calls sent to the server during the execution of the
         query.
@@ -21,8 +78,60 @@ class Spy():
         The time spent resuming saved plans by the server.
     saving_time: float
         The time spent saving query plans by the server.
+    cpu_time: float
+        The CPU time spent by the client, measured with time.process_time
+        (milliseconds).
+    encode_time: float
+        The time spent encoding the JSON requests (milliseconds).
+    http_time: float
+        The time spent waiting for the responses of the server (milliseconds).
+    decode_time: float
+        The time spent decoding the JSON responses (milliseconds).
+    topk_time: float
+        The time spent merging solutions into the client-side TOP-K
+        (milliseconds).
+    threshold_time: float
+        The time spent updating the threshold in the saved plans
+        (milliseconds).
+    formatting_time: float
+        The time spent formatting the final solutions (milliseconds).
+    checkpoint_time: float
+        The time spent saving the state of the query on disk, to resume it
+        if it is interrupted (milliseconds).
+    process_peak_rss: int
+        The peak resident set size of the client process since it started
+        (bytes), as it cannot be reset. It is only specific to a query when
+        each query is executed in its own process, e.g. by topk-run.
+    tracemalloc_peak: int
+        The peak of memory allocated by Python during the execution of the
+        query, measured with tracemalloc (bytes).
+    topk_solutions: int
+        The number of solutions held by the client at the end of the query.
+    topk_bytes: int
+        The estimated size of the solutions held by the client (bytes).
+    early_termination: bool
+        True if the client stopped requesting quanta as soon as its TOP-K
+        could not change anymore, as the server produced solutions sorted on
+        the ORDER BY keys. Only the stand-in server reports the sorted access
+        paths of its quanta, otherwise the client deduces them from the first
+        triple pattern of the query, when the join order is forced.
+    skipped_scan: int
+        The number of solutions that the server did not scan as the client
+        stopped early, as estimated by the server.
+    skipped_quanta: int
+        The number of quanta that the client did not request as it stopped
+        early, estimated from the solutions scanned by the last quantum.
+    continuation: None | str
+        The token used to request the next page of the query, or None if the
+        query has no next page. It is not a statistic, so it is not part of
+        the dataframe.
     """
 
+    # the phases of the execution of a query measured on the client side
+    TIMERS = [
+        "encode_time", "http_time", "decode_time", "topk_time",
+        "threshold_time", "formatting_time", "checkpoint_time"]
+
     def __init__(self):
         self._execution_time = 0.0
         self._data_transfer = 0.0
@@ -30,6 +139,17 @@ class Spy():
         self._nb_solutions = 0
         self._resuming_time = 0.0
         self._saving_time = 0.0
+        self._cpu_time = 0.0
+        self._timers = dict.fromkeys(Spy.TIMERS, 0.0)
+        self._tracks_memory = False
+        self._process_peak_rss = 0
+        self._tracemalloc_peak = 0
+        self._topk_solutions = 0
+        self._topk_bytes = 0
+        self._early_termination = False
+        self._skipped_scan = 0
+        self._skipped_quanta = 0
+        self._continuation = None
 
     @property
     def execution_time(self) -> float:
@@ -47,6 +167,42 @@ class Spy():
     def solutions(self) -> int:
         return self._nb_solutions
 
+    @property
+    def cpu_time(self) -> float:
+        return self._cpu_time
+
+    @property
+    def timers(self) -> Dict[str, float]:
+        return dict(self._timers)
+
+    @property
+    def tracks_memory(self) -> bool:
+        return self._tracks_memory
+
+    @property
+    def process_peak_rss(self) -> int:
+        return self._process_peak_rss
+
+    @property
+    def tracemalloc_peak(self) -> int:
+        return self._tracemalloc_peak
+
+    @property
+    def early_termination(self) -> bool:
+        return self._early_termination
+
+    @property
+    def skipped_scan(self) -> int:
+        return self._skipped_scan
+
+    @property
+    def skipped_quanta(self) -> int:
+        return self._skipped_quanta
+
+    @property
+    def continuation(self) -> Optional[str]:
+        return self._continuation
+
     def report_execution_time(self, value: float) -> None:
         self._execution_time += value
 
@@ -65,11 +221,144 @@ class Spy():
     def report_saving_time(self, value: float) -> None:
         self._saving_time += value
 
+    def report_cpu_time(self, value: float) -> None:
+        self._cpu_time += value
+
+    def report_early_termination(
+        self, remaining: Optional[int] = None, scanned: Optional[int] = None
+    ) -> None:
+        """
+        Reports that the client stopped requesting quanta early, with the work
+        saved as estimated by the server.
+
+        Parameters
+        ----------
+        remaining: None | int - (default = None)
+            The number of solutions that the server did not scan yet.
+        scanned: None | int - (default = None)
+            The number of solutions scanned by the last quantum.
+        """
+        self._early_termination = True
+        if remaining is not None:
+            self._skipped_scan += remaining
+            if scanned is not None and scanned > 0:
+                self._skipped_quanta += math.ceil(remaining / scanned)
+
+    def report_continuation(self, token: Optional[str]) -> None:
+        self._continuation = token
+
+    def report_time(self, timer: str, value: float) -> None:
+        self._timers[timer] += value
+
+    def merge(self, other: "Spy", timers: bool = True) -> None:
+        """
+        Adds the HTTP calls, the data transfer and the time spent by the
+        server and in each phase of another spy.
+
+        Parameters
+        ----------
+        other: Spy
+            The spy to merge into this one.
+        timers: bool - (default = True)
+            True to also add the time spent in each phase of the other spy,
+            False otherwise.
+        """
+        self._data_transfer += other._data_transfer
+        self._http_calls += other._http_calls
+        self._resuming_time += other._resuming_time
+        self._saving_time += other._saving_time
+        if timers:
+            for timer in Spy.TIMERS:
+                self._timers[timer] += other._timers[timer]
+        self._early_termination |= other._early_termination
+        self._skipped_scan += other._skipped_scan
+        self._skipped_quanta += other._skipped_quanta
+
+    def merge_concurrent(self, others: List["Spy"]) -> None:
+        """
+        Merges the spies of executions that ran concurrently, e.g. the
+        partitions of a query. Counters are added, but the time spent in each
+        phase is the one of the slowest execution, i.e. the one that spent
+        the most time in all phases, so that the phases do not add up to more
+        than the execution time of the query.
+
+        Parameters
+        ----------
+        others: List[Spy]
+            The spies to merge into this one.
+        """
+        for other in others:
+            self.merge(other, timers=False)
+        if len(others) == 0:
+            return
+        slowest = max(others, key=lambda other: sum(other._timers.values()))
+        for timer in Spy.TIMERS:
+            self._timers[timer] += slowest._timers[timer]
+
+    @contextmanager
+    def measure(self, timer: str) -> Iterator[None]:
+        """
+        Measures the time spent in a block of code with a monotonic
+        high-resolution clock, and adds it to one of the TIMERS.
+
+        Parameters
+        ----------
+        timer: str
+            The name of the timer, e.g. "http_time".
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._timers[timer] += (time.perf_counter() - start) * 1000
+
+    def report_topk_memory(self, solutions: Iterable[Any]) -> None:
+        solutions = list(solutions)
+        self._topk_solutions = len(solutions)
+        self._topk_bytes = sizeof_solutions(solutions)
+
+    @contextmanager
+    def track_memory(self, allocations: bool = False) -> Iterator[None]:
+        """
+        Tracks the memory used by the client during the execution of a query,
+        i.e. the peak RSS of the process so far and the solutions held by the
+        client. Approaches only estimate the size of their solutions when the
+        memory is tracked, as it is costly.
+
+        Parameters
+        ----------
+        allocations: bool - (default = False)
+            True to also measure the peak of memory allocated by Python with
+            tracemalloc, which slows the client down, False otherwise.
+        """
+        self._tracks_memory = True
+        started = allocations and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        elif allocations:
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            if allocations:
+                self._tracemalloc_peak = tracemalloc.get_traced_memory()[1]
+            if started:
+                tracemalloc.stop()
+            self._process_peak_rss = peak_rss()
+            self._tracks_memory = False
+
     def to_dataframe(self) -> DataFrame:
         columns = [
             "execution_time", "data_transfer", "http_calls", "solutions",
-            "resuming_time", "saving_time"]
+            "resuming_time", "saving_time", "cpu_time", *Spy.TIMERS,
+            "process_peak_rss", "tracemalloc_peak", "topk_solutions",
+            "topk_bytes", "early_termination", "skipped_scan",
+            "skipped_quanta"]
         rows = [[
             self._execution_time, self._data_transfer, self._http_calls,
-            self._nb_solutions, self._resuming_time, self._saving_time]]
+            self._nb_solutions, self._resuming_time, self._saving_time,
+            self._cpu_time, *[self._timers[timer] for timer in Spy.TIMERS],
+            self._process_peak_rss, self._tracemalloc_peak,
+            self._topk_solutions, self._topk_bytes, self._early_termination,
+            self._skipped_scan, self._skipped_quanta]]
         return DataFrame(rows, columns=columns)
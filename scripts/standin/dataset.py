@@ -0,0 +1,269 @@
+import random
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+DC = "http://purl.org/dc/terms/"
+FOAF = "http://xmlns.com/foaf/"
+GR = "http://purl.org/goodrelations/"
+GN = "http://www.geonames.org/ontology#"
+MO = "http://purl.org/ontology/mo/"
+OG = "http://ogp.me/ns#"
+REV = "http://purl.org/stuff/rev#"
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+SORG = "http://schema.org/"
+WSDBM = "http://db.uwaterloo.ca/~galuc/wsdbm/"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+
+class TripleStore():
+    """
+    This class implements an in-memory triple store. RDF terms are stored as
+    strings formatted as in the responses of a SaGe server, i.e. IRIs are not
+    enclosed in angle brackets and the datatype of a literal is written
+    "value"^^datatype. Triples are returned in their insertion order, so that
+    the evaluation of a query is deterministic.
+    """
+
+    def __init__(self) -> None:
+        self._spo = dict()
+        self._pos = dict()
+        self._ps = dict()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def statistics(self) -> Dict[str, int]:
+        """
+        Returns the number of triples of each predicate.
+        """
+        return {
+            predicate: len(pairs) for predicate, pairs in self._ps.items()}
+
+    def add(self, subject: str, predicate: str, obj: str) -> None:
+        """
+        Inserts a triple in the store.
+
+        Parameters
+        ----------
+        subject: str
+            The subject of the triple.
+        predicate: str
+            The predicate of the triple.
+        obj: str
+            The object of the triple.
+        """
+        predicates = self._spo.setdefault(subject, dict())
+        predicates.setdefault(predicate, list()).append(obj)
+        objects = self._pos.setdefault(predicate, dict())
+        objects.setdefault(obj, list()).append(subject)
+        self._ps.setdefault(predicate, list()).append((subject, obj))
+        self._size += 1
+
+    def search(
+        self, subject: Optional[str], predicate: Optional[str],
+        obj: Optional[str]
+    ) -> Iterator[Tuple[str, str, str]]:
+        """
+        Returns the triples that match a triple pattern.
+
+        Parameters
+        ----------
+        subject: None | str
+            The subject of the triple pattern, or None if it is a variable.
+        predicate: None | str
+            The predicate of the triple pattern, or None if it is a variable.
+        obj: None | str
+            The object of the triple pattern, or None if it is a variable.
+
+        Returns
+        -------
+        Iterator[Tuple[str, str, str]]
+            The triples that match the triple pattern.
+        """
+        if subject is not None:
+            predicates = self._spo.get(subject, dict())
+            if predicate is not None:
+                candidates = [predicate]
+            else:
+                candidates = list(predicates.keys())
+            for p in candidates:
+                for o in predicates.get(p, []):
+                    if obj is None or o == obj:
+                        yield (subject, p, o)
+        elif predicate is not None and obj is not None:
+            for s in self._pos.get(predicate, dict()).get(obj, []):
+                yield (s, predicate, obj)
+        elif predicate is not None:
+            for s, o in self._ps.get(predicate, []):
+                yield (s, predicate, o)
+        else:
+            for p, pairs in self._ps.items():
+                for s, o in pairs:
+                    if obj is None or o == obj:
+                        yield (s, p, o)
+
+
+def literal(value: str) -> str:
+    return f'"{value}"'
+
+
+def typed_literal(value: str, datatype: str) -> str:
+    return f'"{value}"^^{XSD}{datatype}'
+
+
+def generate_watdiv(scale: int = 1000, seed: int = 0) -> TripleStore:
+    """
+    Generates a dataset that follows the schema of the WatDiv benchmark, i.e.
+    that contains all the predicates used by the watdiv workloads, with
+    joins between users, products, offers, reviews and websites. The dataset
+    only depends on its scale and on the seed of the random generator.
+
+    Parameters
+    ----------
+    scale: int - (default = 1000)
+        The number of users. The number of other entities is proportional.
+    seed: int - (default = 0)
+        The seed of the random generator.
+
+    Returns
+    -------
+    TripleStore
+        A triple store that contains the generated dataset.
+    """
+    rng = random.Random(seed)
+    store = TripleStore()
+
+    def entities(name: str, count: int) -> List[str]:
+        return [f"{WSDBM}{name}{index}" for index in range(max(count, 1))]
+
+    users = entities("User", scale)
+    products = entities("Product", scale // 4)
+    retailers = entities("Retailer", scale // 100)
+    offers = entities("Offer", scale // 2)
+    reviews = entities("Review", scale // 2)
+    purchases = entities("Purchase", scale // 2)
+    websites = entities("Website", scale // 20)
+    cities = entities("City", scale // 50)
+    countries = entities("Country", 25)
+    genres = entities("SubGenre", 20)
+    topics = entities("Topic", scale // 10)
+    languages = entities("Language", 25)
+    roles = entities("Role", 3)
+    categories = entities("ProductCategory", 15)
+    genders = entities("Gender", 2)
+
+    def some(values: List[str], maximum: int) -> List[str]:
+        return rng.sample(values, rng.randint(0, min(maximum, len(values))))
+
+    def maybe(probability: float) -> bool:
+        return rng.random() < probability
+
+    def date(start: int = 2000, end: int = 2015) -> str:
+        return typed_literal((
+            f"{rng.randint(start, end)}-{rng.randint(1, 12):02d}-"
+            f"{rng.randint(1, 28):02d}"), "date")
+
+    def text(prefix: str) -> str:
+        return literal(f"{prefix} {rng.randint(0, scale * 10)}")
+
+    for city in cities:
+        store.add(city, f"{GN}parentCountry", rng.choice(countries))
+
+    for user in users:
+        store.add(user, f"{RDF}type", rng.choice(roles))
+        store.add(user, f"{DC}Location", rng.choice(cities))
+        store.add(user, f"{SORG}nationality", rng.choice(countries))
+        store.add(user, f"{WSDBM}gender", rng.choice(genders))
+        if maybe(0.8):
+            store.add(user, f"{FOAF}age", typed_literal(
+                str(rng.randint(10, 90)), "integer"))
+        if maybe(0.9):
+            store.add(user, f"{FOAF}givenName", text("GivenName"))
+        if maybe(0.9):
+            store.add(user, f"{FOAF}familyName", text("FamilyName"))
+        if maybe(0.3):
+            store.add(user, f"{SORG}jobTitle", text("JobTitle"))
+        if maybe(0.2):
+            store.add(user, f"{FOAF}homepage", rng.choice(websites))
+        for product in some(products, 3):
+            store.add(user, f"{WSDBM}likes", product)
+        for friend in some(users, 4):
+            store.add(user, f"{WSDBM}friendOf", friend)
+        for website in some(websites, 2):
+            store.add(user, f"{WSDBM}subscribes", website)
+
+    for product in products:
+        store.add(product, f"{RDF}type", rng.choice(categories))
+        store.add(product, f"{OG}title", text("Title"))
+        store.add(product, f"{WSDBM}hasGenre", rng.choice(genres))
+        for attribute, probability in [
+            ("caption", 0.5), ("text", 0.5), ("description", 0.5),
+            ("keywords", 0.4), ("trailer", 0.1), ("publisher", 0.2)
+        ]:
+            if maybe(probability):
+                store.add(
+                    product, f"{SORG}{attribute}", text(attribute.title()))
+        if maybe(0.4):
+            store.add(product, f"{SORG}contentRating", literal(
+                rng.choice(["G", "PG", "PG-13", "R", "NC-17"])))
+        if maybe(0.5):
+            store.add(product, f"{SORG}contentSize", typed_literal(
+                str(rng.randint(1, 10000)), "integer"))
+        if maybe(0.3):
+            store.add(product, f"{SORG}language", rng.choice(languages))
+        if maybe(0.3):
+            store.add(product, f"{FOAF}homepage", rng.choice(websites))
+        for topic in some(topics, 3):
+            store.add(product, f"{OG}tag", topic)
+        for actor in some(users, 2):
+            store.add(product, f"{SORG}actor", actor)
+        if maybe(0.1):
+            store.add(product, f"{MO}artist", rng.choice(users))
+        if maybe(0.05):
+            store.add(product, f"{MO}conductor", rng.choice(users))
+
+    for review in reviews:
+        store.add(rng.choice(products), f"{REV}hasReview", review)
+        store.add(review, f"{REV}title", text("ReviewTitle"))
+        store.add(review, f"{REV}reviewer", rng.choice(users))
+        if maybe(0.5):
+            store.add(review, f"{REV}totalVotes", typed_literal(
+                str(rng.randint(0, 100)), "integer"))
+
+    for retailer in retailers:
+        store.add(retailer, f"{SORG}legalName", text("LegalName"))
+
+    for offer in offers:
+        store.add(rng.choice(retailers), f"{GR}offers", offer)
+        store.add(offer, f"{GR}includes", rng.choice(products))
+        store.add(offer, f"{GR}price", typed_literal(
+            str(rng.randint(1, 1000)), "integer"))
+        store.add(offer, f"{GR}serialNumber", typed_literal(
+            str(rng.randint(1, 10 ** 8)), "integer"))
+        store.add(offer, f"{GR}validFrom", date(2000, 2010))
+        store.add(offer, f"{GR}validThrough", date(2010, 2015))
+        store.add(offer, f"{SORG}eligibleQuantity", typed_literal(
+            str(rng.randint(1, 100)), "integer"))
+        store.add(offer, f"{SORG}eligibleRegion", rng.choice(countries))
+        store.add(offer, f"{SORG}priceValidUntil", date(2010, 2015))
+
+    for purchase in purchases:
+        store.add(rng.choice(users), f"{WSDBM}makesPurchase", purchase)
+        store.add(purchase, f"{WSDBM}purchaseFor", rng.choice(products))
+        store.add(purchase, f"{WSDBM}purchaseDate", date())
+
+    for website in websites:
+        store.add(website, f"{SORG}url", literal(f"{website}/index.html"))
+        store.add(website, f"{WSDBM}hits", typed_literal(
+            str(rng.randint(0, 10 ** 6)), "integer"))
+        store.add(website, f"{SORG}language", rng.choice(languages))
+
+    for genre in genres:
+        store.add(genre, f"{RDF}type", f"{WSDBM}Genre")
+        for topic in some(topics, 2):
+            store.add(genre, f"{OG}tag", topic)
+
+    return store
+
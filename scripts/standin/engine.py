@@ -0,0 +1,507 @@
+import heapq
+import itertools
+import threading
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from functools import cmp_to_key
+from rdflib.plugins.sparql.parser import parseQuery
+from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.plugins.sparql.sparql import Bindings, QueryContext, SPARQLError
+from rdflib.plugins.sparql.operators import EBV
+from rdflib.term import Identifier, Literal, URIRef, Variable
+from rdflib.util import from_n3
+
+from approaches.iterators_pb2 import RootTree
+from standin.dataset import TripleStore
+
+
+class ParsedQuery():
+    """
+    This class represents the parts of a SPARQL query evaluated by the
+    stand-in server: a basic graph pattern, filters, ORDER BY conditions, and
+    a LIMIT/OFFSET. As rdflib reorders triple patterns, the first triple
+    pattern of the query, as written, is also kept.
+
+    Parameters
+    ----------
+    query: str
+        A SPARQL query.
+    """
+
+    def __init__(self, query: str) -> None:
+        parsed = parseQuery(query)
+        written = self.__written_terms__(parsed)
+        algebra = translateQuery(parsed).algebra
+        self.patterns = list()
+        self.filters = list()
+        self.order = list()
+        self.limit = None
+        self.offset = 0
+        self.variables = [variable.n3() for variable in algebra["PV"]]
+        nodes = [algebra]
+        while len(nodes) > 0:
+            node = nodes.pop()
+            if node.name in ["SelectQuery", "Project"]:
+                nodes.append(node.p)
+            elif node.name == "Slice":
+                self.limit = node.length
+                self.offset = node.start or 0
+                nodes.append(node.p)
+            elif node.name == "OrderBy":
+                for condition in node.expr:
+                    order = "DESC" if condition.order == "DESC" else "ASC"
+                    self.order.append((condition.expr, order))
+                nodes.append(node.p)
+            elif node.name == "Filter":
+                self.filters.append(node.expr)
+                nodes.append(node.p)
+            elif node.name == "Join":
+                nodes.extend([node.p2, node.p1])
+            elif node.name == "BGP":
+                for triple in node.triples:
+                    self.patterns.append(tuple(
+                        term if isinstance(term, Variable) else to_sage(term)
+                        for term in triple))
+            else:
+                raise Exception(f"Unsupported SPARQL operator: {node.name}")
+        self.key = (tuple(self.patterns), str(self.filters))
+        # the subject and the object of the first triple pattern identify it
+        self.first = None
+        for pattern in self.patterns:
+            if all(
+                not isinstance(term, Variable) or term == written_term
+                for term, written_term in zip(pattern, written)
+            ):
+                self.first = pattern
+                break
+
+    def __written_terms__(self, parsed: Any) -> List[Any]:
+        """
+        Returns the terms of the first triple pattern of a parsed query, as
+        written, i.e. before prefixes and property paths are translated.
+        """
+        for part in parsed[1]["where"].get("part", []):
+            if part.name == "TriplesBlock" and len(part["triples"]) > 0:
+                return list(part["triples"][0][:3])
+        return []
+
+
+def to_sage(term: Identifier) -> str:
+    """
+    Formats an RDFLib term as in the responses of a SaGe server.
+
+    Parameters
+    ----------
+    term: Identifier
+        An RDFLib term.
+
+    Returns
+    -------
+    str
+        The RDF term formatted as in the responses of a SaGe server.
+    """
+    if isinstance(term, Literal):
+        if term.language is not None:
+            return f'"{term}"@{term.language}'
+        elif term.datatype is not None:
+            return f'"{term}"^^{term.datatype}'
+        return f'"{term}"'
+    return str(term)
+
+
+def to_rdflib(value: str) -> Identifier:
+    """
+    Formats an RDF term received from a SaGe server into an RDFLib term.
+
+    Parameters
+    ----------
+    value: str
+        An RDF term formatted as in the responses of a SaGe server.
+
+    Returns
+    -------
+    Identifier
+        The RDF term formatted for the RDFLib.
+    """
+    if value.startswith("http"):
+        return URIRef(value)
+    elif '"^^http' in value:
+        index = value.find('"^^http')
+        value = f"{value[0:index+3]}<{value[index+3:]}>"
+    return from_n3(value)
+
+
+class StandInEngine():
+    """
+    This class implements a stand-in for a SaGe server. It speaks the same
+    JSON protocol as SaGe, supports the default, the "topk_server" and the
+    "partial_topk" strategies, and evaluates basic graph patterns with filters
+    over an in-memory triple store.
+
+    Query execution is preemptive: a quantum processes a fixed number of
+    solutions, computed from the quota, so quanta boundaries do not depend on
+    the speed of the machine. Saved plans are encoded as in SaGe, so that
+    clients can update the threshold of the "partial_topk" strategy. Solutions
+    are ordered on the string representation of the ORDER BY keys, as done by
+    the clients.
+
+    When the client forces the join order, the first triple pattern of the
+    query is the access path of the query. If its predicate is bound, it is
+    scanned in an index sorted on objects then subjects, so solutions are
+    produced sorted on these variables. The statistics of each quantum then
+    report these variables, their values in the last solution scanned, and
+    the number of solutions that remain to be scanned. These statistics are
+    not part of the SaGe protocol.
+
+    Parameters
+    ----------
+    store: TripleStore
+        The triple store that contains the dataset.
+    quota: int - (default = 75)
+        The quota used when the client does not define one (ms).
+    steps_per_ms: int - (default = 100)
+        The number of solutions processed per millisecond of quota.
+    max_limit: int - (default = 10000)
+        The maximum size of a TOP-k computed by the server.
+    """
+
+    def __init__(
+        self, store: TripleStore, quota: int = 75, steps_per_ms: int = 100,
+        max_limit: int = 10000
+    ) -> None:
+        self._store = store
+        self._quota = quota
+        self._steps_per_ms = steps_per_ms
+        self._max_limit = max_limit
+        self._queries = dict()
+        self._results = OrderedDict()
+        self._plans = dict()
+        self._identifiers = itertools.count()  # never reused
+        self._lock = threading.Lock()
+
+    def __parse__(self, query: str) -> ParsedQuery:
+        if query not in self._queries:
+            self._queries[query] = ParsedQuery(query)
+        return self._queries[query]
+
+    def __filter__(self, query: ParsedQuery, mappings: Dict[str, str]) -> bool:
+        if len(query.filters) == 0:
+            return True
+        bindings = {
+            Variable(key[1:]): to_rdflib(value)
+            for key, value in mappings.items()}
+        context = QueryContext(bindings=Bindings(d=bindings))
+        try:
+            for expr in query.filters:
+                if isinstance(expr, Variable):
+                    value = bindings.get(expr)
+                else:
+                    value = expr.eval(context)
+                if isinstance(value, SPARQLError) or not EBV(value):
+                    return False
+        except SPARQLError:
+            return False
+        return True
+
+    def __order_patterns__(
+        self, patterns: List[Tuple], first: Optional[Tuple] = None
+    ) -> List[Tuple]:
+        """
+        Orders the triple patterns of a basic graph pattern so that each
+        pattern shares a variable with the previous ones whenever possible.
+        If defined, the first triple pattern is evaluated first.
+        """
+        ordered = list()
+        bound = set()
+        remaining = list(patterns)
+        if first is not None:
+            remaining.remove(first)
+            bound.update([t for t in first if isinstance(t, Variable)])
+            ordered.append(first)
+        while len(remaining) > 0:
+            best = 0
+            best_score = -1
+            for index, pattern in enumerate(remaining):
+                score = sum([
+                    1 for term in pattern
+                    if not isinstance(term, Variable) or term in bound])
+                if score > best_score:
+                    best, best_score = index, score
+            pattern = remaining.pop(best)
+            bound.update([t for t in pattern if isinstance(t, Variable)])
+            ordered.append(pattern)
+        return ordered
+
+    def __sorted_access__(
+        self, query: ParsedQuery, pattern: Tuple
+    ) -> List[Tuple[str, str]]:
+        """
+        Returns the variables on which the solutions are sorted when a triple
+        pattern is scanned first, i.e. its object then its subject if they
+        are variables and its predicate is bound. The index is scanned
+        backward if the query is sorted in descending order of the object.
+        """
+        subject, predicate, obj = pattern
+        if isinstance(predicate, Variable) or not isinstance(obj, Variable):
+            return []
+        order = "ASC"
+        if len(query.order) > 0 and query.order[0][0] == obj:
+            order = query.order[0][1]
+        variables = [(obj.n3(), order)]
+        if isinstance(subject, Variable) and subject != obj:
+            variables.append((subject.n3(), order))
+        return variables
+
+    def __evaluate__(
+        self, query: ParsedQuery, force_order: bool = False
+    ) -> Tuple[List[Dict[str, str]], List[Tuple[str, str]]]:
+        """
+        Evaluates the basic graph pattern and the filters of a query, and
+        returns its solutions with the variables on which they are sorted.
+        Results are cached, so resuming a query does not evaluate it again.
+        """
+        key = (query.key, force_order)
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+        first = None
+        variables = []
+        if force_order and query.first is not None:
+            first = query.first
+            variables = self.__sorted_access__(query, first)
+        patterns = self.__order_patterns__(query.patterns, first=first)
+        results = list()
+        stack = [(0, dict())]
+        while len(stack) > 0:
+            index, mappings = stack.pop()
+            if index == len(patterns):
+                if self.__filter__(query, mappings):
+                    results.append(mappings)
+                continue
+            pattern = [
+                mappings.get(term.n3()) if isinstance(term, Variable)
+                else term for term in patterns[index]]
+            triples = self._store.search(*pattern)
+            if index == 0 and len(variables) > 0:  # sorted access
+                triples = sorted(
+                    triples, key=lambda triple: (triple[2], triple[0]),
+                    reverse=(variables[0][1] == "DESC"))
+            candidates = list()
+            for triple in triples:
+                extended = dict(mappings)
+                consistent = True
+                for term, value in zip(patterns[index], triple):
+                    if isinstance(term, Variable):
+                        if extended.setdefault(term.n3(), value) != value:
+                            consistent = False
+                if consistent:
+                    candidates.append((index + 1, extended))
+            stack.extend(reversed(candidates))
+        self._results[key] = (results, variables)
+        if len(self._results) > 32:
+            self._results.popitem(last=False)
+        return results, variables
+
+    def __keys__(
+        self, query: ParsedQuery, mappings: Dict[str, str]
+    ) -> Dict[str, str]:
+        keys = dict()
+        for index, (expr, _) in enumerate(query.order):
+            if isinstance(expr, Variable):
+                value = mappings.get(expr.n3(), "")
+            else:
+                bindings = {
+                    Variable(key[1:]): to_rdflib(value)
+                    for key, value in mappings.items()}
+                context = QueryContext(bindings=Bindings(d=bindings))
+                try:
+                    value = expr.eval(context)
+                    value = "" if isinstance(value, SPARQLError) else str(
+                        to_sage(value))
+                except SPARQLError:
+                    value = ""
+            keys[f"__order_condition_{index}"] = value
+        return keys
+
+    def __compare__(
+        self, query: ParsedQuery, first: Dict[str, str],
+        second: Dict[str, str]
+    ) -> int:
+        for index, (_, order) in enumerate(query.order):
+            key = f"__order_condition_{index}"
+            if first[key] == second[key]:
+                continue
+            smaller = first[key] < second[key]
+            if order == "DESC":
+                smaller = not smaller
+            return -1 if smaller else 1
+        return 0
+
+    def __encode__(self, state: Dict[str, Any], stateless: bool) -> str:
+        root = RootTree()
+        if state["strategy"] == "partial_topk":
+            topk = root.proj_source.partial_topk_source
+            topk.scan_source.last_read = str(state["position"])
+            topk.limit = state["limit"]
+            for key, value in state["threshold"].items():
+                topk.threshold[key] = value
+        elif state["strategy"] == "topk_server":
+            topk = root.proj_source.topk_server_source
+            topk.scan_source.last_read = str(state["position"])
+            topk.limit = state["limit"]
+            for mappings in state["topk"]:
+                solution = topk.topk.add()
+                for key, value in mappings.items():
+                    solution.bindings[key] = value
+        elif state["limit"] is not None:
+            root.limit_source.scan_source.last_read = str(state["position"])
+            root.limit_source.limit = state["limit"]
+            root.limit_source.produced = state["produced"]
+        else:
+            root.proj_source.scan_source.last_read = str(state["position"])
+        plan = b64encode(root.SerializeToString()).decode("utf-8")
+        if stateless:
+            return plan
+        with self._lock:
+            identifier = str(next(self._identifiers))
+            self._plans[identifier] = plan
+        return identifier
+
+    def __decode__(self, plan: str, stateless: bool) -> Dict[str, Any]:
+        if not stateless:
+            plan = self._plans.pop(plan)
+        root = RootTree()
+        root.ParseFromString(b64decode(plan))
+        state = {"threshold": dict(), "topk": list(), "produced": 0}
+        if root.WhichOneof("source") == "limit_source":
+            state["strategy"] = None
+            state["position"] = int(root.limit_source.scan_source.last_read)
+            state["limit"] = root.limit_source.limit
+            state["produced"] = root.limit_source.produced
+            return state
+        projection = root.proj_source
+        source = projection.WhichOneof("source")
+        if source == "partial_topk_source":
+            topk = projection.partial_topk_source
+            state["strategy"] = "partial_topk"
+            state["threshold"] = dict(topk.threshold)
+        elif source == "topk_server_source":
+            topk = projection.topk_server_source
+            state["strategy"] = "topk_server"
+            state["topk"] = [
+                dict(solution.bindings) for solution in topk.topk]
+        else:
+            state["strategy"] = None
+            state["limit"] = None
+            state["position"] = int(projection.scan_source.last_read)
+            return state
+        state["position"] = int(topk.scan_source.last_read)
+        state["limit"] = topk.limit
+        return state
+
+    def execute(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Executes a quantum of a SPARQL query, as a SaGe server does when it
+        receives a request.
+
+        Parameters
+        ----------
+        payload: Dict[str, Any]
+            The body of a request sent to a SaGe server, i.e. the query, the
+            saved plan of the query, the quota, the TOP-k strategy, ...
+
+        Returns
+        -------
+        Dict[str, Any]
+            The body of the response of a SaGe server, i.e. the solutions
+            produced during the quantum, the saved plan of the query, and
+            statistics about the quantum.
+        """
+        stateless = payload.get("stateless", True)
+        quota = payload.get("quota") or self._quota
+        budget = max(1, int(quota * self._steps_per_ms))
+
+        with self._lock:
+            query = self.__parse__(payload["query"])
+            results, variables = self.__evaluate__(
+                query, payload.get("forceOrder", False))
+
+        start = time.perf_counter()
+        if payload.get("next") is not None:
+            state = self.__decode__(payload["next"], stateless)
+        else:
+            strategy = payload.get("topkStrategy")
+            if len(query.order) == 0:
+                strategy = None
+            limit = query.limit
+            if strategy is not None:
+                max_limit = payload.get("maxLimit") or self._max_limit
+                limit = min(limit or max_limit, max_limit)
+            state = {
+                "strategy": strategy, "position": 0, "produced": 0,
+                "limit": limit, "threshold": dict(), "topk": list()}
+            if strategy is None:
+                state["position"] = query.offset
+        resuming_time = (time.perf_counter() - start) * 1000
+
+        end = min(state["position"] + budget, len(results))
+        scanned = results[state["position"]:end]
+        state["position"] = end
+        has_next = end < len(results)
+
+        compare = cmp_to_key(
+            lambda first, second: self.__compare__(query, first, second))
+        bindings = list()
+        if state["strategy"] is None:
+            if state["limit"] is not None:
+                scanned = scanned[:state["limit"] - state["produced"]]
+                state["produced"] += len(scanned)
+                has_next = has_next and state["produced"] < state["limit"]
+            bindings = [dict(mappings) for mappings in scanned]
+        else:
+            threshold = state["threshold"]
+            candidates = list()
+            for mappings in scanned:
+                solution = dict(mappings)
+                solution.update(self.__keys__(query, mappings))
+                if len(threshold) > 0 and self.__compare__(
+                    query, solution, threshold
+                ) >= 0:
+                    continue
+                candidates.append(solution)
+            if state["strategy"] == "partial_topk":
+                bindings = heapq.nsmallest(
+                    state["limit"], candidates, key=compare)
+            else:
+                state["topk"] = heapq.nsmallest(
+                    state["limit"], state["topk"] + candidates, key=compare)
+                if not has_next:
+                    bindings = state["topk"]
+
+        sorted_access = None
+        if len(variables) > 0 and len(scanned) > 0:
+            sorted_access = {
+                "variables": variables,
+                "last": {
+                    variable: scanned[-1].get(variable, "")
+                    for variable, _ in variables},
+                "remaining": len(results) - end}
+
+        start = time.perf_counter()
+        next_plan = None
+        if has_next:
+            next_plan = self.__encode__(state, stateless)
+        saving_time = (time.perf_counter() - start) * 1000
+
+        return {
+            "bindings": bindings,
+            "next": next_plan,
+            "hasNext": has_next,
+            "stats": {
+                "resuming_time": resuming_time,
+                "saving_time": saving_time,
+                "scanned": len(scanned),
+                "sorted": sorted_access}}
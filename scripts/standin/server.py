@@ -0,0 +1,66 @@
+import json
+import logging
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from standin.engine import StandInEngine
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    This class handles the HTTP requests sent to the stand-in server. As SaGe,
+    the server expects JSON payloads sent with POST requests. Connections are
+    kept alive between requests, so Nagle's algorithm is disabled: otherwise,
+    the body of a response waits for the acknowledgement of its headers.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("content-length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length))
+            response = self.server.engine.execute(payload)
+            status = 200
+        except Exception as error:
+            logging.exception("stand-in - the request failed")
+            response = {"error": str(error)}
+            status = 400
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(f"stand-in - {format % args}")
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    This class implements an HTTP server that exposes a stand-in SaGe engine.
+
+    Parameters
+    ----------
+    engine: StandInEngine
+        The engine used to execute queries.
+    host: str - (default = "localhost")
+        The host on which the server listens.
+    port: int - (default = 8080)
+        The port on which the server listens. If 0, a free port is used.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, engine: StandInEngine, host: str = "localhost", port: int = 8080
+    ) -> None:
+        super().__init__((host, port), StandInHandler)
+        self.engine = engine
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/sparql"
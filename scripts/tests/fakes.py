@@ -0,0 +1,67 @@
+import json
+import threading
+
+from contextlib import contextmanager
+
+from approaches.transport import Transport
+from standin.dataset import TripleStore, literal
+from standin.engine import StandInEngine
+from standin.server import StandInServer
+
+EX = "http://example.org/"
+
+CONFIG = {"endpoints": {"sage": {"url": "http://localhost:8080/sparql",
+                                 "graph": "http://localhost:8080/sparql/g"}}}
+
+
+def store(size=500, seed=7):
+    """
+    A triple store where each subject has a value ex:p, and a label ex:q.
+    Values are not unique, so that keys have ties.
+    """
+    store = TripleStore()
+    for index in range(size):
+        subject = f"{EX}s{index:04d}"
+        store.add(subject, f"{EX}p", literal(f"{(index * seed) % 97:03d}"))
+        store.add(subject, f"{EX}q", literal(f"label{index % 13}"))
+    return store
+
+
+class EngineTransport(Transport):
+    """
+    A transport that executes the quanta with a stand-in engine, in process.
+    Without sorted access paths, responses are the ones of a SaGe server.
+    """
+
+    def __init__(self, engine, sorted_access=True):
+        self.engine = engine
+        self.sorted_access = sorted_access
+        self.payloads = []
+
+    def post(self, data):
+        payload = json.loads(data)
+        self.payloads.append(payload)
+        response = self.engine.execute(payload)
+        if not self.sorted_access:
+            del response["stats"]["sorted"]
+        return json.dumps(response).encode("utf-8")
+
+
+def engine(size=500, steps_per_ms=10):
+    return StandInEngine(store(size), steps_per_ms=steps_per_ms)
+
+
+@contextmanager
+def server(size=500, steps_per_ms=10):
+    """
+    Serves a stand-in engine over HTTP, on a free port, while in the context.
+    """
+    standin = StandInServer(engine(size, steps_per_ms), port=0)
+    thread = threading.Thread(target=standin.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield standin
+    finally:
+        standin.shutdown()
+        standin.server_close()
+        thread.join()
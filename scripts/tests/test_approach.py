@@ -0,0 +1,173 @@
+import pytest
+
+from approaches.factory import ApproachFactory
+from spy import Spy
+from tests.fakes import CONFIG, EngineTransport, engine
+
+PREFIX = "PREFIX ex: <http://example.org/> "
+
+QUERY = PREFIX + (
+    "SELECT ?s ?o ?l WHERE { ?s ex:p ?o . ?s ex:q ?l } ORDER BY ?o ?s "
+    "LIMIT 10")
+
+
+def run(approach, query, sorted_access=True, **kwargs):
+    transport = EngineTransport(engine(), sorted_access=sorted_access)
+    approach = ApproachFactory.create(approach, CONFIG, transport=transport)
+    spy = Spy()
+    solutions = approach.execute_query(query, spy, quota=1, **kwargs)
+    approach.close()
+    return solutions, spy, len(transport.payloads)
+
+
+def test_scan_order_is_the_order_of_the_first_triple_pattern():
+    approach = ApproachFactory.create(
+        "sage", CONFIG, transport=EngineTransport(None))
+    assert approach.__scan_order__(QUERY) == [("?o", "ASC"), ("?s", "ASC")]
+    assert approach.__scan_order__(PREFIX + (
+        "SELECT * WHERE { ?s a ?o } ORDER BY ?o")) == [
+            ("?o", "ASC"), ("?s", "ASC")]
+    # unbound predicates and property paths are not sorted
+    assert approach.__scan_order__(
+        "SELECT * WHERE { ?s ?p ?o } ORDER BY ?o") == []
+    assert approach.__scan_order__(PREFIX + (
+        "SELECT * WHERE { ?s ex:p/ex:q ?o } ORDER BY ?o")) == []
+    assert approach.__scan_order__(PREFIX + (
+        "SELECT * WHERE { ?s ex:p+ ?o } ORDER BY ?o")) == []
+    assert approach.__scan_order__(PREFIX + (
+        "SELECT * WHERE { ?s ex:p ex:o } ORDER BY ?s")) == []
+
+
+@pytest.mark.parametrize("name", [
+    "sage", "sage-partial-topk", "sage-partitioned-topk"])
+def test_early_termination_without_the_sorted_access_of_the_server(name):
+    expected, _, quanta = run(name, QUERY, force_order=False)
+    solutions, spy, terminated = run(
+        name, QUERY, sorted_access=False, force_order=True)
+    assert solutions == expected
+    assert spy.early_termination
+    assert terminated < quanta
+
+
+def test_no_early_termination_when_the_order_is_not_the_scan_order():
+    query = QUERY.replace("ORDER BY ?o ?s", "ORDER BY DESC(?o) ?s")
+    expected, _, quanta = run("sage", query, force_order=False)
+    solutions, spy, terminated = run(
+        "sage", query, sorted_access=False, force_order=True)
+    assert solutions == expected
+    assert not spy.early_termination
+    assert terminated == quanta
+
+
+def test_set_limit_rewrites_the_limit_and_the_offset():
+    approach = ApproachFactory.create(
+        "sage", CONFIG, transport=EngineTransport(None))
+    query = "SELECT * WHERE { ?s ?p ?o } ORDER BY ?o"
+    assert approach.__set_limit__(query) == query
+    assert approach.__set_limit__(query, limit=5) == f"{query} LIMIT 5"
+    assert approach.__set_limit__(
+        query, limit=5, offset=3) == f"{query} LIMIT 5 OFFSET 3"
+    assert approach.__set_limit__(
+        f"{query} LIMIT 10 OFFSET 20", limit=5) == f"{query} LIMIT 5"
+    assert approach.__set_limit__(
+        f"{query}\nLIMIT 10\nOFFSET 20", limit=5, offset=2) == (
+            f"{query} LIMIT 5 OFFSET 2")
+    assert approach.__extract_limit__(query) == 10
+    assert approach.__extract_limit__(f"{query} LIMIT 7") == 7
+    assert approach.__extract_offset__(query) == 0
+    assert approach.__extract_offset__(f"{query} LIMIT 7 OFFSET 21") == 21
+
+
+def test_next_page_and_resume_page_round_trip():
+    approach = ApproachFactory.create(
+        "sage", CONFIG, transport=EngineTransport(None))
+    assert approach.__resume_page__(None, 4) == (4, None, 4)
+    # the last page is not full
+    assert approach.__next_page__(0, 9, 10, last=({"?o": "1"}, 1)) is None
+    token = approach.__next_page__(20, 10, 10, last=({"?o": '"5"'}, 3))
+    assert approach.__resume_page__(token, 0) == (30, {"?o": '"5"'}, 3)
+    assert approach.__resume_page__(token, 2) == (32, {"?o": '"5"'}, 5)
+    other = ApproachFactory.create(
+        "sage-topk", CONFIG, transport=EngineTransport(None))
+    with pytest.raises(Exception):
+        other.__resume_page__(token, 0)
+
+
+def test_keyset_keeps_the_ties_of_the_last_solution():
+    approach = ApproachFactory.create(
+        "sage-partial-topk", CONFIG, transport=EngineTransport(None))
+    query = PREFIX + (
+        "SELECT ?s ?o WHERE { ?s ex:p ?o } ORDER BY DESC(?o) ?s LIMIT 500")
+    assert approach.__keyset__(query, None) == query
+    assert approach.__keyset__(PREFIX + (
+        "SELECT ?s ?o WHERE { ?s ex:p ?o } ORDER BY STRLEN(?o) LIMIT 5"), {
+            "?o": '"1"'}) is None
+    solutions = engine().execute({"query": query, "quota": 1000})["bindings"]
+    ties = sorted(
+        [mappings for mappings in solutions if mappings["?o"] == '"042"'],
+        key=lambda mappings: mappings["?s"])
+    assert len(ties) > 2
+    last = ties[1]
+    filtered = engine().execute({
+        "query": approach.__keyset__(query, last), "quota": 1000})["bindings"]
+
+    def after(mappings):  # DESC(?o) then ?s, on their serialization
+        return mappings["?o"] < last["?o"] or (
+            mappings["?o"] == last["?o"] and mappings["?s"] >= last["?s"])
+
+    expected = [mappings for mappings in solutions if after(mappings)]
+    assert sorted(filtered, key=str) == sorted(expected, key=str)
+    # the bound is inclusive, and the ties before it are filtered out
+    assert last in filtered and ties[2] in filtered
+    assert ties[0] not in filtered
+    # without ?s in the ORDER BY clause, all the ties of the last key are kept
+    query = query.replace("DESC(?o) ?s", "DESC(?o)")
+    filtered = engine().execute({
+        "query": approach.__keyset__(query, last), "quota": 1000})["bindings"]
+    assert all(mappings in filtered for mappings in ties)
+    assert len(filtered) == len([
+        mappings for mappings in solutions if mappings["?o"] <= last["?o"]])
+
+
+@pytest.mark.parametrize("name", ["sage", "sage-topk", "sage-partial-topk"])
+def test_pages_equal_one_large_run(name):
+    # ORDER BY ?o only, so that pages end in the middle of ties
+    query = QUERY.replace("ORDER BY ?o ?s", "ORDER BY ?o")
+    expected, _, _ = run(name, query, limit=60)
+    pages = []
+    continuation = None
+    for _ in range(6):
+        solutions, spy, _ = run(
+            name, query, limit=10, continuation=continuation)
+        pages.extend(solutions)
+        continuation = spy.continuation
+    assert len(pages) == 60
+    assert pages == expected
+
+
+class ClosedTransport(EngineTransport):
+
+    def __init__(self):
+        super().__init__(None)
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+
+
+@pytest.mark.parametrize("name", [
+    "sage", "sage-topk", "sage-partial-topk", "sage-partitioned-topk"])
+def test_close_only_closes_the_transport_created_by_the_approach(
+    name, monkeypatch
+):
+    given = ClosedTransport()
+    ApproachFactory.create(name, CONFIG, transport=given).close()
+    assert given.closed == 0
+    created = ClosedTransport()
+    monkeypatch.setattr(
+        f"approaches.{name.replace('-', '_')}.create_transport",
+        lambda *args, **kwargs: created)
+    approach = ApproachFactory.create(name, CONFIG)
+    assert approach._transport is created
+    approach.close()
+    assert created.closed == 1
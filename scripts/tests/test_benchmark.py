@@ -0,0 +1,84 @@
+import math
+import os
+
+import pytest
+
+import benchmark
+
+from approaches.approach import Approach
+
+
+def test_percentiles_interpolate_between_the_closest_ranks():
+    assert benchmark.percentile([1, 2, 3, 4], 50) == 2.5
+    assert benchmark.percentile([4, 1, 3, 2], 50) == 2.5
+    assert benchmark.percentile([1, 2, 3, 4], 0) == 1
+    assert benchmark.percentile([1, 2, 3, 4], 100) == 4
+    # the rank of the 95th percentile of 11 values is 9.5
+    values = [float(value) for value in range(0, 110, 10)]
+    assert benchmark.percentile(values, 95) == pytest.approx(95.0)
+    assert benchmark.percentile([10, 20], 99) == pytest.approx(19.9)
+
+
+def test_percentiles_of_no_values_or_a_single_value():
+    assert math.isnan(benchmark.percentile([], 50))
+    for p in [0, 50, 95, 100]:
+        assert benchmark.percentile([7.5], p) == 7.5
+
+
+def test_the_summary_of_failed_executions():
+    measures = [
+        {"latency": 5.0, "cpu_time": 1.0, "data_transfer": 10,
+         "http_calls": 2, "error": None},
+        {"latency": 50.0, "cpu_time": 3.0, "data_transfer": 0,
+         "http_calls": 0, "error": "timeout"}]
+    report = benchmark.summarize("sage", measures, 1000.0, 2, 1, 1)
+    assert list(report) == benchmark.COLUMNS
+    assert report["errors"] == 1
+    assert report["qps"] == 1.0
+    # failed executions are not part of the latencies
+    assert report["latency_p99"] == report["latency_max"] == 5.0
+    assert report["cpu_time_per_query"] == 2.0
+    report = benchmark.summarize("sage", measures[1:], 1000.0, 1, 1, 1)
+    assert math.isnan(report["latency_p50"])
+    assert math.isnan(report["latency_max"])
+
+
+class Recorder(Approach):
+    """
+    An approach that records the processes in which it executes queries, and
+    the ones in which it is closed.
+    """
+
+    def __init__(self, directory):
+        super().__init__("recorder")
+        self.directory = directory
+
+    def touch(self, event):
+        path = os.path.join(self.directory, f"{event}-{os.getpid()}")
+        open(path, "w").close()
+
+    def execute_query(self, query, spy, **kwargs):
+        self.touch("executed")
+        return []
+
+    def close(self):
+        self.touch("closed")
+
+
+def test_the_approaches_of_pool_workers_are_closed(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        benchmark.ApproachFactory, "create",
+        lambda approach, config, **kwargs: Recorder(str(tmp_path)))
+    queries = [(f"q{index}", "SELECT * WHERE { ?s ?p ?o }")
+               for index in range(8)]
+    reports, _ = benchmark.run_benchmark(
+        ["recorder"], queries, {}, {}, warmup=1, repetitions=2,
+        concurrency=2)
+    assert reports[0]["errors"] == 0
+    executed = {name.split("-")[1] for name in os.listdir(tmp_path)
+                if name.startswith("executed-")}
+    closed = {name.split("-")[1] for name in os.listdir(tmp_path)
+              if name.startswith("closed-")}
+    assert len(executed) > 0
+    assert closed == executed
+    assert str(os.getpid()) not in executed
@@ -0,0 +1,68 @@
+import json
+import os
+
+import pytest
+import requests
+
+from approaches.checkpoint import Checkpoint
+from approaches.factory import ApproachFactory
+from spy import Spy
+from tests.fakes import CONFIG, EngineTransport, engine
+
+QUERY = (
+    "PREFIX ex: <http://example.org/> "
+    "SELECT ?s ?o ?l WHERE { ?s ex:p ?o . ?s ex:q ?l } ORDER BY ?o ?s "
+    "LIMIT 20")
+
+
+class InterruptedTransport(EngineTransport):
+    """
+    A transport whose connection is lost after a given number of quanta.
+    """
+
+    def __init__(self, engine, quanta):
+        super().__init__(engine)
+        self.quanta = quanta
+
+    def post(self, data):
+        if len(self.payloads) == self.quanta:
+            raise requests.ConnectionError("the connection was lost")
+        return super().post(data)
+
+
+def run(name, transport, **kwargs):
+    approach = ApproachFactory.create(name, CONFIG, transport=transport)
+    return approach.execute_query(QUERY, Spy(), quota=1, **kwargs)
+
+
+@pytest.mark.parametrize("name", ["sage", "sage-topk", "sage-partial-topk"])
+def test_a_checkpoint_resumes_to_the_same_results(name, tmp_path):
+    transport = EngineTransport(engine())
+    expected = run(name, transport)
+    quanta = len(transport.payloads)
+    assert quanta > 4
+    path = str(tmp_path / "checkpoint.json")
+    with pytest.raises(requests.ConnectionError):
+        run(name, InterruptedTransport(engine(), quanta // 2),
+            checkpoint=Checkpoint(path, interval=0))
+    with open(path, "r") as checkpointfile:
+        assert json.load(checkpointfile)["quanta"] == quanta // 2
+    # the resumed execution only sends the remaining quanta
+    transport = EngineTransport(engine())
+    solutions = run(
+        name, transport, checkpoint=Checkpoint(path, interval=0), resume=True)
+    assert solutions == expected
+    assert len(transport.payloads) == quanta - quanta // 2
+    assert not os.path.exists(path)
+
+
+def test_a_checkpoint_is_not_resumed_by_another_execution(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    with pytest.raises(requests.ConnectionError):
+        run("sage", InterruptedTransport(engine(), 2),
+            checkpoint=Checkpoint(path, interval=0))
+    with pytest.raises(Exception, match="limit differs"):
+        run("sage", EngineTransport(engine()), limit=5,
+            checkpoint=Checkpoint(path, interval=0), resume=True)
+    # the state of the interrupted execution is kept
+    assert os.path.exists(path)
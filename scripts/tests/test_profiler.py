@@ -0,0 +1,34 @@
+import threading
+import time
+
+from profiler import create_profiler
+
+
+def spin(duration):
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        pass
+
+
+def test_the_sampling_profiler_samples_all_the_threads(tmp_path):
+    profiler = create_profiler("sampling", interval=0.001)
+    with profiler:
+        worker = threading.Thread(
+            target=spin, args=(0.2,), name="partition-1")
+        worker.start()
+        spin(0.2)
+        worker.join()
+    path = profiler.dump(str(tmp_path / "profile"))
+    assert path.endswith(".folded")
+    with open(path, "r") as reader:
+        stacks = [line.rsplit(" ", 1)[0] for line in reader]
+    roots = {stack.split(";")[0] for stack in stacks}
+    assert {"MainThread", "partition-1"} <= roots
+    assert any(
+        stack.startswith("partition-1;") and "spin (" in stack
+        for stack in stacks)
+    assert any(
+        stack.startswith("MainThread;") and "spin (" in stack
+        for stack in stacks)
+    # the sampler does not sample itself
+    assert not any("__sample__" in stack for stack in stacks)
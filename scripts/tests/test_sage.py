@@ -0,0 +1,64 @@
+import random
+
+from multiprocessing import Pool
+
+from approaches.sage import SaGe, TOPKOperator
+from spy import Spy
+from tests.fakes import CONFIG, EngineTransport, engine
+
+QUERY = (
+    "PREFIX ex: <http://example.org/> "
+    "SELECT ?s ?o WHERE { ?s ex:p ?o } ORDER BY DESC(STRLEN(?o)) ?s "
+    "LIMIT 10")
+
+
+def page(rnd, size):
+    return [
+        {"?s": f"s{rnd.randrange(1000):03d}",
+         "?o": '"' + "x" * rnd.randint(0, 8) + '"'}
+        for _ in range(size)]
+
+
+def test_a_snapshot_is_restored_onto_a_fresh_operator():
+    rnd = random.Random(0)
+    topk = TOPKOperator(QUERY, limit=15)
+    for _ in range(5):
+        topk.insert_page(page(rnd, 40))
+    restored = TOPKOperator(QUERY, limit=15)
+    # keys are not stored, they are evaluated again
+    restored.restore(topk.snapshot())
+    assert restored.flatten() == topk.flatten()
+    assert [s.key for s in restored.solutions()] == [
+        s.key for s in topk.solutions()]
+
+
+def test_keys_evaluated_by_workers_give_the_same_topk():
+    rnd = random.Random(1)
+    pages = [page(rnd, rnd.randint(0, 60)) for _ in range(10)]
+    in_process = TOPKOperator(QUERY, limit=15)
+    pooled = TOPKOperator(QUERY, limit=15)
+    with Pool(2) as pool:
+        for solutions in pages:
+            in_process.insert_page(solutions)
+            pooled.insert_page(solutions, pool=pool, batch=8)
+    assert pooled.flatten() == in_process.flatten()
+    assert [s.key for s in pooled.solutions()] == [
+        s.key for s in in_process.solutions()]
+
+
+def test_the_pool_of_workers_is_reused_then_closed():
+    query = QUERY.replace("{ ?s ex:p ?o }", "{ ?s ex:p ?o . ?s ex:q ?l }")
+    approach = SaGe("sage", CONFIG, transport=EngineTransport(engine()))
+    expected = approach.execute_query(query, Spy(), quota=1)
+    assert approach._pool is None
+    solutions = approach.execute_query(
+        query, Spy(), quota=1, eval_workers=2, eval_batch=4)
+    assert solutions == expected
+    pool = approach._pool
+    assert pool is not None
+    approach.execute_query(query, Spy(), quota=1, eval_workers=2)
+    assert approach._pool is pool
+    workers = list(pool._pool)
+    approach.close()
+    assert approach._pool is None
+    assert not any(worker.is_alive() for worker in workers)
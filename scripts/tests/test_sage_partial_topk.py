@@ -0,0 +1,166 @@
+import random
+
+from approaches.sage_partial_topk import SaGePartialTopK, TOPKOperator
+from spy import Spy
+from tests.fakes import CONFIG, EngineTransport, engine
+
+QUERY = (
+    "PREFIX ex: <http://example.org/> "
+    "SELECT ?s ?o WHERE { ?s ex:p ?o } ORDER BY ?o LIMIT 10")
+
+
+def solution(index, value):
+    value = f'"{value:03d}"'
+    return {"?s": f"s{index}", "?o": value, "__order_condition_0": value}
+
+
+def keys(topk):
+    return [record.key[0] for record in topk.solutions()]
+
+
+def count_checks(topk):
+    """
+    Counts the keys checked by the TOP-K data structure of an operator.
+    """
+    calls = [0]
+    can_insert = topk._topk.can_insert
+
+    def counted(key):
+        calls[0] += 1
+        return can_insert(key)
+
+    topk._topk.can_insert = counted
+    return calls
+
+
+def pages(rnd, limit, reverse=False):
+    """
+    Generates pages of solutions, i.e. partial TOP-K as sent by the server,
+    or pages in the reverse order.
+    """
+    for page in range(30):
+        values = [rnd.randint(0, 40) for _ in range(rnd.randint(0, 30))]
+        values = sorted(values)[:limit + 3]
+        if reverse:
+            values.reverse()
+        yield [
+            solution(page * 100 + index, value)
+            for index, value in enumerate(values)]
+
+
+def test_insert_page_is_equivalent_to_insert():
+    rnd = random.Random(0)
+    for limit in [1, 5, 20]:
+        for reverse in [False, True]:
+            paged = TOPKOperator(QUERY, limit=limit, seeding=True)
+            reference = TOPKOperator(QUERY, limit=limit, seeding=True)
+            for page in pages(rnd, limit, reverse=reverse):
+                paged.insert_page(page)
+                for mappings in page:
+                    reference.insert(mappings)
+            assert keys(paged) == keys(reference)
+            assert paged.flatten() == reference.flatten()
+            assert paged.next_seed() == reference.next_seed()
+
+
+def test_insert_page_stops_at_the_first_rejected_solution():
+    paged = TOPKOperator(QUERY, limit=5)
+    reference = TOPKOperator(QUERY, limit=5)
+    paged_checks, reference_checks = count_checks(paged), count_checks(
+        reference)
+    for page in pages(random.Random(1), 5):
+        paged.insert_page(page)
+        for mappings in page:
+            reference.insert(mappings)
+    assert keys(paged) == keys(reference)
+    assert paged_checks[0] < reference_checks[0]
+
+
+def test_insert_page_inserts_each_solution_of_a_reversed_page():
+    topk = TOPKOperator(QUERY, limit=2)
+    topk.insert_page([solution(0, 3), solution(1, 4)])
+    # 5 cannot enter the TOP-K, but the page is not sorted
+    topk.insert_page([solution(2, 5), solution(3, 2), solution(4, 1)])
+    assert keys(topk) == ['"001"', '"002"']
+
+
+def test_insert_page_skips_the_solutions_before_the_previous_page():
+    start = solution(0, 10)
+    topk = TOPKOperator(QUERY, limit=2, start=start)
+    topk.insert_page([solution(index, index) for index in range(8, 14)])
+    assert keys(topk) == ['"010"', '"011"']
+
+
+def test_a_snapshot_is_restored_onto_a_fresh_operator():
+    rnd = random.Random(2)
+    topk = TOPKOperator(QUERY, limit=20)
+    for page in pages(rnd, 20):
+        topk.insert_page(page)
+    restored = TOPKOperator(QUERY, limit=20)
+    restored.restore(topk.snapshot())
+    assert keys(restored) == keys(topk)
+    assert restored.flatten() == topk.flatten()
+    assert restored.threshold() == topk.threshold()
+
+
+def test_the_next_seed_is_strictly_after_the_last_solution():
+    topk = TOPKOperator(QUERY, limit=3, seeding=True)
+    # the 3rd solution is tied with the 4th and the 5th ones
+    topk.insert_page([
+        solution(0, 1), solution(1, 2), solution(2, 4), solution(3, 4),
+        solution(4, 4), solution(5, 6), solution(6, 9)])
+    assert keys(topk) == ['"001"', '"002"', '"004"']
+    assert topk.next_seed()["?o"] == '"006"'
+    # a tighter threshold replaces the seed, a looser one does not
+    topk.tighten(solution(7, 8))
+    topk.tighten(solution(8, 9))
+    assert topk._seed["?o"] == '"008"'
+    # no seed until the TOP-K is full
+    assert TOPKOperator(QUERY, limit=3, seeding=True).next_seed() is None
+
+
+def seeded_runs(limits):
+    """
+    Executes the same query with a growing TOP-K and seeding, in a single
+    client, i.e. each execution is seeded by the previous ones. Returns the
+    solutions of each execution, with the number of solutions sent by the
+    server.
+    """
+    query = (
+        "PREFIX ex: <http://example.org/> SELECT ?s ?o ?l WHERE { "
+        "?s ex:p ?o . ?s ex:q ?l } ORDER BY ?o LIMIT 10")
+    transport = EngineTransport(engine())
+    approach = SaGePartialTopK(
+        "sage-partial-topk", CONFIG, transport=transport)
+    runs = []
+    for limit, seeding in limits:
+        sent = 0
+        original = transport.engine.execute
+
+        def execute(payload):
+            nonlocal sent
+            response = original(payload)
+            sent += len(response["bindings"])
+            return response
+
+        transport.engine.execute = execute
+        solutions = approach.execute_query(
+            query, Spy(), quota=1, limit=limit, seeding=seeding)
+        transport.engine.execute = original
+        runs.append((solutions, sent))
+    return runs
+
+
+def test_seeding_never_drops_solutions_of_the_topk():
+    # ORDER BY ?o has ties at the boundary of the TOP-Ks, so a seed tied with
+    # the last solution would prune some of them
+    (unseeded, sent), _, (seeded, seeded_sent) = seeded_runs([
+        (25, False), (25, True), (25, True)])
+    assert seeded == unseeded
+    assert seeded_sent < sent
+    # a seed recorded for rank 25 is valid for smaller TOP-Ks only
+    (expected, _), _, (smaller, _), (larger, _) = seeded_runs([
+        (10, False), (25, True), (10, True), (40, True)])
+    assert smaller == expected
+    (expected, _), = seeded_runs([(40, False)])
+    assert larger == expected
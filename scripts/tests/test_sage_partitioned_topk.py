@@ -0,0 +1,131 @@
+import threading
+import time
+import types
+
+import pytest
+
+from approaches import sage_partitioned_topk
+from approaches.sage_partial_topk import TOPKOperator
+from approaches.sage_partitioned_topk import SaGePartitionedTopK
+from approaches.sage_topk import SaGeTopK
+from spy import Spy
+from tests.fakes import CONFIG, EngineTransport, engine
+
+QUERY = (
+    "PREFIX ex: <http://example.org/> SELECT ?s ?o ?l WHERE { "
+    "?s ex:p ?o . ?s ex:q ?l } ORDER BY ?o ?s LIMIT 10")
+
+
+class ConcurrentTransport(EngineTransport):
+    """
+    A transport whose quanta last long enough to overlap, and that records
+    the maximum number of quanta executed at the same time.
+    """
+
+    def __init__(self, engine):
+        super().__init__(engine)
+        self.running = 0
+        self.overlap = 0
+        self.lock = threading.Lock()
+
+    def post(self, data):
+        with self.lock:
+            self.running += 1
+            self.overlap = max(self.overlap, self.running)
+        time.sleep(0.002)
+        try:
+            return super().post(data)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def partitioned(transport=None):
+    transport = transport or EngineTransport(engine())
+    return SaGePartitionedTopK(
+        "sage-partitioned-topk", CONFIG, transport=transport)
+
+
+@pytest.mark.parametrize("partitions", [2, 3, 16, 17])
+def test_partitions_split_the_solutions(partitions):
+    approach = partitioned()
+    query = QUERY.replace("LIMIT 10", "LIMIT 1000")
+    server = engine(size=200)
+    solutions = server.execute({"query": query, "quota": 1000})["bindings"]
+    seen = []
+    for index in range(partitions):
+        partition = approach.__partition__(query, index, partitions)
+        response = server.execute({"query": partition, "quota": 1000})
+        seen.extend(mappings["?s"] for mappings in response["bindings"])
+    # no solution is lost, and no solution is in several partitions
+    assert sorted(seen) == sorted(mappings["?s"] for mappings in solutions)
+    assert approach.__partition__(query, 0, 1) == query
+    with pytest.raises(Exception):
+        approach.__partition__(
+            "SELECT * WHERE { <http://example.org/s> ?p ?o }", 0, 2)
+
+
+@pytest.mark.parametrize("limit, offset", [(10, 0), (25, 0), (10, 13)])
+def test_merged_partitions_equal_sage_topk(limit, offset):
+    expected = SaGeTopK(
+        "sage-topk", CONFIG, transport=EngineTransport(engine())
+    ).execute_query(QUERY, Spy(), quota=1, limit=limit, offset=offset)
+    solutions = partitioned().execute_query(
+        QUERY, Spy(), quota=1, limit=limit, offset=offset, partitions=5)
+    assert len(solutions) == limit
+    assert solutions == expected
+
+
+def test_the_shared_threshold_is_only_used_under_its_lock(monkeypatch):
+    locks = []
+
+    class TrackedLock():
+        def __init__(self):
+            self._lock = threading.Lock()
+            self.owner = None
+            locks.append(self)
+
+        def __enter__(self):
+            self._lock.acquire()
+            self.owner = threading.get_ident()
+            time.sleep(0.001)  # widens the window of a race
+
+        def __exit__(self, *args):
+            self.owner = None
+            self._lock.release()
+
+    def held():
+        return any(lock.owner == threading.get_ident() for lock in locks)
+
+    # the thresholds of the other partitions are only read under the lock
+    calls = []
+    tighten = TOPKOperator.tighten
+
+    def tracked_tighten(self, value):
+        calls.append(held())
+        return tighten(self, value)
+
+    monkeypatch.setattr(
+        sage_partitioned_topk, "threading",
+        types.SimpleNamespace(Lock=TrackedLock))
+    monkeypatch.setattr(TOPKOperator, "tighten", tracked_tighten)
+    transport = ConcurrentTransport(engine())
+    solutions = partitioned(transport).execute_query(
+        QUERY, Spy(), quota=1, limit=10, partitions=4)
+    monkeypatch.undo()
+    expected = SaGeTopK(
+        "sage-topk", CONFIG, transport=EngineTransport(engine())
+    ).execute_query(QUERY, Spy(), quota=1, limit=10)
+    assert solutions == expected
+    assert transport.overlap > 1
+    assert len(calls) > 0 and all(calls)
+
+
+@pytest.mark.parametrize("options", [
+    {"continuation": "token"}, {"checkpoint": object()}, {"seeding": True},
+    {"partitions": 0}, {"partitions": 257}])
+def test_unsupported_options_are_rejected(options):
+    transport = EngineTransport(engine())
+    with pytest.raises(Exception):
+        partitioned(transport).execute_query(QUERY, Spy(), **options)
+    assert transport.payloads == []
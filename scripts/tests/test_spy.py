@@ -0,0 +1,18 @@
+import sys
+
+from spy import Spy
+
+
+def test_the_peak_rss_is_the_one_of_the_process():
+    spy = Spy()
+    assert spy.process_peak_rss == 0
+    with spy.track_memory(allocations=True):
+        data = [bytes(1024) for _ in range(1024)]
+    frame = spy.to_dataframe()
+    assert "peak_rss" not in frame.columns
+    if sys.platform.startswith("linux"):
+        assert frame["process_peak_rss"][0] == spy.process_peak_rss > 0
+    # allocations are measured during the query only
+    assert spy.tracemalloc_peak >= 1024 * 1024
+    assert len(data) == 1024
+
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+import requests
+
+from approaches.factory import ApproachFactory
+from approaches.transport import HTTPTransport
+from spy import Spy
+from tests.fakes import CONFIG, server
+
+QUERY = (
+    "PREFIX ex: <http://example.org/> "
+    "SELECT ?s ?o ?l WHERE { ?s ex:p ?o . ?s ex:q ?l } ORDER BY ?o ?s "
+    "LIMIT 10")
+
+
+def post(transport, payload):
+    return json.loads(transport.post(json.dumps(payload)))
+
+
+def test_the_ids_of_saved_plans_are_never_reused():
+    with server() as standin:
+        transport = HTTPTransport(standin.url)
+        queries = [QUERY, QUERY.replace("ORDER BY ?o ?s", "ORDER BY ?l")]
+        payloads = [
+            {"query": query.replace("LIMIT 10", ""), "quota": 1,
+             "stateless": False, "next": None}
+            for query in queries]
+        identifiers = []
+        # the quanta of both queries are interleaved, and each plan is
+        # removed once resumed, so the number of stored plans cannot be
+        # used as an id
+        while len(payloads) > 0:
+            for payload in list(payloads):
+                payload["next"] = post(transport, payload)["next"]
+                if payload["next"] is None:
+                    payloads.remove(payload)
+                else:
+                    identifiers.append(payload["next"])
+        assert len(identifiers) > 10
+        assert len(set(identifiers)) == len(identifiers)
+        assert standin.engine._plans == {}
+        # a resumed plan cannot be resumed again
+        with pytest.raises(requests.HTTPError) as error:
+            post(transport, {
+                "query": queries[0], "quota": 1, "stateless": False,
+                "next": identifiers[0]})
+        assert error.value.response.status_code == 400
+        transport.close()
+
+
+def test_stateful_and_stateless_queries_give_the_same_results():
+    with server() as standin:
+        results = []
+        for stateless in [True, False]:
+            transport = HTTPTransport(standin.url)
+            approach = ApproachFactory.create(
+                "sage", CONFIG, transport=transport)
+            results.append(approach.execute_query(
+                QUERY, Spy(), quota=1, stateless=stateless))
+            transport.close()
+        assert results[0] == results[1]
+        assert len(results[0]) == 10
@@ -0,0 +1,64 @@
+import json
+import os
+
+import pytest
+
+from approaches.threshold_cache import ThresholdCache
+
+GRAPH = "http://example.org/graph"
+QUERY = "SELECT * WHERE { ?s ?p ?o } ORDER BY ?o"
+
+
+def test_get_returns_the_tightest_valid_threshold():
+    cache = ThresholdCache()
+    cache.put(GRAPH, f"{QUERY} LIMIT 10", 10, {"?o": "10"})
+    cache.put(GRAPH, f"{QUERY} LIMIT 50 OFFSET 20", 70, {"?o": "70"})
+    # LIMIT and OFFSET are not part of the key of a query
+    assert cache.get(GRAPH, QUERY, 5) == {"?o": "10"}
+    assert cache.get(GRAPH, f"{QUERY} LIMIT 10", 10) == {"?o": "10"}
+    assert cache.get(GRAPH, QUERY, 11) == {"?o": "70"}
+    assert cache.get(GRAPH, QUERY, 71) is None
+    assert cache.get("http://example.org/other", QUERY, 5) is None
+
+
+def test_save_merges_the_thresholds_of_other_processes(tmp_path):
+    path = str(tmp_path / "thresholds.json")
+    first, second = ThresholdCache(path), ThresholdCache(path)
+    first.put(GRAPH, QUERY, 10, {"?o": "a"})
+    second.put(GRAPH, QUERY, 20, {"?o": "b"})
+    second.put(GRAPH, "SELECT * WHERE { ?s ?p ?o }", 5, {"?o": "c"})
+    first.save()
+    second.save()
+    loaded = ThresholdCache(path)
+    assert loaded.get(GRAPH, QUERY, 10) == {"?o": "a"}
+    assert loaded.get(GRAPH, QUERY, 20) == {"?o": "b"}
+    assert loaded.get(GRAPH, "SELECT * WHERE { ?s ?p ?o }", 5) == {"?o": "c"}
+    # the thresholds saved by the other process are also seen
+    assert second.get(GRAPH, QUERY, 10) == {"?o": "a"}
+    # an update of a rank replaces the threshold of this rank
+    first.put(GRAPH, QUERY, 20, {"?o": "d"})
+    first.save()
+    assert ThresholdCache(path).get(GRAPH, QUERY, 20) == {"?o": "d"}
+    assert os.listdir(tmp_path) == ["thresholds.json"]
+
+
+def test_an_interrupted_save_keeps_the_previous_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "thresholds.json")
+    cache = ThresholdCache(path)
+    cache.put(GRAPH, QUERY, 10, {"?o": "a"})
+    cache.save()
+    with open(path) as cachefile:
+        saved = cachefile.read()
+
+    def interrupted(thresholds, cachefile):
+        cachefile.write('{"partial')
+        raise KeyboardInterrupt()
+
+    cache.put(GRAPH, QUERY, 20, {"?o": "b"})
+    monkeypatch.setattr(json, "dump", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        cache.save()
+    with open(path) as cachefile:
+        assert cachefile.read() == saved
+    monkeypatch.undo()
+    assert ThresholdCache(path).get(GRAPH, QUERY, 10) == {"?o": "a"}
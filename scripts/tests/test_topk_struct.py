@@ -0,0 +1,415 @@
+import contextlib
+import importlib.util
+import inspect
+import os
+import random
+import sys
+
+import pytest
+
+from approaches import topk_struct as compiled
+
+# the Python file of topk_struct, even when the compiled module is built
+_spec = importlib.util.spec_from_file_location(
+    "topk_struct_python",
+    os.path.join(os.path.dirname(compiled.__file__), "topk_struct.py"))
+python = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(python)
+
+
+@pytest.fixture(params=["python", "compiled"])
+def module(request):
+    """
+    The tests run against the Python file, and against the compiled module
+    if it is built.
+    """
+    if request.param == "python":
+        return python
+    if not compiled.COMPILED:
+        pytest.skip("topk_struct is not compiled")
+    return compiled
+
+
+def weighted_tree(module, weights):
+    tree = module.OrderedDict()
+    for key, weight in weights.items():
+        tree.insert(key, str(key), weight=weight)
+    return tree
+
+
+def test_ksmallest_and_klargest_count_keys_on_a_weighted_tree(module):
+    weights = {key: 1 + key % 4 for key in range(0, 60, 3)}
+    tree = weighted_tree(module, weights)
+    keys = sorted(weights)
+    assert tree.root.total != len(tree)
+    for k in range(1, len(keys) + 1):
+        assert tree.KSmallest(k).key == keys[k - 1]
+        assert tree.KLargest(k).key == keys[-k]
+
+
+def test_ksmallest_and_klargest_on_an_unweighted_tree(module):
+    keys = random.Random(0).sample(range(1000), 100)
+    tree = weighted_tree(module, dict.fromkeys(keys, 1))
+    keys.sort()
+    for k in range(1, len(keys) + 1):
+        assert tree.KSmallest(k).key == keys[k - 1]
+        assert tree.KLargest(k).key == keys[-k]
+
+
+def test_ksmallest_rejects_ranks_beyond_the_number_of_keys(module):
+    tree = weighted_tree(module, {1: 5, 2: 5})
+    with pytest.raises(Exception):
+        tree.KSmallest(3)
+    with pytest.raises(Exception):
+        tree.KLargest(0)
+
+
+def test_schema_round_trips_solutions_with_missing_variables(module):
+    schema = module.Schema(excluded=["__o1"])
+    first = schema.encode({"?x": "a", "__o1": "1"})
+    second = schema.encode({"?y": "b", "?x": "c"})
+    third = schema.encode({"?y": "d"})
+    assert schema.variables == ["?x", "?y"]
+    assert first == ("a",)  # encoded before ?y was seen, so shorter
+    assert second == ("c", "b")
+    assert third == (None, "d")
+    assert schema.decode(first) == {"?x": "a"}
+    assert schema.decode(second) == {"?x": "c", "?y": "b"}
+    assert schema.decode(third) == {"?y": "d"}
+
+
+def test_schema_remaps_solutions_of_another_schema(module):
+    schema = module.Schema()
+    schema.encode({"?x": "a", "?y": "b"})
+    other = module.Schema()
+    values = other.encode({"?z": "c", "?x": "d"})
+    assert schema.align(["?x", "?y"]) is None
+    positions = schema.align(other.variables)
+    assert positions == [2, 0]
+    assert schema.decode(schema.remap(values, positions)) == {
+        "?z": "c", "?x": "d"}
+
+
+def test_topk_stores_solutions_encoded_with_a_schema(module):
+    keys = [("__o1", "ASC")]
+    topk = module.TOPKStruct(keys, limit=2)
+    schema = module.Schema(excluded=["__o1"])
+    for mappings in [
+            {"__o1": "3", "?x": "c"}, {"__o1": "1", "?y": "a"},
+            {"__o1": "2", "?x": "b", "?y": "b"}]:
+        key = (mappings["__o1"],)
+        topk.insert(module.Solution(key, schema.encode(mappings)))
+    assert [schema.decode(solution.values) for solution in topk] == [
+        {"?y": "a"}, {"?x": "b", "?y": "b"}]
+
+
+def test_push_skips_the_check_of_insert(module):
+    topk = module.TOPKStruct([("__o1", "ASC")], limit=2)
+    for key in ["3", "1", "2"]:
+        if topk.can_insert((key,)):
+            topk.push(module.Solution((key,), ()))
+    assert not topk.insert(module.Solution(("4",), ()))
+    assert [solution.key for solution in topk] == [("1",), ("2",)]
+
+
+def check_red_black(tree):
+    """
+    Checks the invariants of a red-black tree, without recursion: the root
+    is black, red nodes have black children, all paths have the same number
+    of black nodes, keys are ordered, and totals are the sums of the weights
+    of the subtrees. Returns the height of the tree.
+    """
+    TNULL = tree.TNULL
+    assert tree.root is TNULL or tree.root.color == 0
+    heights = set()
+    height = 0
+    stack = [(tree.root, None, 0, 0, None, None)]
+    while stack:
+        node, parent, blacks, depth, low, high = stack.pop()
+        if node is TNULL:
+            heights.add(blacks)
+            height = max(height, depth)
+            continue
+        assert node.parent is parent
+        assert low is None or low < node.key
+        assert high is None or node.key < high
+        assert node.total == node.left.total + node.right.total + node.weight
+        if node.color == 1:
+            assert node.left.color == 0 and node.right.color == 0
+        blacks += 1 - node.color
+        stack.append((node.left, node, blacks, depth + 1, low, node.key))
+        stack.append((node.right, node, blacks, depth + 1, node.key, high))
+    assert len(heights) == 1
+    return height
+
+
+@contextlib.contextmanager
+def frames(count):
+    """
+    Only allows count more frames on the stack, so that a function that
+    recurses once per level of a tree higher than count fails.
+    """
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(len(inspect.stack(0)) + count)
+    try:
+        yield
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def test_traversals_do_not_recurse_on_a_deep_tree(module):
+    tree = module.OrderedDict()
+    keys = list(range(1 << 15))
+    with frames(10):
+        for key in keys:  # sorted keys, i.e. the worst case without balancing
+            tree.insert(key, str(key))
+        assert [node.key for node in tree] == keys
+        assert [node.key for node in tree.reverse_iterate()] == keys[::-1]
+        assert tree.KSmallest(12345).key == 12344
+        assert tree.search(tree.root, 20000).key == 20000
+        for key in keys[::2]:
+            tree.pop(key)
+    # a recursive traversal would have needed more frames than allowed
+    assert check_red_black(tree) > 10
+    assert [node.key for node in tree] == keys[1::2]
+
+
+def test_deletions_rebalance_the_tree(module):
+    rnd = random.Random(3)
+    tree = module.OrderedDict()
+    keys = rnd.sample(range(100000), 3000)
+    for key in keys:
+        tree.insert(key, None)
+    rnd.shuffle(keys)
+    for index, key in enumerate(keys[:2500]):
+        tree.pop(key)
+        if index % 250 == 0:
+            check_red_black(tree)
+    check_red_black(tree)
+    remaining = sorted(keys[2500:])
+    assert len(tree) == len(remaining)
+    assert [node.key for node in tree] == remaining
+    assert [node.key for node in tree.reverse_iterate()] == remaining[::-1]
+
+
+def test_nested_topk_inserts_and_evictions(module):
+    keys = [("__o1", "ASC"), ("__o2", "DESC"), ("__o3", "ASC")]
+    topk = module.TOPKStruct(keys, limit=500)
+    rnd = random.Random(4)
+    solutions = [
+        module.Solution((rnd.randint(0, 9), rnd.randint(0, 9), index), ())
+        for index in range(5000)]
+    for solution in solutions:
+        topk.insert(solution)
+    flattened = topk.flatten()
+    expected = sorted(solutions, key=lambda solution: (
+        solution.key[0], -solution.key[1], solution.key[2]))[:500]
+    assert flattened == expected
+    assert list(topk) == expected
+
+
+def test_rank_select_and_seek_match_a_sorted_list(module):
+    rnd = random.Random(5)
+    tree = module.OrderedDict()
+    weights = {}
+    for step in range(2000):
+        key = rnd.randrange(400)
+        if key in weights and rnd.random() < 0.4:
+            tree.pop(key)
+            del weights[key]
+        elif key not in weights:
+            weights[key] = rnd.randint(1, 3)
+            tree.insert(key, str(key), weight=weights[key])
+        if step % 100 != 0:
+            continue
+        # one element per unit of weight, in the order of the keys
+        elements = [
+            key for key in sorted(weights) for _ in range(weights[key])]
+        for probe in range(-1, 401, 7):
+            assert tree.rank(probe) == sum(
+                1 for element in elements if element < probe)
+            assert tree.rank(probe, inclusive=True) == sum(
+                1 for element in elements if element <= probe)
+        for position in range(len(elements)):
+            node, offset = tree.select(position)
+            assert node.key == elements[position]
+            assert elements.index(node.key) + offset == position
+            node, _ = tree.select(position, reverse=True)
+            assert node.key == elements[-1 - position]
+        for position in range(0, len(elements), 11):
+            _, children = tree.seek(position)
+            keys = [node.key for node in children]
+            assert keys == sorted(set(elements[position:]))
+            _, children = tree.seek(position, reverse=True)
+            keys = [node.key for node in children]
+            assert keys == sorted(set(elements[:len(elements) - position]),
+                                  reverse=True)
+
+
+def test_topk_rank_and_select_match_a_sorted_list(module):
+    rnd = random.Random(6)
+    keys = [("__o1", "DESC"), ("__o2", "ASC")]
+
+    def order(key):
+        return (-key[0], key[1])
+
+    for layout in ["nested", "flat"]:
+        topk = module.TOPKStruct(keys, limit=50, layout=layout)
+        expected = []  # sorted, ties in their insertion order
+        for index in range(400):
+            solution = module.Solution(
+                (rnd.randint(0, 20), rnd.randint(0, 20)), (index,))
+            inserted = topk.insert(solution)
+            assert inserted == (
+                len(expected) < 50
+                or order(solution.key) < order(expected[-1].key))
+            if inserted:
+                expected.append(solution)
+                expected.sort(key=lambda solution: order(solution.key))
+                if len(expected) > 50:  # evicts the first of the last ties
+                    last = [s for s in expected if s.key == expected[-1].key]
+                    expected.remove(last[0])
+            if index % 3 == 0 and len(expected) > 0:
+                deleted = expected.pop(rnd.randrange(len(expected)))
+                topk.delete(deleted)
+            assert len(topk) == len(expected)
+            assert topk.flatten() == expected
+            for position, solution in enumerate(expected):
+                assert topk.select(position) is solution
+            for offset in [0, 1, len(expected) // 2, len(expected)]:
+                assert topk.flatten(offset=offset) == expected[offset:]
+            probe = (rnd.randint(0, 20), rnd.randint(0, 20))
+            assert topk.rank(probe) == sum(
+                1 for solution in expected
+                if order(solution.key) <= order(probe))
+
+
+def test_descending_reverses_the_order_of_its_value(module):
+    Descending = module.Descending
+    assert Descending(2) < Descending(1)
+    assert not Descending(1) < Descending(1)
+    assert Descending("a") == Descending("a")
+    assert hash(Descending("a")) == hash("a")
+    keys = [(1, Descending("b")), (1, Descending("c")), (0, Descending("a"))]
+    assert sorted(keys) == [keys[2], keys[1], keys[0]]
+
+
+@pytest.mark.parametrize("orders", [
+    ("ASC", "ASC", "ASC"), ("DESC", "DESC", "DESC"), ("ASC", "DESC", "ASC"),
+    ("DESC", "ASC", "DESC")])
+def test_flat_and_nested_layouts_are_equivalent(module, orders):
+    keys = [(f"__o{index}", order) for index, order in enumerate(orders)]
+    nested = module.TOPKStruct(keys, limit=40, layout="nested")
+    flat = module.TOPKStruct(keys, limit=40, layout="flat")
+    rnd = random.Random(7)
+    for index in range(600):
+        key = tuple(f"{rnd.randint(0, 6)}" for _ in orders)
+        solution = module.Solution(key, (str(index),))
+        assert nested.can_insert(key) == flat.can_insert(key)
+        assert nested.rank(key) == flat.rank(key)
+        assert nested.insert(solution) == flat.insert(solution)
+        if index % 50 == 49:
+            assert nested.pop() is flat.pop()
+        assert len(nested) == len(flat)
+        assert nested.lower_bound() is flat.lower_bound()
+        assert nested.upper_bound() is flat.upper_bound()
+    assert nested.flatten() == flat.flatten()
+    assert list(nested) == list(flat)
+    for position in range(len(nested)):
+        assert nested.select(position) is flat.select(position)
+        assert nested.flatten(offset=position) == flat.flatten(
+            offset=position)
+    # the order of the keys, ties being kept in their insertion order
+    expected = sorted(nested.flatten(), key=lambda solution: tuple(
+        module.Descending(value) if order == "DESC" else value
+        for value, order in zip(solution.key, orders)))
+    assert flat.flatten() == expected
+
+
+def test_unknown_layouts_are_rejected(module):
+    with pytest.raises(Exception):
+        module.TOPKStruct([("__o0", "ASC")], layout="columnar")
+
+
+def test_snapshots_round_trip_keys_and_values(module):
+    solutions = [
+        module.Solution(('"b"', None), ("x", None, "é")),
+        module.Solution(('"a"', "1"), ()),
+        module.Solution(("", "2"), (None, "", "long " * 100)),
+    ]
+    data = module.Snapshot.pack(solutions, variables=["?x", "?y", "?z"])
+    variables, unpacked = module.Snapshot.unpack(data)
+    assert variables == ["?x", "?y", "?z"]
+    assert [(s.key, s.values) for s in unpacked] == [
+        (s.key, s.values) for s in solutions]
+    # without keys, only the values are stored
+    _, unpacked = module.Snapshot.unpack(
+        module.Snapshot.pack(solutions, keys=False))
+    assert [(s.key, s.values) for s in unpacked] == [
+        (None, s.values) for s in solutions]
+    assert module.Snapshot.unpack(module.Snapshot.pack([])) == ([], [])
+    with pytest.raises(Exception):
+        module.Snapshot.unpack(b"not a snapshot")
+
+
+def test_restoring_a_snapshot_gives_the_same_topk(module):
+    keys = [("__o0", "ASC"), ("__o1", "DESC")]
+    topk = module.TOPKStruct(keys, limit=30)
+    schema = module.Schema(excluded=["__o0", "__o1"])
+    rnd = random.Random(8)
+    for index in range(200):
+        mappings = {"__o0": str(rnd.randint(0, 9)), "__o1": str(
+            rnd.randint(0, 9)), "?s": f"s{index}"}
+        if index % 3 == 0:
+            mappings["?t"] = f"t{index}"
+        key = (mappings["__o0"], mappings["__o1"])
+        topk.insert(module.Solution(key, schema.encode(mappings)))
+    data = topk.snapshot(variables=schema.variables)
+    for layout in ["nested", "flat"]:
+        restored = module.TOPKStruct(keys, limit=30, layout=layout)
+        assert restored.restore(data) == schema.variables
+        # missing values at the end of a solution are not stored
+        assert [(s.key, schema.decode(s.values)) for s in restored] == [
+            (s.key, schema.decode(s.values)) for s in topk]
+    # keys are needed to restore a TOP-K
+    with pytest.raises(Exception):
+        module.TOPKStruct(keys).restore(topk.snapshot(keys=False))
+
+
+@pytest.mark.parametrize("orders", [
+    ("ASC", "ASC"), ("DESC", "DESC"), ("ASC", "DESC")])
+def test_merge_matches_reinserting_the_solutions(module, orders):
+    keys = [(f"__o{index}", order) for index, order in enumerate(orders)]
+    rnd = random.Random(9)
+    for layout in ["nested", "flat"]:
+        topks = [
+            module.TOPKStruct(keys, limit=25, layout=layout)
+            for _ in range(4)]
+        for index in range(300):  # few distinct keys, i.e. many ties
+            key = (rnd.randint(0, 4), rnd.randint(0, 4))
+            topks[index % 4].insert(module.Solution(key, (index,)))
+        # all solutions reinserted in a TOP-K that evicts none of them, the
+        # solutions of the first TOP-K first, so that ties keep this order
+        union = module.TOPKStruct(keys, limit=100, layout=layout)
+        for topk in topks:
+            for solution in topk:
+                union.insert(solution)
+        expected = union.flatten()
+        merged = list(topks[0].merged(*topks[1:]))
+        assert [solution for _, solution in merged] == expected
+        for index, solution in merged:
+            assert any(s is solution for s in topks[index])
+        assert topks[0].merge(*topks[1:]) == expected[:25]
+        for limit, offset in [(10, 0), (10, 17), (30, 90), (5, 100)]:
+            assert topks[0].merge(
+                *topks[1:], limit=limit, offset=offset) == expected[
+                    offset:offset + limit]
+
+
+def test_merge_of_empty_topks(module):
+    keys = [("__o0", "ASC")]
+    empty = module.TOPKStruct(keys, limit=3)
+    topk = module.TOPKStruct(keys, limit=3)
+    topk.insert(module.Solution((1,), ()))
+    assert empty.merge(module.TOPKStruct(keys)) == []
+    assert empty.merge(topk) == topk.flatten()
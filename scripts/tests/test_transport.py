@@ -0,0 +1,273 @@
+import socket
+
+import pytest
+import requests
+
+from approaches import transport
+from approaches.factory import ApproachFactory
+from approaches.transport import (
+    BalancedTransport, HTTPTransport, RecordingTransport, ReplayTransport,
+    RetryingTransport, Transport)
+from spy import Spy
+from tests.fakes import CONFIG, server
+
+
+class Clock():
+    """
+    A clock that only moves when replicas answer, or when the client sleeps.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def perf_counter(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+class Replica(Transport):
+    """
+    A replica that answers after a given latency, and fails its first
+    requests with the given errors.
+    """
+
+    def __init__(self, clock, url, latency=0.01, errors=()):
+        self.clock = clock
+        self.url = url
+        self.latency = latency
+        self.errors = list(errors)
+        self.requests = 0
+        self.closed = False
+
+    def post(self, data):
+        self.requests += 1
+        self.clock.now += self.latency
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        return b'{"url": "' + self.url.encode("utf-8") + b'"}'
+
+    def close(self):
+        self.closed = True
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"{status} error", response=response)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(transport, "time", clock)
+    return clock
+
+
+def replicas(clock, latencies, errors=None):
+    errors = errors or {}
+    return [
+        Replica(
+            clock, f"http://replica{index}", latency, errors.get(index, ()))
+        for index, latency in enumerate(latencies)]
+
+
+def test_round_robin_sends_requests_to_each_replica_in_turn(clock):
+    balanced = BalancedTransport(replicas(clock, [0.03, 0.01, 0.02]))
+    urls = [balanced.post("{}") for _ in range(6)]
+    assert urls == [
+        b'{"url": "http://replica%d"}' % index for index in [0, 1, 2] * 2]
+    assert [replica["requests"] for replica in balanced.stats()] == [2, 2, 2]
+
+
+def test_least_latency_prefers_the_fastest_replica(clock):
+    balanced = BalancedTransport(
+        replicas(clock, [0.03, 0.01, 0.02]), policy="least-latency")
+    for _ in range(20):
+        balanced.post("{}")
+    # each replica is tried once, as latencies are unknown at first
+    stats = balanced.stats()
+    assert [replica["requests"] for replica in stats] == [1, 18, 1]
+    assert [replica["latency"] for replica in stats] == pytest.approx(
+        [30, 10, 20])
+
+
+def test_power_of_two_never_chooses_the_slowest_of_two_replicas(clock):
+    balanced = BalancedTransport(
+        replicas(clock, [0.03, 0.01, 0.02]), policy="power-of-two", seed=0)
+    for _ in range(100):
+        balanced.post("{}")
+    sent = [replica["requests"] for replica in balanced.stats()]
+    # the slowest replica is only chosen while its latency is unknown
+    assert sent[0] == 1
+    assert sent[1] > sent[2] > 0
+    # pending requests count against a replica
+    balanced._pending[1] = 10
+    assert all(balanced.__choose__([]) != 1 for _ in range(20))
+
+
+def test_the_request_fails_over_to_the_next_replica(clock):
+    errors = {0: [requests.ConnectionError("refused")]}
+    balanced = BalancedTransport(
+        replicas(clock, [0.01] * 3, errors), cooldown=5.0)
+    assert balanced.post("{}") == b'{"url": "http://replica1"}'
+    assert [replica["failures"] for replica in balanced.stats()] == [1, 0, 0]
+    # the failed replica is not chosen during its cooldown
+    urls = [balanced.post("{}") for _ in range(4)]
+    assert b'{"url": "http://replica0"}' not in urls
+    clock.now += 5.0
+    urls = [balanced.post("{}") for _ in range(3)]
+    assert b'{"url": "http://replica0"}' in urls
+
+
+def test_server_errors_fail_over_but_invalid_requests_do_not(clock):
+    errors = {0: [http_error(503)], 1: [http_error(400)]}
+    balanced = BalancedTransport(replicas(clock, [0.01] * 3, errors))
+    with pytest.raises(requests.HTTPError):
+        balanced.post("{}")
+    # the invalid request is not sent to the 3rd replica
+    assert [replica["requests"] for replica in balanced.stats()] == [1, 1, 0]
+    assert [replica["failures"] for replica in balanced.stats()] == [1, 0, 0]
+
+
+def test_the_request_fails_when_all_replicas_fail(clock):
+    errors = {
+        index: [requests.ConnectionError("refused")] for index in range(3)}
+    targets = replicas(clock, [0.01] * 3, errors)
+    balanced = BalancedTransport(targets)
+    with pytest.raises(requests.ConnectionError):
+        balanced.post("{}")
+    assert [target.requests for target in targets] == [1, 1, 1]
+    # all replicas are considered again once they have all failed
+    assert balanced.post("{}") == b'{"url": "http://replica0"}'
+    balanced.close()
+    assert all(target.closed for target in targets)
+
+
+def test_retries_back_off_exponentially(clock):
+    replica = Replica(clock, "http://replica", errors=[
+        requests.ConnectionError("refused"), http_error(502),
+        requests.Timeout("timeout")])
+    retrying = RetryingTransport(replica, retries=3, backoff=0.5)
+    assert retrying.post('{"next": "plan"}') == b'{"url": "http://replica"}'
+    assert replica.requests == 4
+    # each delay is drawn between the half of the backoff and the backoff
+    assert len(clock.sleeps) == 3
+    for delay, backoff in zip(clock.sleeps, [0.5, 1.0, 2.0]):
+        assert backoff / 2 <= delay <= backoff
+
+
+def test_backoff_is_bounded(clock):
+    replica = Replica(clock, "http://replica", errors=[
+        requests.ConnectionError("refused")] * 4)
+    RetryingTransport(replica, retries=4, backoff=20.0).post("{}")
+    assert max(clock.sleeps) <= RetryingTransport.MAX_BACKOFF
+    assert clock.sleeps[-1] >= RetryingTransport.MAX_BACKOFF / 2
+
+
+def test_retries_give_up_after_the_last_retry(clock):
+    replica = Replica(clock, "http://replica", errors=[
+        requests.ConnectionError("refused")] * 10)
+    retrying = RetryingTransport(replica, retries=2, backoff=0.5)
+    with pytest.raises(requests.ConnectionError):
+        retrying.post("{}")
+    assert replica.requests == 3
+    assert len(clock.sleeps) == 2
+
+
+def test_responses_that_are_not_json_are_retried(clock):
+
+    class Proxy(Replica):
+
+        def post(self, data):
+            if self.requests == 0:
+                self.requests += 1
+                return b"<html>502 Bad Gateway</html>"
+            return super().post(data)
+
+    proxy = Proxy(clock, "http://replica")
+    assert RetryingTransport(proxy, retries=1).post("{}") == (
+        b'{"url": "http://replica"}')
+    assert proxy.requests == 2
+
+
+def test_invalid_requests_are_not_retried(clock):
+    replica = Replica(clock, "http://replica", errors=[http_error(400)])
+    with pytest.raises(requests.HTTPError):
+        RetryingTransport(replica, retries=3).post("{}")
+    assert replica.requests == 1
+    assert clock.sleeps == []
+
+
+def test_quanta_that_resume_a_stored_plan_are_never_retried(clock):
+    replica = Replica(clock, "http://replica", errors=[
+        requests.ConnectionError("reset")] * 2)
+    retrying = RetryingTransport(replica, retries=3)
+    with pytest.raises(requests.ConnectionError):
+        retrying.post('{"next": "7", "stateless": false}')
+    assert replica.requests == 1
+    assert clock.sleeps == []
+    # the first quantum of a stateful query does not resume a plan
+    assert retrying.post('{"next": null, "stateless": false}') == (
+        b'{"url": "http://replica"}')
+    assert replica.requests == 3
+
+
+QUERY = (
+    "PREFIX ex: <http://example.org/> "
+    "SELECT ?s ?o ?l WHERE { ?s ex:p ?o . ?s ex:q ?l } ORDER BY ?o ?s "
+    "LIMIT 10")
+
+
+def execute(name, transport, query=QUERY):
+    approach = ApproachFactory.create(name, CONFIG, transport=transport)
+    spy = Spy()
+    return approach.execute_query(query, spy, quota=1), spy.http_calls
+
+
+@pytest.mark.parametrize("name", [
+    "sage", "sage-topk", "sage-partial-topk"])
+def test_a_recorded_trace_is_replayed_without_network(
+    name, tmp_path, monkeypatch
+):
+    path = str(tmp_path / "trace.bin")
+    with server() as standin:
+        recording = RecordingTransport(HTTPTransport(standin.url), path)
+        expected, calls = execute(name, recording)
+        recording.close()
+    assert calls > 1
+
+    def connect(*args, **kwargs):
+        raise OSError("the network is disabled")
+
+    monkeypatch.setattr(socket.socket, "connect", connect)
+    assert execute(name, ReplayTransport(path)) == (expected, calls)
+    # the trace only contains the requests of the recorded query, once
+    replay = ReplayTransport(path)
+    with pytest.raises(Exception, match="does not match the trace"):
+        execute(name, replay, query=QUERY.replace("ex:q ?l", "ex:p ?l"))
+    replay = ReplayTransport(path)
+    execute(name, replay)
+    with pytest.raises(Exception, match="does not contain more requests"):
+        replay.post(b"{}")
+    replay.close()
+
+
+def test_the_original_timing_waits_as_long_as_the_server(tmp_path, clock):
+    path = str(tmp_path / "trace.bin")
+    recording = RecordingTransport(
+        Replica(clock, "http://replica", latency=0.25), path)
+    for _ in range(3):
+        recording.post('{"query": "q"}')
+    recording.close()
+    replay = ReplayTransport(path, timing="original")
+    for _ in range(3):
+        assert replay.post('{"query": "q"}') == b'{"url": "http://replica"}'
+    replay.close()
+    assert clock.sleeps == pytest.approx([0.25] * 3)
@@ -0,0 +1,134 @@
+import json
+import tracemalloc
+
+import pytest
+
+from validation import (
+    compare_bags, compare_files, compare_topk, get_orderby_variables,
+    iter_solutions)
+
+
+def solutions(size):
+    # values that contain the delimiters of a JSON array and escapes
+    return [
+        {"?s": f"http://example.org/s{index}",
+         "?o": f'"a, b] [{{c}}\\" é {index % 97}"'}
+        for index in range(size)]
+
+
+def write(path, mappings, indent=None):
+    with open(path, "w") as writer:
+        json.dump(mappings, writer, indent=indent)
+    return str(path)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 65536])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_solutions_are_read_across_chunks(tmp_path, chunk_size, indent):
+    expected = solutions(200)
+    path = write(tmp_path / "solutions.json", expected, indent=indent)
+    assert list(iter_solutions(path, chunk_size=chunk_size)) == expected
+
+
+def test_a_large_file_is_streamed(tmp_path):
+    path = write(tmp_path / "solutions.json", solutions(50000))
+    with open(path, "r") as reader:
+        size = len(reader.read())
+    tracemalloc.start()
+    count = sum(1 for _ in iter_solutions(path, chunk_size=4096))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert count == 50000
+    # only a chunk and a solution are held in memory
+    assert peak < size / 50
+
+
+def test_empty_and_invalid_files(tmp_path):
+    assert list(iter_solutions(write(tmp_path / "empty.json", []))) == []
+    path = tmp_path / "object.json"
+    path.write_text('{"?s": "s"}')
+    with pytest.raises(Exception, match="JSON array"):
+        list(iter_solutions(str(path)))
+    path = tmp_path / "truncated.json"
+    path.write_text('[{"?s": "s1"}, {"?s": "s')
+    with pytest.raises(Exception, match="not a valid JSON array"):
+        list(iter_solutions(str(path), chunk_size=4))
+
+
+def test_bags_count_duplicated_solutions():
+    a, b = {"?s": "a"}, {"?s": "b"}
+    assert compare_bags([a, a, b], [a, b, a])
+    assert compare_bags([{"?s": "a", "?o": "1"}], [{"?o": "1", "?s": "a"}])
+    assert not compare_bags([a, a, b], [a, b, b])
+    assert not compare_bags([a, a, b], [a, b])
+    assert not compare_bags([a, b], [a, a, b])
+    assert compare_bags([], [])
+
+
+def test_files_are_compared_as_bags_or_sequences(tmp_path):
+    a, b = {"?s": "a"}, {"?s": "b"}
+    reference = write(tmp_path / "reference.json", [a, b, b])
+    assert compare_files(reference, write(tmp_path / "bag.json", [b, a, b]))
+    assert not compare_files(
+        reference, write(tmp_path / "sequence.json", [b, a, b]),
+        ordered=True)
+    assert compare_files(
+        reference, write(tmp_path / "same.json", [a, b, b]), ordered=True)
+
+
+def topk(*solutions):
+    return [{"?s": subject, "?o": value} for value, subject in solutions]
+
+
+def test_a_tie_straddling_the_k_boundary_is_accepted():
+    # c and d are tied at the 3rd position, the reference kept c
+    reference = topk((1, "a"), (2, "b"), (3, "c"))
+    assert compare_topk(reference, topk((1, "a"), (2, "b"), (3, "d")), ["?o"])
+    # the ties can be in any order
+    reference = topk((1, "a"), (3, "c"), (3, "d"))
+    assert compare_topk(reference, topk((1, "a"), (3, "e"), (3, "c")), ["?o"])
+
+
+def test_a_wrong_value_at_the_k_boundary_is_rejected():
+    reference = topk((1, "a"), (2, "b"), (3, "c"))
+    assert not compare_topk(
+        reference, topk((1, "a"), (2, "b"), (4, "c")), ["?o"])
+    # too many or too few ties at the boundary
+    assert not compare_topk(
+        reference, topk((1, "a"), (2, "b"), (3, "c"), (3, "d")), ["?o"])
+    assert not compare_topk(reference, topk((1, "a"), (2, "b")), ["?o"])
+
+
+def test_ties_before_the_k_boundary_must_be_the_same_solutions():
+    reference = topk((1, "a"), (1, "b"), (2, "c"))
+    assert compare_topk(reference, topk((1, "b"), (1, "a"), (2, "c")), ["?o"])
+    assert not compare_topk(
+        reference, topk((1, "a"), (1, "d"), (2, "c")), ["?o"])
+    # duplicated solutions are counted
+    reference = topk((1, "a"), (1, "a"), (2, "c"))
+    assert not compare_topk(
+        reference, topk((1, "a"), (2, "c"), (2, "c")), ["?o"])
+    # solutions must be sorted on their keys
+    assert not compare_topk(
+        reference, topk((2, "c"), (1, "a"), (1, "a")), ["?o"])
+
+
+def test_keys_with_several_variables():
+    # the solutions tied on ?o are not tied on ?o ?s
+    reference = topk((1, "a"), (1, "b"), (2, "c"))
+    assert not compare_topk(
+        reference, topk((1, "a"), (1, "b"), (2, "d")), ["?o", "?s"])
+    assert compare_topk(
+        reference, topk((1, "a"), (1, "b"), (2, "c")), ["?o", "?s"])
+    assert compare_topk([], [], ["?o"])
+    assert not compare_topk([], topk((1, "a")), ["?o"])
+    assert get_orderby_variables((
+        "SELECT * WHERE { ?s ?p ?o } ORDER BY DESC(?o) STRLEN(?s) "
+        "LIMIT 3")) == ["?o", "?s"]
+
+
+def test_files_are_compared_as_topk(tmp_path):
+    reference = write(tmp_path / "reference.json", topk((1, "a"), (2, "b")))
+    actual = write(tmp_path / "actual.json", topk((1, "a"), (2, "c")))
+    assert compare_files(reference, actual, keys=["?o"])
+    assert not compare_files(reference, actual, ordered=True)
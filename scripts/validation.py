@@ -0,0 +1,359 @@
+import json
+import os
+import glob
+import logging
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from itertools import zip_longest
+from collections import Counter
+from rdflib.plugins.sparql.parser import parseQuery
+from rdflib.plugins.sparql.algebra import translateQuery
+
+
+def get_orderby_variables(query: str) -> List[str]:
+    """
+    Returns the variables that appear in the ORDER BY clause of a query, in
+    the order of the ORDER BY clause.
+
+    Parameters
+    ----------
+    query: str
+        A SPARQL TOP-K query.
+
+    Returns
+    -------
+    List[str]
+        The variables that appear in the ORDER BY clause of the query.
+    """
+    variables = []
+    for expr in translateQuery(parseQuery(query)).algebra.p.p.p.expr:
+        for variable in expr._vars:
+            variables.append(variable.n3())
+    return variables
+
+
+def iter_solutions(path: str, chunk_size: int = 65536) -> Iterator[Dict]:
+    """
+    Iterates over the solutions mappings stored in a JSON file, i.e. a JSON
+    array of objects, without loading the whole file in memory.
+
+    Parameters
+    ----------
+    path: str
+        The path to a JSON file that contains an array of solutions mappings.
+    chunk_size: int - (default = 65536)
+        The number of characters read from the file at a time.
+
+    Returns
+    -------
+    Iterator[Dict]
+        The solutions mappings, in the order of the file.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r") as reader:
+        buffer = reader.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise Exception(f"{path} does not contain a JSON array...")
+        position = 1
+        eof = False
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                if position == len(buffer):
+                    raise json.JSONDecodeError("", buffer, position)
+                mappings, position = decoder.raw_decode(buffer, position)
+                yield mappings
+            except json.JSONDecodeError:
+                if eof:
+                    raise Exception(f"{path} is not a valid JSON array...")
+                chunk = reader.read(chunk_size)
+                eof = len(chunk) == 0
+                buffer = buffer[position:] + chunk
+                position = 0
+
+
+def solution_hash(mappings: Dict[str, str]) -> int:
+    """
+    Computes a fast, non-cryptographic, hash of a solution mappings. The hash
+    does not depend on the order of the variables in the mappings. As Python
+    randomizes the hash of strings, hashes can only be compared inside the same
+    process.
+
+    Parameters
+    ----------
+    mappings: Dict[str, str]
+        A solution mappings.
+
+    Returns
+    -------
+    int
+        The hash of the solution mappings.
+    """
+    return hash(tuple(sorted(mappings.items())))
+
+
+def compare_bags(reference: Iterable[Dict], actual: Iterable[Dict]) -> bool:
+    """
+    Checks that two sets of solutions are equal, i.e. that they contain the
+    same solutions with the same number of duplicates. The order of solutions
+    is not taken into account. Only the hashes of the reference solutions are
+    kept in memory.
+
+    Parameters
+    ----------
+    reference: Iterable[Dict]
+        The expected solutions.
+    actual: Iterable[Dict]
+        The solutions to validate.
+
+    Returns
+    -------
+    bool
+        True if both sets of solutions are equal, False otherwise.
+    """
+    memory = Counter(solution_hash(mappings) for mappings in reference)
+    for mappings in actual:
+        key = solution_hash(mappings)
+        if memory[key] == 0:
+            logging.info(f"Incorrect or duplicated solution: {mappings}")
+            return False
+        memory[key] -= 1
+    for key, count in memory.items():
+        if count > 0:
+            logging.info(f"{count} solution(s) missing")
+            return False
+    return True
+
+
+def group_by_key(
+    solutions: Iterable[Dict], keys: Optional[List[str]] = None
+) -> Iterator[Tuple[Tuple, List[int]]]:
+    """
+    Groups consecutive solutions that share the same ORDER BY key.
+
+    Parameters
+    ----------
+    solutions: Iterable[Dict]
+        A sequence of solutions mappings.
+    keys: None | List[str] - (default = None)
+        The variables of the ORDER BY clause. If None, all the variables of a
+        solution are part of its key.
+
+    Returns
+    -------
+    Iterator[Tuple[Tuple, List[int]]]
+        For each group, its key and the hashes of its solutions.
+    """
+    current_key = None
+    group = []
+    for mappings in solutions:
+        if keys is None:
+            key = tuple(sorted(mappings.items()))
+        else:
+            key = tuple(mappings.get(variable) for variable in keys)
+        if len(group) > 0 and key != current_key:
+            yield current_key, group
+            group = []
+        current_key = key
+        group.append(solution_hash(mappings))
+    if len(group) > 0:
+        yield current_key, group
+
+
+def check_groups(
+    expected: Optional[Tuple[Tuple, List[int]]],
+    found: Optional[Tuple[Tuple, List[int]]],
+    ties: bool = False
+) -> bool:
+    """
+    Checks that a group of solutions matches the expected group.
+
+    Parameters
+    ----------
+    expected: None | Tuple[Tuple, List[int]]
+        The expected group, as returned by `group_by_key`.
+    found: None | Tuple[Tuple, List[int]]
+        The group to validate, as returned by `group_by_key`.
+    ties: bool - (default = False)
+        True if any solution with the key of the group is accepted, i.e. only
+        the number of solutions is checked, False otherwise.
+
+    Returns
+    -------
+    bool
+        True if the group matches the expected group, False otherwise.
+    """
+    if expected is None or found is None:
+        logging.info("The number of solutions is different")
+        return False
+    if expected[0] != found[0]:
+        logging.info(f"Expected key {expected[0]} but found {found[0]}")
+        return False
+    if ties and len(expected[1]) != len(found[1]):
+        logging.info(f"Wrong number of solutions for key {expected[0]}")
+        return False
+    if not ties and Counter(expected[1]) != Counter(found[1]):
+        logging.info(f"Different solutions for key {expected[0]}")
+        return False
+    return True
+
+
+def compare_sequences(
+    reference: Iterable[Dict], actual: Iterable[Dict],
+    keys: Optional[List[str]] = None
+) -> bool:
+    """
+    Checks that two sequences of solutions are equal, the order of solutions
+    being significant. Solutions that share the same ORDER BY key can appear
+    in any order. Both sequences are read in lockstep, so only one group of
+    solutions with the same key is kept in memory at a time.
+
+    Parameters
+    ----------
+    reference: Iterable[Dict]
+        The expected solutions, in the expected order.
+    actual: Iterable[Dict]
+        The solutions to validate.
+    keys: None | List[str] - (default = None)
+        The variables of the ORDER BY clause. If None, all the variables of a
+        solution are part of its key.
+
+    Returns
+    -------
+    bool
+        True if both sequences are equal, False otherwise.
+    """
+    for expected, found in zip_longest(
+        group_by_key(reference, keys=keys), group_by_key(actual, keys=keys)
+    ):
+        if not check_groups(expected, found):
+            return False
+    return True
+
+
+def compare_topk(
+    reference: Iterable[Dict], actual: Iterable[Dict], keys: List[str]
+) -> bool:
+    """
+    Checks that a TOP-K is correct. Both the reference and the TOP-K to
+    validate are sorted on the ORDER BY keys, so they are merged group by
+    group, a group being a sequence of solutions with the same key. All the
+    groups must contain the same solutions, except the last one: when several
+    solutions are tied at the k-th position, any of them belongs to a correct
+    TOP-K, so only the number of solutions of the last group is checked. At
+    most one group of solutions is kept in memory, i.e. O(k) solutions.
+
+    Parameters
+    ----------
+    reference: Iterable[Dict]
+        The expected TOP-K, sorted on the ORDER BY keys.
+    actual: Iterable[Dict]
+        The TOP-K to validate.
+    keys: List[str]
+        The variables of the ORDER BY clause.
+
+    Returns
+    -------
+    bool
+        True if the TOP-K is correct, False otherwise.
+    """
+    groups = zip_longest(
+        group_by_key(reference, keys=keys), group_by_key(actual, keys=keys))
+    previous = next(groups, None)
+    for current in groups:
+        if not check_groups(*previous):
+            return False
+        previous = current
+    if previous is None:  # both TOP-K are empty
+        return True
+    return check_groups(*previous, ties=True)
+
+
+def compare_files(
+    reference: str, actual: str, ordered: bool = False,
+    keys: Optional[List[str]] = None
+) -> bool:
+    """
+    Checks that a JSON file of solutions matches a reference JSON file.
+
+    Parameters
+    ----------
+    reference: str
+        The path to the JSON file that contains the expected solutions.
+    actual: str
+        The path to the JSON file that contains the solutions to validate.
+    ordered: bool - (default = False)
+        True to also check the order of solutions, False otherwise.
+    keys: None | List[str] - (default = None)
+        The variables of the ORDER BY clause. If defined, solutions are
+        validated as a TOP-K, i.e. any tie-break at the k-th position is
+        accepted.
+
+    Returns
+    -------
+    bool
+        True if the solutions match the reference, False otherwise.
+    """
+    if keys is not None:
+        return compare_topk(
+            iter_solutions(reference), iter_solutions(actual), keys)
+    elif ordered:
+        return compare_sequences(
+            iter_solutions(reference), iter_solutions(actual))
+    return compare_bags(iter_solutions(reference), iter_solutions(actual))
+
+
+def list_checks(
+    directory: str, workloads: Optional[str] = None,
+    workload: Optional[str] = None
+) -> List[Tuple[str, str, str, Optional[str]]]:
+    """
+    Lists the results of an experiment that can be validated. The directory
+    must follow the layout of the Snakefile, i.e.
+    {workload}/{approach}-{quota}ms/{limit}/{run}/{query}.json, the reference
+    results being those of the virtuoso approach.
+
+    Parameters
+    ----------
+    directory: str
+        The directory of an experiment, e.g. output/data/stateless.
+    workloads: None | str - (default = None)
+        The directory that contains the workloads, e.g. workloads.
+    workload: None | str - (default = None)
+        The name of a workload, to only list the results of this workload.
+        By default, the results of all workloads are listed.
+
+    Returns
+    -------
+    List[Tuple[str, str, str, Optional[str]]]
+        For each result of the first run, the path to the reference result,
+        the path to the result, the path where the outcome of the validation
+        is expected, and the path to the query if it exists in the workloads.
+    """
+    checks = list()
+    pattern = f"{directory}/{workload or '*'}/*/*/1/*.json"
+    for actual in sorted(glob.glob(pattern)):
+        run_directory = os.path.dirname(actual)
+        limit_directory = os.path.dirname(run_directory)
+        approach_directory = os.path.dirname(limit_directory)
+        workload_directory = os.path.dirname(approach_directory)
+        if os.path.basename(approach_directory).startswith("virtuoso-"):
+            continue
+        query = os.path.basename(actual).split(".")[0]
+        limit = os.path.basename(limit_directory)
+        reference = (
+            f"{workload_directory}/virtuoso-0ms/{limit}/1/{query}.json")
+        if not os.path.exists(reference):
+            continue
+        output = f"{limit_directory}/check/{query}.csv"
+        queryfile = None
+        if workloads is not None:
+            workload = os.path.basename(workload_directory)
+            queryfile = f"{workloads}/{workload}/{query}.sparql"
+            if not os.path.exists(queryfile):
+                queryfile = None
+        checks.append((reference, actual, output, queryfile))
+    return checks